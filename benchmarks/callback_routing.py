@@ -0,0 +1,111 @@
+"""Measure button handler lookup of Bot.callback_query_handler.
+
+Run from the repository root:
+    ```bash
+    python -m benchmarks.callback_routing --prefixes 10 100 1000
+    ```
+For each number of button prefixes (namespaces like `shop:///`, some nested
+    like `shop:///cart`), callback data lookups are timed with:
+    - `linear`: previous implementation, `startswith` on each prefix in
+        registration order;
+    - `trie`: `Bot.callback_trie`, longest prefix match.
+"""
+
+# Standard library modules
+import argparse
+import os
+import random
+import string
+import tempfile
+import time
+
+# Project modules
+from davtelepot.bot import Bot
+
+
+def make_bot(database_path, prefixes, seed=0):
+    """Return a Bot having `prefixes` buttons, a third of them nested."""
+    generator = random.Random(seed)
+    bot = Bot(token='123456:benchmark', database_url=database_path)
+    namespaces = []
+    for n in range(prefixes):
+        if namespaces and n % 3 == 0:
+            name = generator.choice(namespaces)
+            action = ''.join(generator.choices(string.ascii_lowercase, k=5))
+            prefix = f"{name}:///{action}"
+        else:
+            name = ''.join(generator.choices(string.ascii_lowercase, k=6))
+            namespaces.append(name)
+            prefix = f"{name}:///"
+
+        async def handler(bot, update, user_record, data):
+            return
+
+        bot.button(prefix, authorization_level='everybody')(handler)
+    return bot
+
+
+def make_data(bot, number, seed=0):
+    """Return `number` callback data strings (10% of them unknown)."""
+    generator = random.Random(seed)
+    prefixes = list(bot.callback_handlers)
+    return [
+        (
+            f"{generator.choice(prefixes)}{generator.randint(1, 99)}|page"
+            if generator.random() < 0.9
+            else f"unknown:///{generator.randint(1, 99)}"
+        )
+        for _ in range(number)
+    ]
+
+
+def linear_lookup(bot, data):
+    """Return handler of `data`, as in previous implementation."""
+    for start_text, handler in bot.callback_handlers.items():
+        if data.startswith(start_text):
+            return handler
+
+
+def trie_lookup(bot, data):
+    """Return handler of `data`, as in `Bot.callback_query_handler`."""
+    return bot.callback_trie.longest(data)
+
+
+def measure(lookup, bot, data, repeat):
+    """Return microseconds per lookup (best of `repeat` runs)."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for element in data:
+            lookup(bot, element)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(data) * 10 ** 6
+
+
+def main(prefixes, queries, repeat):
+    """Run benchmark and print results."""
+    print(f"{'prefixes':>8} {'linear':>12} {'trie':>12} {'speedup':>8} "
+          f"{'overlaps':>9}")
+    with tempfile.TemporaryDirectory() as directory:
+        for number in prefixes:
+            bot = make_bot(os.path.join(directory, f"{number}.db"), number)
+            data = make_data(bot, queries)
+            # Queries resolved differently, since the longest prefix wins now
+            overlaps = sum(
+                linear_lookup(bot, element) is not trie_lookup(bot, element)
+                for element in data
+            )
+            linear = measure(linear_lookup, bot, data, repeat)
+            trie = measure(trie_lookup, bot, data, repeat)
+            print(f"{number:>8} {linear:>9.2f} us {trie:>9.2f} us "
+                  f"{linear / trie:>7.1f}x {overlaps:>9}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--prefixes', type=int, nargs='+',
+                        default=[10, 100, 1000])
+    parser.add_argument('--queries', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=5)
+    main(**vars(parser.parse_args()))
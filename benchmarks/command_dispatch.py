@@ -0,0 +1,134 @@
+"""Measure command and alias lookup of Bot.text_message_handler.
+
+Run from the repository root:
+    ```bash
+    python -m benchmarks.command_dispatch --aliases 10 100 1000
+    ```
+For each number of aliases, a Bot is given as many localized aliases and
+    lookups of text messages (commands, alias hits and misses) are timed with:
+    - `linear`: previous implementation, a regular expression search per
+        command and a scan of `command_aliases` calling `lower()` on each;
+    - `trie`: `COMMAND_PATTERN` and `Bot.alias_trie`.
+"""
+
+# Standard library modules
+import argparse
+import os
+import random
+import re
+import string
+import tempfile
+import time
+
+# Project modules
+from davtelepot.bot import Bot, COMMAND_PATTERN
+
+LANGUAGES = ('en', 'it', 'fr', 'de', 'es')
+
+
+def make_alias(generator):
+    """Return a random alias made of one or two words."""
+    words = [
+        ''.join(generator.choices(string.ascii_letters,
+                                  k=generator.randint(3, 9)))
+        for _ in range(generator.randint(1, 2))
+    ]
+    return ' '.join(words).capitalize()
+
+
+def make_bot(database_path, aliases, seed=0):
+    """Return a Bot having `aliases` aliases (one per language by command)."""
+    generator = random.Random(seed)
+    bot = Bot(token='123456:benchmark', database_url=database_path)
+    for n in range(0, aliases, len(LANGUAGES)):
+        async def handler(bot, update, user_record):
+            return
+
+        bot.command(
+            f"/command_{n}",
+            aliases=[make_alias(generator)
+                     for _ in range(min(len(LANGUAGES), aliases - n))],
+            authorization_level='everybody'
+        )(handler)
+    return bot
+
+
+def make_texts(bot, number, seed=0):
+    """Return `number` texts: 20% commands, 50% alias hits, 30% misses."""
+    generator = random.Random(seed)
+    aliases = list(bot.command_aliases)
+    commands = list(bot.commands)
+    texts = []
+    for _ in range(number):
+        draw = generator.random()
+        if draw < 0.2:
+            texts.append(f"/{generator.choice(commands)}@benchmark_bot arg")
+        elif draw < 0.7:
+            texts.append(f"{generator.choice(aliases)} with some text")
+        else:
+            texts.append(make_alias(generator) + " is not an alias")
+    return [text.lower() for text in texts]
+
+
+def linear_lookup(bot, text):
+    """Return handler of `text`, as in previous implementation."""
+    if text.startswith('/'):
+        command = re.search(r"([A-z_1-9]){1,32}", text).group(0)
+        if command in bot.commands:
+            return bot.commands[command]['handler']
+        return
+    for alias, function in bot.command_aliases.items():
+        if text.startswith(alias.lower()):
+            return function
+
+
+def trie_lookup(bot, text):
+    """Return handler of `text`, as in `Bot.text_message_handler`."""
+    if text.startswith('/'):
+        match = COMMAND_PATTERN.match(text)
+        command = match.group(1) if match else None
+        if command in bot.commands:
+            return bot.commands[command]['handler']
+        return
+    alias = bot.alias_trie.first(text)
+    if alias is not None:
+        return bot.command_aliases[alias]
+
+
+def measure(lookup, bot, texts, repeat):
+    """Return microseconds per lookup (best of `repeat` runs)."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for text in texts:
+            lookup(bot, text)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(texts) * 10 ** 6
+
+
+def main(aliases, messages, repeat):
+    """Run benchmark and print results."""
+    print(f"{'aliases':>8} {'linear':>12} {'trie':>12} {'speedup':>8}")
+    with tempfile.TemporaryDirectory() as directory:
+        for number in aliases:
+            bot = make_bot(os.path.join(directory, f"{number}.db"), number)
+            texts = make_texts(bot, messages)
+            # The previous command pattern missed `0`: compare aliases only
+            for text in texts:
+                assert text.startswith('/') or (
+                    linear_lookup(bot, text) is trie_lookup(bot, text)
+                ), f"Lookups disagree on `{text}`"
+            linear = measure(linear_lookup, bot, texts, repeat)
+            trie = measure(trie_lookup, bot, texts, repeat)
+            print(f"{number:>8} {linear:>9.2f} us {trie:>9.2f} us "
+                  f"{linear / trie:>7.1f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--aliases', type=int, nargs='+',
+                        default=[10, 100, 1000])
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--repeat', type=int, default=5)
+    main(**vars(parser.parse_args()))
@@ -0,0 +1,96 @@
+"""Compare fresh HTTP sessions and the keep-alive pool of TelegramBot.
+
+Run from the repository root:
+    ```bash
+    python -m benchmarks.connection_pool --requests 2000 --concurrency 20
+    ```
+A local stub server answers every POST with a Telegram-like json object.
+Before: a new aiohttp.ClientSession (hence a new connection) per request.
+After: the pooled session returned by `TelegramBot.get_session`.
+"""
+
+# Standard library modules
+import argparse
+import asyncio
+import time
+
+# Third party modules
+import aiohttp
+from aiohttp import web
+
+# Project modules
+from davtelepot.api import TelegramBot
+
+
+async def stub_handler(request):
+    """Answer like Telegram would."""
+    await request.read()
+    return web.json_response(dict(ok=True, result=True))
+
+
+async def start_stub_server(host='127.0.0.1'):
+    """Run stub server on a free port and return (runner, url)."""
+    app = web.Application()
+    app.router.add_route('POST', '/{tail:.*}', stub_handler)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, host, 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://{host}:{port}/botTOKEN/sendMessage"
+
+
+async def fresh_session_request(bot, url):
+    """Old behaviour: open and close a session for each request."""
+    async with aiohttp.ClientSession() as session:
+        async with session.post(url, data=dict(chat_id='1')) as response:
+            return await response.json()
+
+
+async def pooled_session_request(bot, url):
+    """New behaviour: use the bot keep-alive pool and per-method timeout."""
+    session, _ = bot.get_session('sendMessage')
+    timeout = bot.get_timeout('sendMessage')
+    async with session.post(url, data=dict(chat_id='1'),
+                            timeout=timeout) as response:
+        return await response.json()
+
+
+async def measure(request_function, bot, url, requests, concurrency):
+    """Return requests per second achieved by `request_function`."""
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one_request():
+        async with semaphore:
+            await request_function(bot, url)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one_request() for _ in range(requests)])
+    return requests / (time.perf_counter() - start)
+
+
+async def main(requests, concurrency):
+    """Run both benchmarks and print results."""
+    runner, url = await start_stub_server()
+    bot = TelegramBot(token='TOKEN')
+    try:
+        for name, function in (
+            ('fresh session per request', fresh_session_request),
+            ('keep-alive pool', pooled_session_request),
+        ):
+            rate = await measure(function, bot, url, requests, concurrency)
+            print(f"{name:>28}: {rate:9.1f} requests/s")
+    finally:
+        for session in bot.sessions.values():
+            await session.close()
+        await runner.cleanup()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=20)
+    arguments = parser.parse_args()
+    TelegramBot.loop.run_until_complete(
+        main(arguments.requests, arguments.concurrency)
+    )
@@ -0,0 +1,109 @@
+"""Measure argument injection cost of decorated Bot handlers, per update.
+
+Run from the repository root:
+    ```bash
+    python -m benchmarks.handler_injection --calls 20000
+    ```
+Command, parser, button and inline query handlers registered with
+    `Bot.command`, `Bot.parser`, `Bot.button` and `Bot.query` are called as
+    they are when an update is dispatched, and compared with handlers
+    inspecting the signature of the decorated function on each call (previous
+    implementation).
+"""
+
+# Standard library modules
+import argparse
+import inspect
+import os
+import tempfile
+import time
+
+# Project modules
+from davtelepot.bot import Bot
+
+USER = dict(id=1, is_bot=False, first_name="User", language_code='en')
+MESSAGE = dict(message_id=1, date=0, chat=dict(id=1, type='private'),
+               text='/foo')
+MESSAGE['from'] = USER
+CALLBACK_QUERY = dict(id='1', chat_instance='1', data='bench:///1|2',
+                      message=MESSAGE)
+CALLBACK_QUERY['from'] = USER
+INLINE_QUERY = dict(id='1', query='q', offset='')
+INLINE_QUERY['from'] = USER
+
+
+async def handler(bot, update, user_record):
+    """Return at once."""
+    return
+
+
+async def button_handler(bot, update, user_record, data):
+    """Return at once."""
+    return
+
+
+def always(update):
+    """Match any update."""
+    return True
+
+
+def make_legacy_handler(function):
+    """Return a handler inspecting `function` signature on each call."""
+    async def decorated_handler(bot, update, user_record):
+        data = update.get('data')  # noqa: F841, used by locals()
+        if bot.authorization_function(update=update, user_record=user_record,
+                                      authorization_level='everybody'):
+            return await function(
+                **{
+                    name: argument
+                    for name, argument in locals().items()
+                    if name in inspect.signature(function).parameters
+                }
+            )
+    return decorated_handler
+
+
+def make_handlers(bot):
+    """Return (kind, update, current handler, legacy handler) tuples."""
+    bot.command('/foo', authorization_level='everybody')(handler)
+    bot.parser(always, authorization_level='everybody')(handler)
+    bot.button('bench:///', authorization_level='everybody')(button_handler)
+    bot.query(always, authorization_level='everybody')(handler)
+    return [
+        ('command', MESSAGE, bot.commands['foo']['handler'],
+         make_legacy_handler(handler)),
+        ('parser', MESSAGE, bot.text_message_parsers[always]['handler'],
+         make_legacy_handler(handler)),
+        ('button', CALLBACK_QUERY, bot.callback_handlers['bench:///'][
+            'handler'], make_legacy_handler(button_handler)),
+        ('query', INLINE_QUERY, bot.inline_query_handlers[always]['handler'],
+         make_legacy_handler(handler)),
+    ]
+
+
+async def measure(bot, function, update, calls):
+    """Return microseconds per call of `function`."""
+    start = time.perf_counter()
+    for _ in range(calls):
+        await function(bot=bot, update=update, user_record=None)
+    return (time.perf_counter() - start) / calls * 10 ** 6
+
+
+async def main(calls):
+    """Run benchmark and print results."""
+    with tempfile.TemporaryDirectory() as directory:
+        bot = Bot(token='123456:benchmark',
+                  database_url=os.path.join(directory, 'benchmark.db'))
+        print(f"{'handler':>8} {'legacy':>12} {'current':>12} "
+              f"{'speedup':>8}")
+        for kind, update, current, legacy in make_handlers(bot):
+            legacy_time = await measure(bot, legacy, update, calls)
+            current_time = await measure(bot, current, update, calls)
+            print(f"{kind:>8} {legacy_time:>9.2f} us {current_time:>9.2f} us "
+                  f"{legacy_time / current_time:>7.1f}x")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--calls', type=int, default=20000)
+    Bot.loop.run_until_complete(main(**vars(parser.parse_args())))
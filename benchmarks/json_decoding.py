@@ -0,0 +1,88 @@
+"""Compare JSON libraries decoding Telegram updates.
+
+Run from the repository root:
+    ```bash
+    python -m benchmarks.json_decoding --payloads recorded_updates.jsonl
+    ```
+`--payloads` is a file with one recorded `getUpdates` response or webhook
+    body per line. If it is not given, typical synthetic updates are used.
+The codec selected by `davtelepot.json_codec` is reported as well.
+"""
+
+# Standard library modules
+import argparse
+import json
+import time
+
+# Project modules
+from davtelepot.json_codec import codec
+
+
+def make_synthetic_payloads():
+    """Return a list of JSON-encoded updates of various types."""
+    user = dict(id=123456789, is_bot=False, first_name="Ada",
+                last_name="Lovelace", username="ada", language_code="en")
+    chat = dict(id=-1001234567890, title="Group", type='supergroup')
+    message = dict(
+        message_id=1, date=1579440000, chat=chat, text="/start@my_bot hello",
+        entities=[dict(offset=0, length=13, type='bot_command')],
+    )
+    message['from'] = user
+    callback_query = dict(id='1234567890', chat_instance='-987654321',
+                          data='button:///1|2|3',
+                          message=dict(message, text="Pick one"))
+    callback_query['from'] = user
+    inline_query = dict(id='1234567891', query="search text", offset='')
+    inline_query['from'] = user
+    updates = [
+        dict(update_id=1, message=message),
+        dict(update_id=2, callback_query=callback_query),
+        dict(update_id=3, inline_query=inline_query),
+    ]
+    payloads = [json.dumps(update) for update in updates]
+    # A full getUpdates response having 100 updates
+    payloads.append(
+        json.dumps(
+            dict(ok=True, result=[
+                dict(updates[n % 3], update_id=n) for n in range(100)
+            ])
+        )
+    )
+    return [payload.encode('utf-8') for payload in payloads]
+
+
+def get_decoders():
+    """Return available (name, loads) pairs."""
+    decoders = [('json (stdlib)', json.loads)]
+    for name in ('orjson', 'ujson'):
+        try:
+            decoders.append((name, __import__(name).loads))
+        except ImportError:
+            pass
+    decoders.append((f"selected codec ({codec.name})", codec.loads))
+    return decoders
+
+
+def measure(loads, payloads, rounds):
+    """Return decoded megabytes per second."""
+    size = sum(len(payload) for payload in payloads) * rounds
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for payload in payloads:
+            loads(payload)
+    return size / (time.perf_counter() - start) / 2 ** 20
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--payloads', default=None)
+    parser.add_argument('--rounds', type=int, default=2000)
+    arguments = parser.parse_args()
+    if arguments.payloads:
+        with open(arguments.payloads, 'rb') as payloads_file:
+            payloads = [line for line in payloads_file if line.strip()]
+    else:
+        payloads = make_synthetic_payloads()
+    for name, loads in get_decoders():
+        print(f"{name:>24}: {measure(loads, payloads, arguments.rounds):8.1f}"
+              " MiB/s")
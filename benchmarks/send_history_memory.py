@@ -0,0 +1,94 @@
+"""Measure memory used to remember per-chat sending times.
+
+Run from the repository root, once per mode (each run starts from a clean
+    process, so that RSS figures are comparable):
+    ```bash
+    python -m benchmarks.send_history_memory --mode bounded
+    python -m benchmarks.send_history_memory --mode unbounded
+    ```
+A simulated clock advances by 1/30 s at each request (the global limit),
+    while requests are sent to `--chats` distinct chats (one in ten is a
+    group). The `unbounded` mode reproduces the former `last_sending_time`
+    dictionary, which kept an entry for every chat forever.
+"""
+
+# Standard library modules
+import argparse
+import datetime
+import os
+import resource
+
+# Project modules
+from davtelepot.flood_control import RateLimiter
+
+
+class SimulatedClock(object):
+    """Monotonic clock advanced manually."""
+
+    def __init__(self):
+        """Start at zero."""
+        self.now = 0.0
+
+    def __call__(self):
+        """Return current simulated time."""
+        return self.now
+
+
+def get_rss():
+    """Return current resident set size in MiB (Linux only)."""
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            pages = int(statm.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / 2 ** 20
+    except (OSError, ValueError):
+        return float('nan')
+
+
+def get_peak_rss():
+    """Return peak resident set size in MiB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+def simulate_bounded(chats, report_every):
+    """Record sends with RateLimiter histories."""
+    clock = SimulatedClock()
+    limiter = RateLimiter(clock=clock)
+    for n in range(1, chats + 1):
+        chat_id = n if n % 10 else -n
+        limiter.record(chat_id)
+        clock.now += limiter.bucket.interval
+        if n % report_every == 0:
+            yield n, len(limiter.chats)
+
+
+def simulate_unbounded(chats, report_every):
+    """Record sends like the former `last_sending_time` dictionary."""
+    last_sending_time = dict()
+    start = datetime.datetime.now()
+    for n in range(1, chats + 1):
+        chat_id = n if n % 10 else -n
+        now = start + datetime.timedelta(seconds=n / 30)
+        if chat_id > 0:
+            last_sending_time[chat_id] = now
+        else:
+            last_sending_time.setdefault(chat_id, []).append(now)
+        if n % report_every == 0:
+            yield n, len(last_sending_time)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--mode', choices=('bounded', 'unbounded'),
+                        default='bounded')
+    parser.add_argument('--chats', type=int, default=1_000_000)
+    parser.add_argument('--report-every', type=int, default=100_000)
+    arguments = parser.parse_args()
+    simulate = (
+        simulate_bounded if arguments.mode == 'bounded'
+        else simulate_unbounded
+    )
+    print(f"Mode: {arguments.mode} - initial RSS {get_rss():.1f} MiB")
+    for sent, stored in simulate(arguments.chats, arguments.report_every):
+        print(f"{sent:>9} chats | {stored:>9} stored entries | "
+              f"RSS {get_rss():7.1f} MiB")
+    print(f"Peak RSS: {get_peak_rss():.1f} MiB")
@@ -0,0 +1,126 @@
+"""Measure text parser matching of Bot.text_message_handler.
+
+Run from the repository root:
+    ```bash
+    python -m benchmarks.text_parsers --parsers 10 100 1000
+    ```
+For each number of parsers, the same conditions are registered with
+    `Bot.parser` on two bots and messages (80% of them matching no parser)
+    are matched with `Bot.match_text_parser`:
+    - `callable`: each condition is a function searching its regular
+        expression, evaluated in order;
+    - `compiled`: each condition is a regular expression (or a set of
+        keywords), all combined and searched in a single pass.
+The most hit parsers are reported, from `Bot.get_parser_stats`.
+"""
+
+# Standard library modules
+import argparse
+import os
+import random
+import re
+import string
+import tempfile
+import time
+
+# Project modules
+from davtelepot.bot import Bot
+
+
+async def parser_handler(bot, update, user_record):
+    """Return at once."""
+    return
+
+
+def make_words(generator, number):
+    """Return `number` distinct random words."""
+    words = set()
+    while len(words) < number:
+        words.add(''.join(generator.choices(string.ascii_lowercase,
+                                            k=generator.randint(4, 10))))
+    return sorted(words)
+
+
+def make_bots(directory, parsers, seed=0):
+    """Return bots with `parsers` callable and compiled parsers, and words.
+
+    Half of the parsers look for a keyword, the others for a pattern.
+    """
+    generator = random.Random(seed)
+    words = make_words(generator, parsers)
+    callable_bot = Bot(token='123456:callable',
+                       database_url=os.path.join(directory, 'callable.db'))
+    compiled_bot = Bot(token='123456:compiled',
+                       database_url=os.path.join(directory, 'compiled.db'))
+    for n, word in enumerate(words):
+        if n % 2:
+            pattern = re.compile(rf"\b{word} (\d+)\b", re.IGNORECASE)
+            condition = pattern
+        else:
+            pattern = re.compile(rf"\b{word}\b", re.IGNORECASE)
+            condition = {word}
+
+        def matches(text, pattern=pattern):
+            return pattern.search(text) is not None
+        matches.__name__ = word
+        callable_bot.parser(matches, authorization_level='everybody')(
+            parser_handler
+        )
+        compiled_bot.parser(condition, authorization_level='everybody')(
+            parser_handler
+        )
+    return callable_bot, compiled_bot, words
+
+
+def make_texts(words, number, seed=0):
+    """Return `number` lower-cased message texts, 20% matching a parser."""
+    generator = random.Random(seed)
+    filler = make_words(generator, 50)
+    texts = []
+    for _ in range(number):
+        text = ' '.join(generator.choices(filler, k=8))
+        if generator.random() < 0.2:
+            text += f" {generator.choice(words)} {generator.randint(1, 99)}"
+        texts.append(text.lower())
+    return texts
+
+
+def measure(bot, texts, repeat):
+    """Return microseconds per matched text (best of `repeat` runs)."""
+    best = None
+    update = dict(text='')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for text in texts:
+            bot.match_text_parser(update=update, text=text)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best / len(texts) * 10 ** 6
+
+
+def main(parsers, messages, repeat):
+    """Run benchmark and print results."""
+    print(f"{'parsers':>8} {'callable':>12} {'compiled':>12} {'speedup':>8}")
+    for number in parsers:
+        with tempfile.TemporaryDirectory() as directory:
+            callable_bot, compiled_bot, words = make_bots(directory, number)
+            texts = make_texts(words, messages)
+            callable_time = measure(callable_bot, texts, repeat)
+            compiled_time = measure(compiled_bot, texts, repeat)
+            print(f"{number:>8} {callable_time:>9.2f} us "
+                  f"{compiled_time:>9.2f} us "
+                  f"{callable_time / compiled_time:>7.1f}x")
+    top = ', '.join(
+        f"{parser['name']} ({parser['hits']})"
+        for parser in compiled_bot.get_parser_stats()[:3]
+    )
+    print(f"Most hit parsers: {top}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--parsers', type=int, nargs='+',
+                        default=[10, 100, 1000])
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--repeat', type=int, default=3)
+    main(**vars(parser.parse_args()))
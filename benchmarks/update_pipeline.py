@@ -0,0 +1,326 @@
+"""Measure end-to-end throughput of the update pipeline of Bot.
+
+Run from the repository root:
+    ```bash
+    python -m benchmarks.update_pipeline --mode polling --updates 5000
+    ```
+Synthetic updates (text commands, aliases, parser hits, callback queries,
+    inline queries and media) are handled by a Bot talking to a local
+    `davtelepot.fake_api.FakeTelegramServer`.
+Modes:
+    - `route`: `Bot.route_update` is scheduled for each update;
+    - `webhook`: updates are POSTed to `Bot.webhook_feeder` (pass
+        `--webhook-reply 0.05` to reply within webhook responses);
+    - `polling`: updates are queued on the fake server and fetched by
+        `Bot.get_updates`.
+Pass `--update-queue memory` (or `sqlite`) to make updates go through an
+    update queue between ingestion and routing.
+Reported: updates per second, handler latency percentiles (from injection to
+    handler completion), API calls per update and peak RSS.
+Telegram flood limits are lifted unless `--rate-limits` is passed, so that the
+    pipeline itself is measured.
+"""
+
+# Standard library modules
+import argparse
+import asyncio
+import logging
+import os
+import random
+import resource
+import tempfile
+import time
+
+# Third party modules
+import aiohttp
+from aiohttp import web
+
+# Project modules
+from davtelepot.bot import Bot
+from davtelepot.fake_api import FakeTelegramServer
+from davtelepot.flood_control import RateLimiter
+from davtelepot.update_queue import InProcessUpdateQueue, SqliteUpdateQueue
+
+TOKEN = '123456:benchmark'
+# Relative frequency of each kind of synthetic update
+UPDATE_MIX = dict(
+    command=30,
+    alias=10,
+    parser=15,
+    callback_query=20,
+    inline_query=15,
+    media=10,
+)
+# API methods not caused by handling updates
+POLLING_METHODS = ('getMe', 'deleteWebhook', 'getUpdates')
+
+
+class BenchmarkBot(Bot):
+    """Bot recording when each update has been handled."""
+
+    def __init__(self, *args, **kwargs):
+        """Init bot and latency records."""
+        super().__init__(*args, **kwargs)
+        self.injection_times = dict()  # update_id -> time
+        self.latencies = []
+        self.expected_updates = 0
+        self.all_handled = asyncio.Event()
+
+    def expect(self, updates):
+        """Get ready to handle `updates` more updates."""
+        self.expected_updates += updates
+        self.all_handled.clear()
+
+    def inject(self, update_id):
+        """Record injection time of `update_id`."""
+        self.injection_times[update_id] = time.perf_counter()
+
+    async def route_update(self, update):
+        """Route `update` and record its latency."""
+        try:
+            return await super().route_update(update)
+        finally:
+            injection_time = self.injection_times.pop(update['update_id'],
+                                                      None)
+            if injection_time is not None:
+                self.latencies.append(time.perf_counter() - injection_time)
+            if len(self.latencies) >= self.expected_updates:
+                self.all_handled.set()
+
+
+def make_bot(database_path, api_url, rate_limits=False):
+    """Return a BenchmarkBot with commands, aliases, parsers and buttons."""
+    bot = BenchmarkBot(token=TOKEN, database_url=database_path)
+    bot.set_api_url(api_url)
+    if not rate_limits:
+        bot.rate_limiter = RateLimiter(
+            messages_per_second=10 ** 9, burst=10 ** 9,
+            private_chat_cooldown=0, group_chat_cooldown=0,
+            group_messages_per_window=10 ** 9, group_window=0
+        )
+    bot._name = 'benchmark_bot'
+
+    @bot.command('/foo', aliases=['Foo alias'], authorization_level='user')
+    async def foo_command(bot, update, user_record):
+        return "Bar!"
+
+    def is_greeting(text):
+        return text.startswith('hello')
+
+    @bot.parser(is_greeting, authorization_level='user')
+    async def greeting_parser(bot, update, user_record):
+        return "Hello to you!"
+
+    @bot.button('bench:///', authorization_level='user')
+    async def bench_button(bot, update, user_record, data):
+        return dict(text=f"Button {data}")
+
+    def any_query(query):
+        return True
+
+    @bot.query(any_query, authorization_level='user')
+    async def any_query_handler(bot, update, user_record):
+        return [
+            dict(type='article', id=n, title=f"Result {n}",
+                 input_message_content=dict(message_text=f"Result {n}"))
+            for n in range(3)
+        ]
+    return bot
+
+
+def make_updates(number, users, seed=0):
+    """Return `number` synthetic updates sent by `users` different users."""
+    generator = random.Random(seed)
+    kinds = generator.choices(list(UPDATE_MIX), weights=UPDATE_MIX.values(),
+                              k=number)
+    updates = []
+    for update_id, kind in enumerate(kinds, start=1):
+        user = dict(id=generator.randint(1, users), is_bot=False,
+                    first_name="User", language_code='en')
+        message = dict(message_id=update_id, date=int(time.time()),
+                       chat=dict(id=user['id'], type='private'))
+        message['from'] = user
+        if kind == 'command':
+            message['text'] = '/foo'
+        elif kind == 'alias':
+            message['text'] = 'Foo alias'
+        elif kind == 'parser':
+            message['text'] = 'Hello bot'
+        elif kind == 'media':
+            message['photo'] = [dict(file_id=f"photo_{update_id}",
+                                     width=90, height=90)]
+        if kind == 'callback_query':
+            update = dict(callback_query=dict(
+                id=str(update_id), chat_instance='1',
+                data=f"bench:///{update_id}",
+                message=dict(message, text="Pick one")
+            ))
+            update['callback_query']['from'] = user
+        elif kind == 'inline_query':
+            update = dict(inline_query=dict(id=str(update_id), query="q",
+                                            offset=''))
+            update['inline_query']['from'] = user
+        else:
+            update = dict(message=message)
+        update['update_id'] = update_id
+        updates.append(update)
+    return updates
+
+
+async def paced(updates, rate):
+    """Yield `updates`, `rate` per second (as fast as possible if 0)."""
+    start = time.perf_counter()
+    for n, update in enumerate(updates):
+        if rate:
+            delay = start + n / rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        yield update
+
+
+async def drive_route(bot, server, updates, rate, concurrency):
+    """Schedule `Bot.route_update` for each update."""
+    async for update in paced(updates, rate):
+        bot.inject(update['update_id'])
+        asyncio.ensure_future(bot.route_update(update))
+
+
+async def drive_webhook(bot, server, updates, rate, concurrency):
+    """POST updates to `Bot.webhook_feeder` through a local web app."""
+    app = web.Application()
+    app.router.add_route('POST', '/webhook', bot.webhook_feeder)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    url = f"http://127.0.0.1:{port}/webhook"
+    semaphore = asyncio.Semaphore(concurrency)
+    posts = []
+
+    async def post(session, update):
+        async with semaphore:
+            bot.inject(update['update_id'])
+            async with session.post(url, json=update) as response:
+                await response.read()
+
+    try:
+        async with aiohttp.ClientSession() as session:
+            async for update in paced(updates, rate):
+                posts.append(asyncio.ensure_future(post(session, update)))
+            await asyncio.gather(*posts)
+            await bot.all_handled.wait()
+    finally:
+        await runner.cleanup()
+
+
+async def drive_polling(bot, server, updates, rate, concurrency):
+    """Queue updates on fake server and let `Bot.get_updates` fetch them."""
+    polling = asyncio.ensure_future(bot.get_updates(timeout=1))
+    try:
+        async for update in paced(updates, rate):
+            bot.inject(update['update_id'])
+            server.push_update(TOKEN, update)
+        await bot.all_handled.wait()
+    finally:
+        polling.cancel()
+
+
+DRIVERS = dict(
+    route=drive_route,
+    webhook=drive_webhook,
+    polling=drive_polling,
+)
+
+
+def percentile(values, p):
+    """Return `p`-th percentile of sorted `values`."""
+    if not values:
+        return float('nan')
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def get_peak_rss():
+    """Return peak resident set size in MiB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
+async def main(mode, updates, users, rate, concurrency, latency,
+               rate_limits, webhook_reply, update_queue):
+    """Run benchmark and print results."""
+    BenchmarkBot.set_class_webhook_reply(webhook_reply)
+    server = FakeTelegramServer(latency=latency)
+    api_url = await server.start()
+    with tempfile.TemporaryDirectory() as directory:
+        if update_queue == 'memory':
+            BenchmarkBot.set_class_update_queue(InProcessUpdateQueue)
+        elif update_queue == 'sqlite':
+            BenchmarkBot.set_class_update_queue(
+                lambda bot: SqliteUpdateQueue(
+                    os.path.join(directory, 'queue.db'),
+                    poll_interval=0.01
+                )
+            )
+        bot = make_bot(os.path.join(directory, 'benchmark.db'), api_url,
+                       rate_limits=rate_limits)
+        synthetic_updates = make_updates(updates, users)
+        bot.expect(updates)
+        start = time.perf_counter()
+        consumer = None
+        if bot.update_queue is not None:
+            consumer = asyncio.ensure_future(bot.consume_updates())
+        try:
+            await DRIVERS[mode](bot, server, synthetic_updates, rate,
+                               concurrency)
+            await bot.all_handled.wait()
+            elapsed = time.perf_counter() - start
+        finally:
+            if consumer is not None:
+                consumer.cancel()
+            await bot.close_sessions()
+            await server.stop()
+    latencies = sorted(bot.latencies)
+    api_calls = sum(
+        calls
+        for method, calls in server.requests.items()
+        if method not in POLLING_METHODS
+    )
+    print(f"Mode: {mode} - {updates} updates from {users} users")
+    print(f"Throughput: {updates / elapsed:9.1f} updates/s")
+    for p in (50, 95, 99):
+        print(f"Latency p{p}: {percentile(latencies, p) * 1000:9.2f} ms")
+    print(f"API calls per update: {api_calls / updates:.2f} "
+          f"(+ {server.requests['getUpdates']} getUpdates)")
+    stats = bot.update_dispatcher.stats
+    print(f"Update queue: max depth {stats['max_queue_depth']}, "
+          f"average wait {stats['average_waiting_time'] * 1000:.2f} ms")
+    if mode == 'polling':
+        fetch_latency = bot.polling_stats['fetch_latency']
+        batch_size = bot.polling_stats['batch_size'].as_dict()
+        print(f"getUpdates: mean latency {fetch_latency.mean * 1000:.2f} ms, "
+              f"batch sizes {batch_size['buckets']}")
+    print(f"Peak RSS: {get_peak_rss():.1f} MiB")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--mode', choices=list(DRIVERS), default='route')
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--rate', type=float, default=0,
+                        help="Updates per second (0: all at once)")
+    parser.add_argument('--concurrency', type=int, default=40,
+                        help="Simultaneous webhook connections")
+    parser.add_argument('--latency', type=float, default=0.0,
+                        help="Fake API latency in seconds")
+    parser.add_argument('--rate-limits', action='store_true',
+                        help="Enforce Telegram flood limits")
+    parser.add_argument('--webhook-reply', type=float, default=None,
+                        help="Deadline (seconds) to reply within webhook "
+                             "responses")
+    parser.add_argument('--update-queue', choices=['memory', 'sqlite'],
+                        default=None,
+                        help="Queue updates between ingestion and routing")
+    arguments = vars(parser.parse_args())
+    logging.basicConfig(level=logging.WARNING)
+    Bot.loop.run_until_complete(main(**arguments))
@@ -0,0 +1,98 @@
+"""Measure user record lookups of Bot.route_update.
+
+Run from the repository root:
+    ```bash
+    python -m benchmarks.user_records --updates 5000
+    ```
+Updates of several types (text, photo and edited messages, channel posts,
+    polls), most of them routed to placeholder handlers of a default Bot, are
+    routed with:
+    - `always`: previous implementation, looking up the user record of any
+        update;
+    - `needed`: `Bot.needs_user_record`, looking it up only for handlers
+        needing it.
+Derived `Bot.allowed_updates` are reported as well.
+"""
+
+# Standard library modules
+import argparse
+import os
+import random
+import tempfile
+import time
+
+# Project modules
+from davtelepot.bot import Bot
+
+UPDATE_TYPES = (
+    # (update type, message key or None, share of updates)
+    ('message', 'text', 0.4),
+    ('message', 'photo', 0.15),
+    ('edited_message', 'text', 0.2),
+    ('channel_post', 'text', 0.15),
+    ('poll', None, 0.1),
+)
+
+
+def make_updates(number, users, seed=0):
+    """Return `number` updates sent by `users` different users."""
+    generator = random.Random(seed)
+    updates = []
+    for update_id in range(number):
+        update_type, key, _ = generator.choices(
+            UPDATE_TYPES, weights=[share for *_, share in UPDATE_TYPES]
+        )[0]
+        user = dict(id=generator.randint(1, users), is_bot=False,
+                    first_name="User", language_code='en')
+        if key is None:
+            value = dict(id=str(update_id), question="?", options=[])
+        else:
+            value = dict(message_id=update_id, date=0,
+                         chat=dict(id=user['id'], type='private'))
+            value['from'] = user
+            value[key] = 'hello' if key == 'text' else []
+        updates.append({'update_id': update_id, update_type: value})
+    return updates
+
+
+async def measure(bot, updates):
+    """Return microseconds per routed update and user record lookups."""
+    lookups = 0
+    get_user_record = bot.get_user_record
+
+    def counting_get_user_record(update):
+        nonlocal lookups
+        lookups += 1
+        return get_user_record(update=update)
+
+    bot.get_user_record = counting_get_user_record
+    start = time.perf_counter()
+    for update in updates:
+        await bot.route_update(update)
+    elapsed = time.perf_counter() - start
+    del bot.get_user_record
+    return elapsed / len(updates) * 10 ** 6, lookups
+
+
+async def main(updates, users):
+    """Run benchmark and print results."""
+    updates = make_updates(updates, users)
+    print(f"{'lookup':>8} {'time':>12} {'lookups':>8}")
+    with tempfile.TemporaryDirectory() as directory:
+        for name in ('always', 'needed'):
+            bot = Bot(token=f'123456:{name}',
+                      database_url=os.path.join(directory, f'{name}.db'))
+            if name == 'always':
+                bot.needs_user_record = lambda update_type, update: True
+            # Store users first, as running bots do over time
+            await measure(bot, updates)
+            elapsed, lookups = await measure(bot, updates)
+            print(f"{name:>8} {elapsed:>9.2f} us {lookups:>8}")
+        print(f"Allowed updates: {', '.join(bot.allowed_updates)}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--updates', type=int, default=5000)
+    parser.add_argument('--users', type=int, default=500)
+    Bot.loop.run_until_complete(main(**vars(parser.parse_args())))
@@ -811,7 +811,7 @@ async def _stop_button(bot, update, user_record, data):
         result = text
         # Do not stop bots immediately, otherwise callback query
         # will never be answered
-        asyncio.ensure_future(stop_bots(bot))
+        bot.track_task(stop_bots(bot), kind='routing')
     elif command == 'cancel':
         text = bot.get_message(
                 'admin', 'stop_button', 'cancelled',
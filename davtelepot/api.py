@@ -7,24 +7,34 @@ A simple aiohttp asyncronous web client is used to make requests.
 # Standard library modules
 import asyncio
 import datetime
-import json
+import inspect
 import logging
 
 # Third party modules
 import aiohttp
 from aiohttp import web
 
+# Project modules
+from .api_cache import ApiCache
+from .flood_control import (
+    FloodGate, OutboundDispatcher, RateLimiter, outbound_priority
+)
+from .json_codec import codec
+from .webhook_reply import get_webhook_reply, is_webhook_reply_allowed
+
 
 class TelegramError(Exception):
     """Telegram API exceptions class."""
 
-    def __init__(self, error_code=0, description=None, ok=False):
+    def __init__(self, error_code=0, description=None, ok=False,
+                 parameters=None):
         """Get an error response and return corresponding Exception."""
         self._code = error_code
         if description is None:
             self._description = 'Generic error'
         else:
             self._description = description
+        self._parameters = parameters or dict()
         super().__init__(self.description)
 
     @property
@@ -37,6 +47,169 @@ class TelegramError(Exception):
         """Human-readable description of error."""
         return f"Error {self.code}: {self._description}"
 
+    @property
+    def parameters(self):
+        """Response parameters (may be empty).
+
+        See https://core.telegram.org/bots/api#responseparameters
+        """
+        return self._parameters
+
+    @property
+    def retry_after(self):
+        """Return seconds to wait before repeating the request, or None.
+
+        Telegram sets this parameter when flood control is exceeded.
+        """
+        return self.parameters.get('retry_after')
+
+
+class RequestEncoder(object):
+    """Encode parameters of an API method as a request body.
+
+    Parameter names are known in advance, so that encoding takes a single
+        pass over them, ignoring any other item of `parameters` (e.g. `self`
+        and local variables of the calling method).
+    Requests carrying no file are sent as `application/json` bodies;
+        multipart aiohttp.FormData is used only when a file is uploaded.
+    """
+
+    # Parameters expecting a JSON-serialized object or array
+    json_parameters = frozenset(
+        [
+            'allowed_updates', 'errors', 'mask_position', 'media', 'options',
+            'permissions', 'prices', 'reply_markup', 'results',
+            'shipping_options',
+        ]
+    )
+    # Parameters which may carry a file to be uploaded
+    file_parameters = frozenset(
+        [
+            'animation', 'audio', 'certificate', 'document', 'photo',
+            'png_sticker', 'sticker', 'thumb', 'video', 'video_note', 'voice',
+        ]
+    )
+
+    def __init__(self, parameter_names, exclude=None):
+        """Precompile the list of fields and their encoding functions."""
+        exclude = set(exclude or ()) | {'self'}
+        self._fields = tuple(
+            (
+                name,
+                (
+                    self.encode_json if name in self.json_parameters
+                    else self.encode_file if name in self.file_parameters
+                    else self.encode_value
+                )
+            )
+            for name in parameter_names
+            if name not in exclude
+        )
+        self._file_fields = tuple(
+            name
+            for name, _ in self._fields
+            if name in self.file_parameters
+        )
+        self._json_fields = frozenset(
+            name
+            for name, _ in self._fields
+            if name in self.json_parameters
+        )
+
+    @property
+    def fields(self):
+        """Return names of encoded parameters."""
+        return tuple(name for name, _ in self._fields)
+
+    @staticmethod
+    def is_file(value):
+        """Return True if `value` must be uploaded as a file."""
+        return (
+            type(value) in (bytes, bytearray)
+            or hasattr(value, 'read')
+            or (type(value) is dict and 'file' in value)
+        )
+
+    @staticmethod
+    def encode_json(value):
+        """Serialize `value`, unless it is already a string."""
+        if type(value) is str:
+            return value
+        return codec.dumps(value)
+
+    @staticmethod
+    def encode_file(value):
+        """Return the file object of `value`, or `value` itself."""
+        if type(value) is dict and 'file' in value:
+            return value['file']
+        return value
+
+    @staticmethod
+    def encode_value(value):
+        """Serialize numbers, booleans, lists and dicts; keep other values."""
+        if (
+            type(value) in (int, float, bool, list, tuple)
+            or (type(value) is dict and 'file' not in value)
+        ):
+            return codec.dumps(value)
+        if type(value) is dict:
+            return value['file']
+        return value
+
+    def has_files(self, parameters):
+        """Return True if any file is going to be uploaded."""
+        get = parameters.get
+        for name in self._file_fields:
+            value = get(name)
+            if value is not None and self.is_file(value):
+                return True
+        return False
+
+    def encode_form(self, parameters):
+        """Return a aiohttp.FormData object, skipping None values."""
+        # quote_fields must be set to False, otherwise filenames cause troubles
+        data = aiohttp.FormData(quote_fields=False)
+        get = parameters.get
+        for name, encode in self._fields:
+            value = get(name)
+            if value is not None:
+                data.add_field(name, encode(value))
+        return data
+
+    def make_body(self, parameters):
+        """Return a dict of JSON-serializable parameters, skipping None.
+
+        Parameters already serialized by the caller are decoded, so that
+            they are nested as objects; invalid ones are sent as they are, for
+            Telegram to report the error.
+        """
+        body = dict()
+        get = parameters.get
+        json_fields = self._json_fields
+        for name, _ in self._fields:
+            value = get(name)
+            if value is not None:
+                if type(value) is str and name in json_fields:
+                    try:
+                        value = codec.loads(value)
+                    except ValueError:
+                        pass
+                body[name] = value
+        return body
+
+    def encode_body(self, parameters):
+        """Return a JSON payload, skipping None values."""
+        return aiohttp.payload.BytesPayload(
+            codec.dumps_bytes(self.make_body(parameters)),
+            content_type='application/json'
+        )
+
+    def encode(self, parameters):
+        """Return request body: JSON, or multipart if files are uploaded."""
+        if self.has_files(parameters):
+            return self.encode_form(parameters)
+        return self.encode_body(parameters)
+
 
 class TelegramBot(object):
     """Provide python method having the same signature as Telegram API methods.
@@ -46,6 +219,8 @@ class TelegramBot(object):
 
     loop = asyncio.get_event_loop()
     app = web.Application()
+    # Per-method timeout profiles (seconds), applied to each single request.
+    # Methods not listed here use `_default_timeout` (None: no timeout).
     sessions_timeouts = {
         'getUpdates': dict(
             timeout=35,
@@ -54,8 +229,50 @@ class TelegramBot(object):
         'sendMessage': dict(
             timeout=20,
             close=False
-        )
+        ),
+        'answerCallbackQuery': dict(
+            timeout=10,
+            close=False
+        ),
+        'answerInlineQuery': dict(
+            timeout=10,
+            close=False
+        ),
+        'editMessageText': dict(
+            timeout=20,
+            close=False
+        ),
+        'deleteMessage': dict(
+            timeout=20,
+            close=False
+        ),
+        'sendChatAction': dict(
+            timeout=10,
+            close=False
+        ),
     }
+    _default_timeout = None
+    # Base URL of Telegram bot API (may point to a local server)
+    _api_url = 'https://api.telegram.org'
+    # Keep-alive connection pool settings (see `set_class_connection_pool`)
+    _connection_pool = dict(
+        limit=100,
+        limit_per_host=0,
+        ttl_dns_cache=300,
+        keepalive_timeout=60,
+        shared=False
+    )
+    _shared_session = None
+    # Times a request refused with `retry_after` will be sent again
+    _flood_retries = 1
+    # Workers sending requests to chats (0 to send them directly)
+    _outbound_workers = 8
+    # Methods having `edits` priority (others are `interactive` by default)
+    _edit_methods = (
+        'editMessageText', 'editMessageCaption', 'editMessageMedia',
+        'editMessageReplyMarkup', 'editMessageLiveLocation',
+        'stopMessageLiveLocation', 'deleteMessage', 'stopPoll',
+    )
     _absolute_cooldown_timedelta = datetime.timedelta(seconds=1/30)
     _per_chat_cooldown_timedelta = datetime.timedelta(seconds=1)
     _allowed_messages_per_group_per_minute = 20
@@ -63,24 +280,114 @@ class TelegramBot(object):
     def __init__(self, token):
         """Set bot token and store HTTP sessions."""
         self._token = token
+        self._api_url = None
         self.sessions = dict()
         self._flood_wait = 0
-        self.last_sending_time = dict(
-            absolute=(
-                datetime.datetime.now()
-                - self.absolute_cooldown_timedelta
+        self.flood_gate = FloodGate()
+        self.api_cache = None
+        self.outbound_dispatcher = None
+        if self.__class__._outbound_workers:
+            self.outbound_dispatcher = OutboundDispatcher(
+                workers=self.__class__._outbound_workers,
+                get_delay=self.get_chat_delay
             )
-        )
+        self.rate_limiter = self.make_rate_limiter()
+        # Requests queued or being sent (see `drain_requests`)
+        self.requests_in_flight = 0
+        self._no_requests = None
+
+    def make_rate_limiter(self, processes=1):
+        """Return a RateLimiter enforcing class cooldowns.
+
+        The global limit is divided among `processes` sending requests on
+            behalf of this bot at the same time.
+        """
+        return RateLimiter(
+            messages_per_second=(
+                1 / self.absolute_cooldown_timedelta.total_seconds()
+                / processes
+            ),
+            private_chat_cooldown=(
+                self.per_chat_cooldown_timedelta.total_seconds()
+            ),
+            group_chat_cooldown=(
+                self.per_chat_cooldown_timedelta.total_seconds()
+            ),
+            group_messages_per_window=(
+                self.allowed_messages_per_group_per_minute
+            ),
+            group_window=self.longest_cooldown_timedelta.total_seconds()
+        )
+
+    def reset_after_fork(self, processes=1):
+        """Drop sessions, queues and timers inherited from parent process.
+
+        Call it in a forked child process, before making requests: objects
+            bound to the parent event loop cannot be used there.
+        The global rate limit is divided among `processes`.
+        """
+        self.sessions = dict()
+        TelegramBot._shared_session = None
+        self.flood_gate = FloodGate()
+        if self.outbound_dispatcher is not None:
+            self.outbound_dispatcher = OutboundDispatcher(
+                workers=self.__class__._outbound_workers,
+                get_delay=self.get_chat_delay
+            )
+        if self.api_cache is not None:
+            self.api_cache = ApiCache(ttls=self.api_cache.ttls,
+                                      max_size=self.api_cache.max_size)
+        self.rate_limiter = self.make_rate_limiter(processes=processes)
 
     @property
     def token(self):
         """Telegram API bot token."""
         return self._token
 
+    @property
+    def api_url(self):
+        """Base URL of Telegram bot API.
+
+        Requests are posted to `{api_url}/bot{token}/{method}` and files are
+            downloaded from `{api_url}/file/bot{token}/{file_path}`.
+        If instance URL is not set, class URL is returned.
+        """
+        return self._api_url or self.__class__._api_url
+
+    @classmethod
+    def set_class_api_url(cls, api_url):
+        """Set base URL of Telegram bot API for all bots.
+
+        Useful to run bots against a local server, e.g.
+            `davtelepot.fake_api.FakeTelegramServer`.
+        """
+        cls._api_url = api_url.rstrip('/')
+
+    def set_api_url(self, api_url):
+        """Set base URL of Telegram bot API for this bot.
+
+        Pass None to fall back to class URL.
+        """
+        self._api_url = api_url.rstrip('/') if api_url else None
+
+    @property
+    def last_sending_time(self):
+        """Return recent sending times, by chat_id.
+
+        Values are `ChatSendHistory` objects, whose `sent` deque holds
+            `time.monotonic()` timestamps.
+        """
+        return self.rate_limiter.chats
+
     @property
     def flood_wait(self):
         """Seconds to wait before next API requests."""
-        return self._flood_wait
+        return self.flood_gate.get_delay()
+
+    @property
+    def flood_stats(self):
+        """Return counters about time spent throttled by flood control."""
+        return self.flood_gate.stats
 
     @property
     def absolute_cooldown_timedelta(self):
@@ -139,56 +446,204 @@ class TelegramBot(object):
         return response['result']
 
     @staticmethod
-    def adapt_parameters(parameters, exclude=[]):
+    def adapt_parameters(parameters, exclude=None):
         """Build a aiohttp.FormData object from given `paramters`.
 
         Exclude `self`, empty values and parameters in `exclude` list.
         Cast integers to string to avoid TypeError during json serialization.
+        Used for methods not mirrored by this class (see `get_encoder`).
         """
-        exclude.append('self')
+        exclude = set(exclude or ()) | {'self'}
         # quote_fields must be set to False, otherwise filenames cause troubles
         data = aiohttp.FormData(quote_fields=False)
         for key, value in parameters.items():
             if not (key in exclude or value is None):
-                if (
-                    type(value) in (int, list,)
-                    or (type(value) is dict and 'file' not in value)
-                ):
-                    value = json.dumps(value, separators=(',', ':'))
-                data.add_field(key, value)
+                data.add_field(key, RequestEncoder.encode_value(value))
         return data
 
-    def get_session(self, api_method):
-        """According to API method, return proper session and information.
+    @classmethod
+    def get_encoder(cls, method, exclude=None):
+        """Return the RequestEncoder of `method`, or None if it is unknown.
+
+        Encoders are built once per class, method and `exclude` list, from
+            the signature of the camelCase method mirroring `method`.
+        """
+        key = (method, tuple(exclude or ()))
+        encoders = cls.__dict__.get('_encoders')
+        if encoders is None:
+            encoders = dict()
+            setattr(cls, '_encoders', encoders)
+        if key not in encoders:
+            function = getattr(cls, method, None)
+            encoders[key] = (
+                RequestEncoder(
+                    parameter_names=inspect.signature(function).parameters,
+                    exclude=exclude
+                )
+                if asyncio.iscoroutinefunction(function)
+                else None
+            )
+        return encoders[key]
+
+    def encode_parameters(self, method, parameters, exclude=None):
+        """Return the request body for `method` given its `parameters`."""
+        encoder = self.get_encoder(method, exclude)
+        if encoder is None:
+            return self.adapt_parameters(parameters, exclude=exclude)
+        return encoder.encode(parameters)
+
+    @classmethod
+    def set_class_connection_pool(cls, limit=None, limit_per_host=None,
+                                  ttl_dns_cache=None, keepalive_timeout=None,
+                                  shared=None):
+        """Configure the keep-alive connection pool used for API requests.
+
+        `limit` is the maximum number of simultaneous connections (0 for no
+            limit), `limit_per_host` the maximum number of connections to the
+            same endpoint.
+        `ttl_dns_cache` is the number of seconds resolved addresses are
+            cached (None to cache them forever).
+        `keepalive_timeout` is the number of seconds idle connections are
+            kept open.
+        If `shared` is True, all bots will use the same pool.
+        Settings apply to sessions opened after this call.
+        """
+        for key, value in dict(
+            limit=limit,
+            limit_per_host=limit_per_host,
+            ttl_dns_cache=ttl_dns_cache,
+            keepalive_timeout=keepalive_timeout,
+            shared=shared
+        ).items():
+            if value is not None:
+                cls._connection_pool[key] = value
+
+    @classmethod
+    def set_class_timeout(cls, api_method, timeout):
+        """Set the timeout (in seconds) of requests to `api_method`.
+
+        Pass `api_method=None` to set the timeout of methods not having a
+            specific profile.
+        """
+        if api_method is None:
+            cls._default_timeout = timeout
+            return
+        cls.sessions_timeouts[api_method] = dict(
+            timeout=timeout,
+            close=False
+        )
 
+    def get_timeout(self, api_method):
+        """Return the aiohttp.ClientTimeout to be applied to `api_method`."""
+        cls = self.__class__
+        if api_method in cls.sessions_timeouts:
+            timeout = cls.sessions_timeouts[api_method]['timeout']
+        else:
+            timeout = cls._default_timeout
+        return aiohttp.ClientTimeout(total=timeout)
+
+    def make_session(self):
+        """Return a new aiohttp.ClientSession with a keep-alive pool.
+
+        Per-request timeouts are set in `api_request` (see `get_timeout`).
+        """
+        cls = self.__class__
+        pool = cls._connection_pool
+        connector = aiohttp.TCPConnector(
+            limit=pool['limit'],
+            limit_per_host=pool['limit_per_host'],
+            ttl_dns_cache=pool['ttl_dns_cache'],
+            use_dns_cache=True,
+            keepalive_timeout=pool['keepalive_timeout'],
+            loop=cls.loop
+        )
+        return aiohttp.ClientSession(
+            connector=connector,
+            loop=cls.loop,
+            timeout=aiohttp.ClientTimeout(total=None)
+        )
+
+    def get_session(self, api_method=None):
+        """Return the session to be used for API requests and information.
+
+        All API methods share the same keep-alive connection pool (per bot,
+            or per class if pool is `shared`), so that TCP and TLS handshakes
+            are not repeated for each request.
         Return a tuple (session, session_must_be_closed)
         session : aiohttp.ClientSession
-            Client session with proper timeout
+            Client session with a keep-alive connection pool
         session_must_be_closed : bool
-            True if session must be closed after being used once
+            True if session must be closed after being used once (always
+            False, kept for backward compatibility)
         """
         cls = self.__class__
-        if api_method in cls.sessions_timeouts:
-            if api_method not in self.sessions:
-                self.sessions[api_method] = aiohttp.ClientSession(
-                    loop=cls.loop,
-                    timeout=aiohttp.ClientTimeout(
-                        total=cls.sessions_timeouts[api_method]['timeout']
-                    )
-                )
-            session = self.sessions[api_method]
-            session_must_be_closed = cls.sessions_timeouts[api_method]['close']
-        else:
-            session = aiohttp.ClientSession(
-                loop=cls.loop,
-                timeout=aiohttp.ClientTimeout(total=None)
-            )
-            session_must_be_closed = True
-        return session, session_must_be_closed
+        session = self.sessions.get('pool')
+        if session is None or session.closed:
+            if cls._connection_pool['shared']:
+                if (
+                    TelegramBot._shared_session is None
+                    or TelegramBot._shared_session.closed
+                ):
+                    TelegramBot._shared_session = self.make_session()
+                session = TelegramBot._shared_session
+            else:
+                session = self.make_session()
+            self.sessions['pool'] = session
+        return session, False
+
+    @classmethod
+    def set_class_outbound_workers(cls, workers):
+        """Set number of workers sending requests to chats.
+
+        Set `workers` to 0 to send requests directly, with no priority.
+        It applies to bots instantiated after this call.
+        """
+        cls._outbound_workers = workers
+
+    @staticmethod
+    def outbound_priority(priority):
+        """Set priority of requests made within a `with` block.
+
+        `priority` may be `interactive`, `edits` or `bulk`. Usage:
+            ```
+            with bot.outbound_priority('bulk'):
+                for chat_id in chat_ids:
+                    await bot.send_message(chat_id=chat_id, text="News!")
+            ```
+        """
+        return outbound_priority(priority)
+
+    def set_api_cache(self, enabled=True, ttls=None, max_size=10000):
+        """Cache results of idempotent getters (e.g. `getChatMember`).
+
+        `ttls` maps method names to seconds results are kept for (see
+            `ApiCache.default_ttls`); at most `max_size` results are kept,
+            least recently used ones being evicted first.
+        Concurrent identical calls result in a single request.
+        Set `enabled` to False to stop caching.
+        """
+        if not enabled:
+            self.api_cache = None
+            return
+        self.api_cache = ApiCache(ttls=ttls, max_size=max_size)
+
+    def get_request_priority(self, method):
+        """Return default outbound priority of `method`."""
+        if method in self.__class__._edit_methods:
+            return 'edits'
+        return 'interactive'
+
+    def get_chat_delay(self, chat_id):
+        """Return seconds to wait before a request to `chat_id` is allowed."""
+        return max(
+            self.flood_gate.get_delay(chat_id),
+            self.rate_limiter.get_delay(chat_id)
+        )
 
     def set_flood_wait(self, flood_wait):
         """Wait `flood_wait` seconds before next request."""
         self._flood_wait = flood_wait
+        self.flood_gate.pause(flood_wait)
 
     async def prevent_flooding(self, chat_id):
         """Await until request may be sent safely.
@@ -198,107 +653,86 @@ class TelegramBot(object):
         Exact limits are unknown, but less than 30 total private chat messages
             per second, less than 1 private message per chat and less than 20
             group chat messages per chat per minute should be safe.
+        See `davtelepot.flood_control.RateLimiter` for details.
         """
-        now = datetime.datetime.now
-        if type(chat_id) is int and chat_id > 0:
-            while (
-                now() < (
-                    self.last_sending_time['absolute']
-                    + self.absolute_cooldown_timedelta
-                )
-            ) or (
-                chat_id in self.last_sending_time
-                and (
-                    now() < (
-                        self.last_sending_time[chat_id]
-                        + self.per_chat_cooldown_timedelta
-                    )
-                )
-            ):
-                await asyncio.sleep(
-                    self.absolute_cooldown_timedelta.seconds
-                )
-            self.last_sending_time[chat_id] = now()
-        else:
-            while (
-                now() < (
-                    self.last_sending_time['absolute']
-                    + self.absolute_cooldown_timedelta
-                )
-            ) or (
-                chat_id in self.last_sending_time
-                and len(
-                    [
-                        sending_datetime
-                        for sending_datetime in self.last_sending_time[chat_id]
-                        if sending_datetime >= (
-                            now()
-                            - datetime.timedelta(minutes=1)
-                        )
-                    ]
-                ) >= self.allowed_messages_per_group_per_minute
-            ) or (
-                chat_id in self.last_sending_time
-                and len(self.last_sending_time[chat_id]) > 0
-                and now() < (
-                    self.last_sending_time[chat_id][-1]
-                    + self.per_chat_cooldown_timedelta
-                )
-            ):
-                await asyncio.sleep(0.5)
-            if chat_id not in self.last_sending_time:
-                self.last_sending_time[chat_id] = []
-            self.last_sending_time[chat_id].append(now())
-            self.last_sending_time[chat_id] = [
-                sending_datetime
-                for sending_datetime in self.last_sending_time[chat_id]
-                if sending_datetime >= (
-                    now()
-                    - self.longest_cooldown_timedelta
-                )
-            ]
-        self.last_sending_time['absolute'] = now()
-        return
+        return await self.rate_limiter.acquire(chat_id)
 
-    async def api_request(self, method, parameters={}, exclude=[]):
-        """Return the result of a Telegram bot API request, or an Exception.
+    @staticmethod
+    def has_files(parameters):
+        """Return True if any of `parameters` is a file to be uploaded.
 
-        Opened sessions will be used more than one time (if appropriate) and
-            will be closed on `Bot.app.cleanup`.
-        Result may be a Telegram API json response, None, or Exception.
+        Such requests may not be sent twice, since files are read once.
+        """
+        return any(
+            hasattr(value, 'read')
+            or (type(value) is dict and 'file' in value)
+            for value in parameters.values()
+        )
+
+    def handle_flood_error(self, error, chat_id=None):
+        """Pause requests as asked by Telegram `error`, if needed.
+
+        Error 420 (`FLOOD_WAIT_X`) pauses all requests of this bot.
+        Error 429 with a `retry_after` parameter pauses requests in `chat_id`,
+            or all requests if no chat is involved.
+        Return True if the failed request may be sent again after the pause.
         """
-        response_object = None
+        if error.code == 420:  # Flood error!
+            try:
+                flood_wait = int(
+                    error.description.split('_')[-1]
+                ) + 30
+            except Exception as e:
+                logging.error(f"{e}")
+                flood_wait = 5*60
+            logging.critical(
+                "Telegram antiflood control triggered!\n"
+                f"Wait {flood_wait} seconds before making another "
+                "request"
+            )
+            self.set_flood_wait(flood_wait)
+        elif error.code == 429 and error.retry_after is not None:
+            logging.warning(
+                f"Too many requests: waiting {error.retry_after} seconds "
+                f"before next request "
+                f"{'to ' + str(chat_id) if chat_id is not None else ''}"
+            )
+            self.flood_gate.pause(error.retry_after, chat_id=chat_id)
+            return True
+        return False
+
+    async def send_request(self, method, parameters, exclude):
+        """Send a single API request, after waiting for flood control.
+
+        Return a tuple (response_object, retry)
+        response_object : dict, list, bool, Exception or None
+            Result of the request
+        retry : bool
+            True if Telegram asked to send the request again later
+        """
+        response_object, retry = None, False
+        chat_id = parameters.get('chat_id')
         session, session_must_be_closed = self.get_session(method)
-        # Prevent Telegram flood control for all methodsd having a `chat_id`
+        await self.flood_gate.wait(chat_id)
+        # Prevent Telegram flood control for all methods having a `chat_id`
         if 'chat_id' in parameters:
-            await self.prevent_flooding(parameters['chat_id'])
-        parameters = self.adapt_parameters(parameters, exclude=exclude)
+            await self.prevent_flooding(chat_id)
         try:
+            data = self.encode_parameters(method, parameters,
+                                          exclude=exclude)
             async with session.post(
-                "https://api.telegram.org/bot"
-                f"{self.token}/{method}",
-                data=parameters
+                f"{self.api_url}/bot{self.token}/{method}",
+                data=data,
+                timeout=self.get_timeout(method)
             ) as response:
                 try:
                     response_object = self.check_telegram_api_json(
-                        await response.json()  # Telegram returns json objects
+                        # Telegram returns json objects
+                        codec.loads(await response.read())
                     )
                 except TelegramError as e:
                     logging.error(f"API error response - {e}")
-                    if e.code == 420:  # Flood error!
-                        try:
-                            flood_wait = int(
-                                e.description.split('_')[-1]
-                            ) + 30
-                        except Exception as e:
-                            logging.error(f"{e}")
-                            flood_wait = 5*60
-                        logging.critical(
-                            "Telegram antiflood control triggered!\n"
-                            f"Wait {flood_wait} seconds before making another "
-                            "request"
-                        )
-                        self.set_flood_wait(flood_wait)
+                    retry = self.handle_flood_error(e, chat_id=chat_id)
                     response_object = e
                 except Exception as e:
                     logging.error(f"{e}", exc_info=True)
@@ -311,7 +745,149 @@ class TelegramBot(object):
         finally:
             if session_must_be_closed and not session.closed:
                 await session.close()
-        return response_object
+        return response_object, retry
+
+    def reply_in_webhook_response(self, method, parameters, exclude=None):
+        """Store request in the webhook response, if allowed; return True.
+
+        Only the first request made while handling a webhook update, before
+            the deadline, may travel in the webhook response (see
+            `Bot.set_class_webhook_reply`), and only if its result is not
+            needed (see `webhook_reply.is_webhook_reply_allowed`). File
+            uploads are always sent, and so are requests having to wait for
+            flood limits.
+        """
+        webhook_reply = get_webhook_reply()
+        if (
+            webhook_reply is None
+            or not webhook_reply.is_open
+            or not is_webhook_reply_allowed(method)
+        ):
+            return False
+        encoder = self.get_encoder(method, exclude)
+        if encoder is None or encoder.has_files(parameters):
+            return False
+        chat_id = parameters.get('chat_id')
+        if (
+            self.flood_gate.get_delay(chat_id) > 0
+            or not self.rate_limiter.try_acquire(chat_id)
+        ):
+            return False
+        return webhook_reply.claim(method, encoder.make_body(parameters))
+
+    async def dispatch_request(self, method, parameters, exclude=None):
+        """Send a request directly or through the outbound dispatcher.
+
+        Requests to a chat are queued in the outbound dispatcher (if any),
+            according to their priority (see `get_request_priority`).
+        Requests refused with a `retry_after` are sent again once, when the
+            flood control pause ends.
+        A request carried by a webhook response returns True instead of its
+            result, which is unknown. This only happens to methods returning
+            True anyway, and to text replies made within
+            `webhook_reply.results_ignored` (see `reply_in_webhook_response`).
+        """
+        if self.reply_in_webhook_response(method, parameters, exclude):
+            return True
+        chat_id = parameters.get('chat_id')
+        retries = self.__class__._flood_retries
+        if self.has_files(parameters):
+            retries = 0
+        self.requests_in_flight += 1
+        try:
+            while True:
+                if (
+                    chat_id is not None
+                    and self.outbound_dispatcher is not None
+                ):
+                    response_object, retry = (
+                        await self.outbound_dispatcher.submit(
+                            self.send_request, method, parameters, exclude,
+                            chat_id=chat_id,
+                            priority=self.get_request_priority(method)
+                        )
+                    )
+                else:
+                    response_object, retry = await self.send_request(
+                        method, parameters, exclude
+                    )
+                if not (retry and retries > 0):
+                    return response_object
+                retries -= 1
+        finally:
+            self.requests_in_flight -= 1
+            if self._no_requests is not None and not self.requests_in_flight:
+                self._no_requests.set()
+
+    async def drain_requests(self, timeout=None):
+        """Wait up to `timeout` seconds for pending requests to be sent.
+
+        Requests queued in the outbound dispatcher are sent first, then
+            requests sent directly are awaited.
+        Return True if no request is pending.
+        """
+        deadline = (
+            None if timeout is None
+            else asyncio.get_event_loop().time() + timeout
+        )
+        if self.outbound_dispatcher is not None:
+            await self.outbound_dispatcher.drain(timeout)
+        if self.requests_in_flight:
+            if self._no_requests is None:
+                self._no_requests = asyncio.Event()
+            self._no_requests.clear()
+            try:
+                await asyncio.wait_for(
+                    self._no_requests.wait(),
+                    None if deadline is None
+                    else max(0, deadline - asyncio.get_event_loop().time())
+                )
+            except asyncio.TimeoutError:
+                pass
+        return self.requests_in_flight == 0
+
+    async def api_request(self, method, parameters=None, exclude=None):
+        """Return the result of a Telegram bot API request, or an Exception.
+
+        Requests share a keep-alive connection pool, which will be closed on
+            `Bot.app.cleanup`. Timeouts are set per method.
+        Requests to a chat are queued in the outbound dispatcher (if any),
+            according to their priority (see `get_request_priority`).
+        While Telegram flood control is active, requests are queued (see
+            `handle_flood_error`); requests refused with a `retry_after`
+            are sent again once, when the pause ends.
+        If `api_cache` is set, results of idempotent getters are cached (see
+            `set_api_cache`).
+        Result may be a Telegram API json response, None, or Exception.
+        """
+        if parameters is None:
+            parameters = dict()
+        api_cache = self.api_cache
+        if api_cache is None:
+            return await self.dispatch_request(method, parameters, exclude)
+        chat_id = parameters.get('chat_id')
+        if api_cache.is_cacheable(method):
+            encoder = self.get_encoder(method, exclude)
+            return await api_cache.get(
+                key=api_cache.make_key(
+                    method, parameters,
+                    fields=(
+                        encoder.fields if encoder is not None
+                        else sorted(key for key in parameters if key != 'self')
+                    )
+                ),
+                request=lambda: self.dispatch_request(
+                    method, parameters, exclude
+                ),
+                chat_id=chat_id
+            )
+        result = await self.dispatch_request(method, parameters, exclude)
+        if (
+            method in api_cache.invalidating_methods
+            and not isinstance(result, Exception)
+        ):
+            api_cache.invalidate(chat_id=chat_id)
+        return result
 
     async def getMe(self):
         """Get basic information about the bot in form of a User object.
@@ -0,0 +1,161 @@
+"""Cache results of idempotent Telegram API getters.
+
+Results are kept for a per-method time to live, the least recently used
+    ones are evicted beyond `max_size`, and concurrent identical calls are
+    coalesced into a single request (single flight).
+Entries are indexed by chat, so that they can be invalidated when the chat
+    changes (e.g. members join or leave).
+"""
+
+# Standard library modules
+import asyncio
+import collections
+import time
+
+# Result of requests whose caller was cancelled (waiters retry)
+_ABANDONED = object()
+
+
+class ApiCache(object):
+    """LRU cache with per-method TTL and single-flight coalescing."""
+
+    # Default time to live (seconds) of cacheable methods
+    default_ttls = dict(
+        getChat=60,
+        getChatAdministrators=60,
+        getChatMember=30,
+        getChatMembersCount=60,
+        getFile=30 * 60,  # File links are guaranteed to last one hour
+    )
+    # Methods changing chats: their success invalidates cached entries
+    invalidating_methods = frozenset(
+        [
+            'kickChatMember', 'unbanChatMember', 'restrictChatMember',
+            'promoteChatMember', 'setChatPhoto', 'deleteChatPhoto',
+            'setChatTitle', 'setChatDescription', 'pinChatMessage',
+            'unpinChatMessage', 'leaveChat', 'setChatStickerSet',
+            'deleteChatStickerSet', 'exportChatInviteLink',
+        ]
+    )
+
+    def __init__(self, ttls=None, max_size=10000, clock=time.monotonic):
+        """Set time to live by method and maximum number of entries."""
+        self.ttls = dict(self.default_ttls)
+        if ttls:
+            self.ttls.update(ttls)
+        self.max_size = max_size
+        self._clock = clock
+        # key -> (expiry, chat_id, result), least recently used first
+        self._entries = collections.OrderedDict()
+        self._by_chat = collections.defaultdict(set)  # chat_id -> keys
+        self._in_flight = dict()  # key -> future
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    @property
+    def stats(self):
+        """Return cache counters."""
+        return dict(
+            size=len(self._entries),
+            hits=self.hits,
+            misses=self.misses,
+            coalesced=self.coalesced,
+            in_flight=len(self._in_flight),
+        )
+
+    def is_cacheable(self, method):
+        """Return True if results of `method` are cached."""
+        return method in self.ttls
+
+    @staticmethod
+    def make_key(method, parameters, fields):
+        """Return a hashable key for `method` called with `parameters`."""
+        return (method,) + tuple(parameters.get(name) for name in fields)
+
+    def _store(self, key, chat_id, result):
+        """Store `result`, evicting least recently used entries if needed."""
+        entries = self._entries
+        entries[key] = (self._clock() + self.ttls[key[0]], chat_id, result)
+        entries.move_to_end(key)
+        if chat_id is not None:
+            self._by_chat[chat_id].add(key)
+        while len(entries) > self.max_size:
+            self._forget(next(iter(entries)))
+
+    def _forget(self, key):
+        """Remove `key` from entries and chat index."""
+        _, chat_id, _ = self._entries.pop(key)
+        if chat_id is not None:
+            keys = self._by_chat.get(chat_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_chat[chat_id]
+
+    def _lookup(self, key):
+        """Return (True, result) if a fresh entry exists.
+
+        Return (False, None) otherwise.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            return False, None
+        if entry[0] < self._clock():
+            self._forget(key)
+            return False, None
+        self._entries.move_to_end(key)
+        return True, entry[2]
+
+    async def get(self, key, request, chat_id=None):
+        """Return cached result for `key`, or await `request()` and store it.
+
+        Concurrent calls with the same `key` share a single request.
+        If the call making the request is cancelled, calls waiting for it are
+            not: one of them makes the request again.
+        Exceptions and None results are not stored.
+        """
+        while True:
+            found, result = self._lookup(key)
+            if found:
+                self.hits += 1
+                return result
+            if key not in self._in_flight:
+                break
+            self.coalesced += 1
+            result = await asyncio.shield(self._in_flight[key])
+            if result is not _ABANDONED:
+                return result
+        self.misses += 1
+        future = asyncio.get_event_loop().create_future()
+        self._in_flight[key] = future
+        try:
+            result = await request()
+        except asyncio.CancelledError:
+            # Wake up waiters, so that one of them retries
+            future.set_result(_ABANDONED)
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # Mark as retrieved if nobody is waiting
+            raise
+        else:
+            future.set_result(result)
+            if result is not None and not isinstance(result, Exception):
+                self._store(key, chat_id, result)
+        finally:
+            del self._in_flight[key]
+        return result
+
+    def invalidate(self, chat_id=None, method=None):
+        """Forget cached entries about `chat_id` and/or of `method`.
+
+        Call with no arguments to clear the whole cache.
+        """
+        if chat_id is None:
+            keys = list(self._entries)
+        else:
+            keys = list(self._by_chat.get(chat_id, ()))
+        for key in keys:
+            if method is None or key[0] == method:
+                self._forget(key)
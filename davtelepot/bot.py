@@ -34,13 +34,13 @@ Usage
 
 # Standard library modules
 import asyncio
-from collections import OrderedDict
+from collections import OrderedDict, deque
 import datetime
 import io
-import inspect
 import logging
 import os
 import re
+import time
 
 # Third party modules
 from aiohttp import web
@@ -48,15 +48,39 @@ from aiohttp import web
 # Project modules
 from .api import TelegramBot, TelegramError
 from .database import ObjectWithDatabase
+from .json_codec import codec
 from .languages import MultiLanguageObject
+from .sharding import ShardedDispatcher, ShardRouter
+from .update_dispatcher import UpdateDispatcher
+from .update_queue import InProcessUpdateQueue
+from .update_tracking import UpdateIdWindow, UpdateJournal
+from .webhook_reply import (
+    WebhookReply, reset_webhook_reply, results_ignored, set_webhook_reply
+)
 from .utilities import (
-    async_get, escape_html_chars, extract, get_secure_key,
+    Histogram, PatternSet, PrefixTrie, async_get, escape_html_chars, extract,
+    get_argument_injector, get_secure_key, make_argument_injector,
     make_inline_query_answer, make_lines_of_buttons, remove_html_tags
 )
 
 # Do not log aiohttp `INFO` and `DEBUG` levels
 logging.getLogger('aiohttp').setLevel(logging.WARNING)
 
+# A command must always start with the `/` symbol and may not be longer than
+#   32 characters; commands can use latin letters, numbers and underscores
+COMMAND_PATTERN = re.compile(r"/([a-z0-9_]{1,32})")
+
+
+def placeholder_handler(handler):
+    """Mark `handler` as doing nothing but logging updates.
+
+    No user record is looked up for updates routed to placeholder handlers,
+        and their update types are not requested to Telegram (unless
+        `allowed_updates` is given, see `Bot.allowed_updates`).
+    """
+    handler.placeholder = True
+    return handler
+
 
 class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
     """Simple Bot object, providing methods corresponding to Telegram bot API.
@@ -67,6 +91,10 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
     bots = []
     _path = '.'
     runner = None
+    # Forwards updates to worker processes (see `run`)
+    shard_router = None
+    # In worker processes, connection to the front process
+    shard_worker = None
     # TODO: find a way to choose port automatically by default
     # Setting port to 0 does not work unfortunately
     local_host = 'localhost'
@@ -90,6 +118,36 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
     ]
     _log_file_name = None
     _errors_file_name = None
+    # Incoming updates handled at once and waiting to be handled
+    _update_concurrency = 100
+    _update_queue_size = 1000
+    # Updates from the same `chat` (or `user`) are handled in order
+    _update_ordering = 'chat'
+    # Seconds between two saves of the long polling offset
+    _offset_checkpoint_interval = 5
+    # Upper bounds of long polling histograms buckets
+    _fetch_latency_buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+    _batch_size_buckets = (0, 1, 5, 10, 25, 50, 75, 100)
+    # Number of recent webhook update ids remembered to drop retries
+    _webhook_dedup_window = 4096
+    # Seconds to wait for a reply to be sent within webhook response (None to
+    #   always answer webhook requests at once)
+    _webhook_reply_deadline = None
+    # Function returning the UpdateQueue of a bot (None to hand updates to
+    #   the update dispatcher directly) and roles of this node
+    _update_queue_factory = None
+    _ingest_updates = True
+    _consume_updates = True
+    # Seconds granted to in-flight updates and requests on stop
+    _drain_timeout = 30
+    # Message keys making cached information about a chat outdated
+    chat_changing_message_keys = frozenset(
+        [
+            'new_chat_members', 'left_chat_member', 'new_chat_title',
+            'new_chat_photo', 'delete_chat_photo', 'pinned_message',
+            'migrate_to_chat_id', 'migrate_from_chat_id',
+        ]
+    )
 
     def __init__(
         self, token, hostname='', certificate=None, max_connections=40,
@@ -106,7 +164,8 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
         max_connections : int (1 - 100)
             Maximum number of HTTPS connections allowed.
         allowed_updates : List(str)
-            Allowed update types (empty list to allow all).
+            Allowed update types (empty list to allow all, None to allow
+            only types having a handler).
             @type allowed_updates: list(str)
         """
         # Append `self` to class list of instances
@@ -118,7 +177,23 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
         self._path = None
         self.preliminary_tasks = []
         self.final_tasks = []
+        # Long polling: next offset, updates fetched and not handled yet,
+        #   recent update ids and statistics
         self._offset = 0
+        self.update_journal = None
+        self.polled_updates = UpdateIdWindow(
+            size=self.__class__._webhook_dedup_window
+        )
+        self.polling_stats = dict(
+            fetch_latency=Histogram(self.__class__._fetch_latency_buckets),
+            batch_size=Histogram(self.__class__._batch_size_buckets),
+        )
+        # Recent update ids received via webhook (Telegram retries slow ones)
+        self.webhook_updates = UpdateIdWindow(
+            size=self.__class__._webhook_dedup_window
+        )
+        # update_id -> WebhookReply of webhook updates waiting for a reply
+        self.webhook_replies = dict()
         self._hostname = hostname
         self._certificate = certificate
         self._max_connections = max_connections
@@ -140,6 +215,10 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             'pre_checkout_query': self.pre_checkout_query_handler,
             'poll': self.poll_handler,
         }
+        # Update types (and message types) whose handlers were declared not
+        #   to need the record of the user sending the update
+        self.routers_without_user_record = {'chosen_inline_result'}
+        self.message_handlers_without_user_record = set()
         # Different message update types need different handlers
         self.message_handlers = {
             'text': self.text_message_handler,
@@ -178,10 +257,15 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
         self.individual_text_message_handlers = dict()
         self.commands = OrderedDict()
         self.command_aliases = OrderedDict()
+        # Lower-cased command aliases, pointing to the first alias
+        #   registered for them, to find the one prefixing a text
+        self.alias_trie = PrefixTrie()
         self.messages['commands'] = dict()
         self.messages['reply_keyboard_buttons'] = dict()
         self._unknown_command_message = None
         self.text_message_parsers = OrderedDict()
+        # Patterns and keywords of text parsers, searched in a single pass
+        self.text_parser_patterns = PatternSet()
         # Support for /help command
         self.messages['help_sections'] = OrderedDict()
         # Handle location messages
@@ -190,6 +274,8 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
         self.individual_voice_handlers = dict()
         # Callback query-related properties
         self.callback_handlers = OrderedDict()
+        # Button prefixes, to find the longest one prefixing callback data
+        self.callback_trie = PrefixTrie()
         self._callback_data_separator = None
         # Inline query-related properties
         self.inline_query_handlers = OrderedDict()
@@ -218,6 +304,28 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
         self._log_file_name = None
         self._errors_file_name = None
         self.placeholder_requests = dict()
+        # Incoming updates are handled by a bounded number of tasks
+        self.update_dispatcher = UpdateDispatcher(
+            handler=self.handle_update,
+            concurrency=self.__class__._update_concurrency,
+            queue_size=self.__class__._update_queue_size,
+            get_key=self.get_update_key,
+            on_done=self.update_handled
+        )
+        # Updates may go through a queue shared with other processes or hosts
+        self.update_queue = None
+        if self.__class__._update_queue_factory is not None:
+            self.update_queue = self.__class__._update_queue_factory(self)
+        # update_id -> deque of update queue receipts, while update is handled
+        #   (updates are decoded again when handled by worker processes, so
+        #   they are matched by id)
+        self.update_receipts = dict()
+        # Tasks receiving updates, cancelled on stop (see `drain`)
+        self.accepting_updates = True
+        self.intake_tasks = []
+        # Background tasks awaited on stop (see `track_task`)
+        self.tracked_tasks = dict(routing=set(), sending=set())
+        self.drain_stats = dict()
         # Add `users` table with its fields if missing
         self.db['users'].upsert(
             dict(
@@ -365,8 +473,16 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
         """List of update types to be retrieved.
 
         Empty list to allow all updates.
+        Unless given on init, it lists update types routed to handlers which
+            are not placeholders (see `set_router`).
         """
-        return self._allowed_updates or []
+        if self._allowed_updates is None:
+            return [
+                update_type
+                for update_type, handler in self.routing_table.items()
+                if not getattr(handler, 'placeholder', False)
+            ]
+        return self._allowed_updates
 
     @property
     def name(self):
@@ -385,9 +501,10 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
 
     @property
     def offset(self):
-        """Return last update id.
+        """Return offset of next `getUpdates` request.
 
-        Useful to ignore repeated updates and restore original update order.
+        Updates having lower ids are confirmed: they have been stored in the
+            update journal and will not be sent again by Telegram.
         """
         return self._offset
 
@@ -529,7 +646,19 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
         )
 
     async def message_router(self, update, user_record):
-        """Route Telegram `message` update to appropriate message handler."""
+        """Route Telegram `message` update to appropriate message handler.
+
+        Service messages about chat changes invalidate cached API results
+            about that chat (see `set_api_cache`).
+        """
+        if (
+            self.api_cache is not None
+            and 'chat' in update
+            and not self.__class__.chat_changing_message_keys.isdisjoint(
+                update
+            )
+        ):
+            self.api_cache.invalidate(chat_id=update['chat']['id'])
         for key, value in update.items():
             if key in self.message_handlers:
                 return await self.message_handlers[key](update, user_record)
@@ -538,6 +667,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             "However, this message type is unknown."
         )
 
+    @placeholder_handler
     async def edited_message_handler(self, update, user_record):
         """Handle Telegram `edited_message` update."""
         logging.info(
@@ -546,6 +676,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
         )
         return
 
+    @placeholder_handler
     async def channel_post_handler(self, update, user_record):
         """Handle Telegram `channel_post` update."""
         logging.info(
@@ -554,6 +685,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
         )
         return
 
+    @placeholder_handler
     async def edited_channel_post_handler(self, update, user_record):
         """Handle Telegram `edited_channel_post` update."""
         logging.info(
@@ -632,24 +764,22 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
         A callback query is sent when users press inline keyboard buttons.
         Bad clients may send malformed or deceiving callback queries:
             never put secrets in buttons and always check request validity!
-        Get an `answer` from the callback handler associated to the query
-            prefix and use it to edit the source message (or send new ones
-            if text is longer than single message limit).
+        Get an `answer` from the callback handler associated to the longest
+            button prefix of query data and use it to edit the source message
+            (or send new ones if text is longer than single message limit).
         Anyway, the query is answered, otherwise the client would hang and
             the bot would look like idle.
         """
         assert 'data' in update, "Malformed callback query lacking data field."
         answer = dict()
         data = update['data']
-        for start_text, handler in self.callback_handlers.items():
-            if data.startswith(start_text):
-                _function = handler['handler']
-                answer = await _function(
-                    bot=self,
-                    update=update,
-                    user_record=user_record
-                )
-                break
+        handler = self.callback_trie.longest(data)
+        if handler is not None:
+            answer = await handler['handler'](
+                bot=self,
+                update=update,
+                user_record=user_record
+            )
         if answer is None:
             answer = ''
         if type(answer) is str:
@@ -665,7 +795,8 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
                 else (lambda *args, **kwargs: None)
             )
             try:
-                await method(**message_identifier, **edit)
+                with results_ignored():
+                    await method(**message_identifier, **edit)
             except TelegramError as e:
                 logging.info("Message was not modified:\n{}".format(e))
         try:
@@ -681,6 +812,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             logging.error(e)
         return
 
+    @placeholder_handler
     async def shipping_query_handler(self, update, user_record):
         """Handle Telegram `shipping_query` update."""
         logging.info(
@@ -689,6 +821,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
         )
         return
 
+    @placeholder_handler
     async def pre_checkout_query_handler(self, update, user_record):
         """Handle Telegram `pre_checkout_query` update."""
         logging.info(
@@ -697,6 +830,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
         )
         return
 
+    @placeholder_handler
     async def poll_handler(self, update, user_record):
         """Handle Telegram `poll` update."""
         logging.info(
@@ -714,50 +848,33 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             replier = self.individual_text_message_handlers[user_id]
             del self.individual_text_message_handlers[user_id]
         elif text.startswith('/'):  # Handle commands
-            # A command must always start with the ‘/’ symbol and may not be
-            # longer than 32 characters.
-            # Commands can use latin letters, numbers and underscores.
-            command = re.search(
-                r"([A-z_1-9]){1,32}",  # Command pattern (without leading `/`)
-                text
-            ).group(0)  # Get the first group of characters matching pattern
+            match = COMMAND_PATTERN.match(text)
+            command = match.group(1) if match else None
             if command in self.commands:
                 replier = self.commands[command]['handler']
             elif 'chat' in update and update['chat']['id'] > 0:
                 reply = self.unknown_command_message
         else:  # Handle command aliases and text parsers
-            # Aliases are case insensitive: text and alias are both .lower()
-            for alias, function in self.command_aliases.items():
-                if text.startswith(alias.lower()):
-                    replier = function
-                    break
+            # Aliases are case insensitive: the first registered one
+            #   prefixing text is picked
+            alias = self.alias_trie.first(text)
+            if alias is not None:
+                replier = self.command_aliases[alias]
             # Text message update parsers
-            for check_function, parser in self.text_message_parsers.items():
-                if (
-                    parser['argument'] == 'text'
-                    and check_function(text)
-                ) or (
-                    parser['argument'] == 'update'
-                    and check_function(update)
-                ):
-                    replier = parser['handler']
-                    break
+            parser = self.match_text_parser(update=update, text=text)
+            if parser is not None:
+                replier = parser['handler']
         if replier:
             reply = await replier(
                 bot=self,
-                **{
-                    name: argument
-                    for name, argument in locals().items()
-                    if name in inspect.signature(
-                        replier
-                    ).parameters
-                }
+                **get_argument_injector(replier)(locals())
             )
         if reply:
             if type(reply) is str:
                 reply = dict(text=reply)
             try:
-                return await self.reply(update=update, **reply)
+                with results_ignored():
+                    return await self.reply(update=update, **reply)
             except Exception as e:
                 logging.error(
                     f"Failed to handle text message:\n{e}",
@@ -765,6 +882,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
                 )
         return
 
+    @placeholder_handler
     async def audio_file_handler(self, update, user_record):
         """Handle `audio` file update."""
         logging.info(
@@ -772,6 +890,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             "but this handler does nothing yet."
         )
 
+    @placeholder_handler
     async def document_message_handler(self, update, user_record):
         """Handle `document` message update."""
         logging.info(
@@ -779,6 +898,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             "but this handler does nothing yet."
         )
 
+    @placeholder_handler
     async def animation_message_handler(self, update, user_record):
         """Handle `animation` message update."""
         logging.info(
@@ -786,6 +906,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             "but this handler does nothing yet."
         )
 
+    @placeholder_handler
     async def game_message_handler(self, update, user_record):
         """Handle `game` message update."""
         logging.info(
@@ -793,6 +914,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             "but this handler does nothing yet."
         )
 
+    @placeholder_handler
     async def photo_message_handler(self, update, user_record):
         """Handle `photo` message update."""
         logging.info(
@@ -800,6 +922,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             "but this handler does nothing yet."
         )
 
+    @placeholder_handler
     async def sticker_message_handler(self, update, user_record):
         """Handle `sticker` message update."""
         logging.info(
@@ -807,6 +930,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             "but this handler does nothing yet."
         )
 
+    @placeholder_handler
     async def video_message_handler(self, update, user_record):
         """Handle `video` message update."""
         logging.info(
@@ -824,19 +948,14 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
         if replier:
             reply = await replier(
                 bot=self,
-                **{
-                    name: argument
-                    for name, argument in locals().items()
-                    if name in inspect.signature(
-                        replier
-                    ).parameters
-                }
+                **get_argument_injector(replier)(locals())
             )
         if reply:
             if type(reply) is str:
                 reply = dict(text=reply)
             try:
-                return await self.reply(update=update, **reply)
+                with results_ignored():
+                    return await self.reply(update=update, **reply)
             except Exception as e:
                 logging.error(
                     f"Failed to handle voice message:\n{e}",
@@ -844,6 +963,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
                 )
         return
 
+    @placeholder_handler
     async def video_note_message_handler(self, update, user_record):
         """Handle `video_note` message update."""
         logging.info(
@@ -851,6 +971,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             "but this handler does nothing yet."
         )
 
+    @placeholder_handler
     async def contact_message_handler(self, update, user_record):
         """Handle `contact` message update."""
         logging.info(
@@ -868,19 +989,14 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
         if replier:
             reply = await replier(
                 bot=self,
-                **{
-                    name: argument
-                    for name, argument in locals().items()
-                    if name in inspect.signature(
-                        replier
-                    ).parameters
-                }
+                **get_argument_injector(replier)(locals())
             )
         if reply:
             if type(reply) is str:
                 reply = dict(text=reply)
             try:
-                return await self.reply(update=update, **reply)
+                with results_ignored():
+                    return await self.reply(update=update, **reply)
             except Exception as e:
                 logging.error(
                     f"Failed to handle location message:\n{e}",
@@ -888,6 +1004,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
                 )
         return
 
+    @placeholder_handler
     async def venue_message_handler(self, update, user_record):
         """Handle `venue` message update."""
         logging.info(
@@ -895,6 +1012,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             "but this handler does nothing yet."
         )
 
+    @placeholder_handler
     async def poll_message_handler(self, update, user_record):
         """Handle `poll` message update."""
         logging.info(
@@ -902,6 +1020,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             "but this handler does nothing yet."
         )
 
+    @placeholder_handler
     async def new_chat_members_message_handler(self, update, user_record):
         """Handle `new_chat_members` message update."""
         logging.info(
@@ -909,6 +1028,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             "but this handler does nothing yet."
         )
 
+    @placeholder_handler
     async def left_chat_member_message_handler(self, update, user_record):
         """Handle `left_chat_member` message update."""
         logging.info(
@@ -916,6 +1036,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             "but this handler does nothing yet."
         )
 
+    @placeholder_handler
     async def new_chat_title_message_handler(self, update, user_record):
         """Handle `new_chat_title` message update."""
         logging.info(
@@ -923,6 +1044,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             "but this handler does nothing yet."
         )
 
+    @placeholder_handler
     async def new_chat_photo_message_handler(self, update, user_record):
         """Handle `new_chat_photo` message update."""
         logging.info(
@@ -930,6 +1052,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             "but this handler does nothing yet."
         )
 
+    @placeholder_handler
     async def delete_chat_photo_message_handler(self, update, user_record):
         """Handle `delete_chat_photo` message update."""
         logging.info(
@@ -937,6 +1060,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             "but this handler does nothing yet."
         )
 
+    @placeholder_handler
     async def group_chat_created_message_handler(self, update, user_record):
         """Handle `group_chat_created` message update."""
         logging.info(
@@ -944,6 +1068,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             "but this handler does nothing yet."
         )
 
+    @placeholder_handler
     async def supergroup_chat_created_message_handler(self, update,
                                                       user_record):
         """Handle `supergroup_chat_created` message update."""
@@ -952,6 +1077,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             "but this handler does nothing yet."
         )
 
+    @placeholder_handler
     async def channel_chat_created_message_handler(self, update, user_record):
         """Handle `channel_chat_created` message update."""
         logging.info(
@@ -959,6 +1085,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             "but this handler does nothing yet."
         )
 
+    @placeholder_handler
     async def migrate_to_chat_id_message_handler(self, update, user_record):
         """Handle `migrate_to_chat_id` message update."""
         logging.info(
@@ -966,6 +1093,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             "but this handler does nothing yet."
         )
 
+    @placeholder_handler
     async def migrate_from_chat_id_message_handler(self, update, user_record):
         """Handle `migrate_from_chat_id` message update."""
         logging.info(
@@ -973,6 +1101,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             "but this handler does nothing yet."
         )
 
+    @placeholder_handler
     async def pinned_message_message_handler(self, update, user_record):
         """Handle `pinned_message` message update."""
         logging.info(
@@ -980,6 +1109,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             "but this handler does nothing yet."
         )
 
+    @placeholder_handler
     async def invoice_message_handler(self, update, user_record):
         """Handle `invoice` message update."""
         logging.info(
@@ -987,6 +1117,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             "but this handler does nothing yet."
         )
 
+    @placeholder_handler
     async def successful_payment_message_handler(self, update, user_record):
         """Handle `successful_payment` message update."""
         logging.info(
@@ -994,6 +1125,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             "but this handler does nothing yet."
         )
 
+    @placeholder_handler
     async def connected_website_message_handler(self, update, user_record):
         """Handle `connected_website` message update."""
         logging.info(
@@ -1001,6 +1133,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             "but this handler does nothing yet."
         )
 
+    @placeholder_handler
     async def passport_data_message_handler(self, update, user_record):
         """Handle `passport_data` message update."""
         logging.info(
@@ -1744,7 +1877,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             return
         file_bytes = await async_get(
             url=(
-                f"https://api.telegram.org/file/"
+                f"{self.api_url}/file/"
                 f"bot{self.token}/"
                 f"{file['file_path']}"
             ),
@@ -2002,6 +2135,8 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
         command = command.strip('/ ').lower()
 
         def command_decorator(command_handler):
+            inject_arguments = make_argument_injector(command_handler)
+
             async def decorated_command_handler(bot, update, user_record):
                 logging.info(
                     f"Command `{command}@{bot.name}` called by "
@@ -2014,13 +2149,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
                 ):
                     # Pass supported arguments from locals() to command_handler
                     return await command_handler(
-                        **{
-                            name: argument
-                            for name, argument in locals().items()
-                            if name in inspect.signature(
-                                command_handler
-                            ).parameters
-                        }
+                        **inject_arguments(locals())
                     )
                 return self.authorization_denied_message
             self.commands[command] = dict(
@@ -2040,7 +2169,8 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
                             authorization_level=authorization_level
                         )
                     else:
-                        self.command_aliases[alias] = decorated_command_handler
+                        self.add_command_alias(alias,
+                                               decorated_command_handler)
             if show_in_keyboard and (aliases or reply_keyboard_button):
                 _reply_keyboard_button = reply_keyboard_button or aliases[0]
                 self.messages[
@@ -2050,9 +2180,20 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
                     'reply_keyboard_button'] = _reply_keyboard_button
         return command_decorator
 
+    def add_command_alias(self, alias, handler):
+        """Make text messages starting with `alias` call `handler`.
+
+        Aliases are case insensitive: if several aliases differ only in case,
+            the first registered one wins (registering it again replaces its
+            handler).
+        """
+        self.command_aliases[alias] = handler
+        # Lower-cased aliases point to the first alias registered for them
+        self.alias_trie.setdefault(alias.lower(), alias)
+
     def parser(self, condition, description='', authorization_level='admin',
                argument='text'):
-        """Define a text message parser.
+        r"""Define a text message parser.
 
         Decorate command handlers like this:
             ```
@@ -2062,26 +2203,75 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             @bot.parser(custom_criteria, authorization_level='user')
             async def text_parser(bot, update, user_record):
                 return "Result"
+
+            @bot.parser(r"\bweather in (\w+)", authorization_level='user')
+            async def weather_parser(bot, update, user_record):
+                return "Sunny"
+
+            @bot.parser({'hello', 'hi'}, authorization_level='user')
+            async def greeting_parser(bot, update, user_record):
+                return "Hello!"
             ```
-        If condition evaluates True when run on a message text
-            (not starting with '/'), such decorated function gets
-            called on update.
-        Conditions of parsers are evaluated in order; when one is True,
-            others will be skipped.
+        `condition` may be:
+            - a regular expression (string or compiled), searched in message
+                text (case insensitive if it is a string, otherwise as
+                compiled, inline flags included);
+            - a set of keywords, matching if text contains any of them as a
+                whole word (case insensitive);
+            - a callable, getting lower-cased message text (or update, if
+                `argument` is `update`) and returning True if the parser
+                should be called.
+        Regular expressions and keywords are always searched in message text:
+            `argument` must be `text` for them. Each of them may be registered
+            once (ValueError is raised otherwise), while registering a
+            callable condition again replaces its parser.
+        Regular expressions and keywords of all parsers are searched at once,
+            in a single pass over message text (see `PatternSet`); the match
+            starting first wins. Callable conditions are only evaluated if
+            none matches, in order; when one is True, others are skipped.
+        Messages starting with '/' are not parsed.
         `description` provides information about the parser.
         `authorization_level` is the lowest authorization level needed to call
             the parser.
-        """
-        if not callable(condition):
+        Times each parser was called are counted in `hits` (see
+            `get_parser_stats`).
+        """
+        if isinstance(condition, (str, re.Pattern)):
+            kind = 'pattern'
+            if isinstance(condition, str):
+                condition = re.compile(condition, re.IGNORECASE)
+            condition_name = condition.pattern
+        elif isinstance(condition, (set, frozenset, list, tuple)):
+            kind = 'keywords'
+            condition = frozenset(keyword.lower() for keyword in condition)
+            condition_name = '|'.join(sorted(condition))
+        elif callable(condition):
+            kind = 'callable'
+            condition_name = condition.__name__
+        else:
             raise TypeError(
-                f'Condition {condition.__name__} is not a callable'
+                f'Condition {condition} is neither a callable, nor a regular '
+                f'expression, nor a set of keywords'
+            )
+        if argument not in ('text', 'update'):
+            raise ValueError(f'Unsupported parser argument `{argument}`')
+        if kind != 'callable' and argument != 'text':
+            raise ValueError(
+                f'Condition `{condition_name}` is searched in message text: '
+                f'it cannot get the `{argument}`'
+            )
+        if kind != 'callable' and condition in self.text_message_parsers:
+            raise ValueError(
+                f'A parser for condition `{condition_name}` already exists'
             )
 
         def parser_decorator(parser):
+            inject_arguments = make_argument_injector(parser)
+
             async def decorated_parser(bot, update, user_record):
                 logging.info(
                     f"Text message update matching condition "
-                    f"`{condition.__name__}@{bot.name}` from "
+                    f"`{condition_name}@{bot.name}` from "
                     f"`{update['from'] if 'from' in update else update['chat']}`"
                 )
                 if bot.authorization_function(
@@ -2091,21 +2281,64 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
                 ):
                     # Pass supported arguments from locals() to parser
                     return await parser(
-                        **{
-                            name: arg
-                            for name, arg in locals().items()
-                            if name in inspect.signature(parser).parameters
-                        }
+                        **inject_arguments(locals())
                     )
                 return bot.authorization_denied_message
+            if kind == 'pattern':
+                self.text_parser_patterns.add(condition, condition)
+            elif kind == 'keywords':
+                self.text_parser_patterns.add_keywords(condition, condition)
             self.text_message_parsers[condition] = dict(
                 handler=decorated_parser,
                 description=description,
                 authorization_level=authorization_level,
-                argument=argument
+                argument=argument,
+                kind=kind,
+                name=condition_name,
+                hits=0
             )
         return parser_decorator
 
+    def match_text_parser(self, update, text):
+        """Return the text parser to be called on `update`, if any.
+
+        `text` is the lower-cased message text, passed to callable conditions.
+            Patterns and keywords are searched first, in the original message
+            text, so that compiled patterns keep their case sensitivity.
+        """
+        parser = None
+        condition = self.text_parser_patterns.search(update['text'])
+        if condition is not None:
+            parser = self.text_message_parsers[condition]
+        else:
+            for condition, candidate in self.text_message_parsers.items():
+                if candidate['kind'] != 'callable':
+                    continue
+                if (
+                    candidate['argument'] == 'text'
+                    and condition(text)
+                ) or (
+                    candidate['argument'] == 'update'
+                    and condition(update)
+                ):
+                    parser = candidate
+                    break
+        if parser is not None:
+            parser['hits'] += 1
+        return parser
+
+    def get_parser_stats(self):
+        """Return name, kind and hits of text parsers, most hit first."""
+        return sorted(
+            (
+                dict(name=parser['name'], kind=parser['kind'],
+                     hits=parser['hits'])
+                for parser in self.text_message_parsers.values()
+            ),
+            key=lambda parser: parser['hits'],
+            reverse=True
+        )
+
     def set_command(self, command, handler, aliases=None,
                     reply_keyboard_button=None, show_in_keyboard=False,
                     description="",
@@ -2142,7 +2375,8 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
         """Associate a bot button `prefix` with a handler.
 
         When a callback data text starts with `prefix`, the associated handler
-            is called upon the update.
+            is called upon the update. If several button prefixes match (e.g.
+            `menu:///` and `menu:///settings`), the longest one wins.
         Decorate button handlers like this:
             ```
             @bot.button('a_prefix:///', description="A button",
@@ -2162,6 +2396,8 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             )
 
         def button_decorator(handler):
+            inject_arguments = make_argument_injector(handler)
+
             async def decorated_button_handler(bot, update, user_record):
                 logging.info(
                     f"Button `{update['data']}`@{bot.name} pressed by "
@@ -2186,11 +2422,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
                         ]
                     # Pass supported arguments from locals() to handler
                     return await handler(
-                        **{
-                            name: argument
-                            for name, argument in locals().items()
-                            if name in inspect.signature(handler).parameters
-                        }
+                        **inject_arguments(locals())
                     )
                 return bot.authorization_denied_message
             self.callback_handlers[prefix] = dict(
@@ -2198,6 +2430,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
                 description=description,
                 authorization_level=authorization_level
             )
+            self.callback_trie[prefix] = self.callback_handlers[prefix]
         return button_decorator
 
     def query(self, condition, description='', authorization_level='admin'):
@@ -2219,6 +2452,8 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             )
 
         def query_decorator(handler):
+            inject_arguments = make_argument_injector(handler)
+
             async def decorated_query_handler(bot, update, user_record):
                 logging.info(
                     f"Inline query matching condition "
@@ -2232,11 +2467,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
                 ):
                     # Pass supported arguments from locals() to handler
                     return await handler(
-                        **{
-                            name: argument
-                            for name, argument in locals().items()
-                            if name in inspect.signature(handler).parameters
-                        }
+                        **inject_arguments(locals())
                     )
                 return self.authorization_denied_message
             self.inline_query_handlers[condition] = dict(
@@ -2417,7 +2648,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
         """
         request_id = len(self.placeholder_requests)
         self.placeholder_requests[request_id] = 0
-        asyncio.ensure_future(
+        self.track_task(
             self.placeholder_effector(
                 request_id=request_id,
                 timeout=timeout,
@@ -2456,11 +2687,42 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
         """Handle incoming HTTP `request`s.
 
         Get data, feed webhook and return and OK message.
-        """
-        update = await request.json()
-        asyncio.ensure_future(
-            self.route_update(update)
-        )
+        If the update queue is full, wait for a free slot before answering
+            (see `set_class_update_dispatcher`).
+        Updates delivered again by Telegram (which retries when answers are
+            slow) are dropped and counted in `webhook_updates.duplicates`.
+        If a webhook reply deadline is set, the first reply made within it is
+            sent in the response body (see `set_class_webhook_reply`).
+        """
+        if not self.accepting_updates:
+            # Telegram will deliver the update again later
+            return web.Response(status=503)
+        update = codec.loads(await request.read())
+        if (
+            'update_id' in update
+            and not self.webhook_updates.add(update['update_id'])
+        ):
+            logging.info(f"Duplicate update {update['update_id']} dropped")
+            return web.Response(
+                body='OK'.encode('utf-8')
+            )
+        deadline = self.__class__._webhook_reply_deadline
+        webhook_reply = None
+        if deadline is not None and 'update_id' in update:
+            webhook_reply = WebhookReply()
+            self.webhook_replies[update['update_id']] = webhook_reply
+        # Answer later if too many updates are pending, slowing Telegram down
+        await self.submit_update(update)
+        if webhook_reply is not None:
+            replied = await webhook_reply.wait(deadline)
+            self.webhook_replies.pop(update['update_id'], None)
+            if replied:
+                return web.Response(
+                    body=codec.dumps_bytes(
+                        webhook_reply.make_response_body()
+                    ),
+                    content_type='application/json'
+                )
         return web.Response(
             body='OK'.encode('utf-8')
         )
@@ -2492,18 +2754,59 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             )
 
     def setup(self):
-        """Make bot ask for updates and handle responses."""
-        if not self.webhook_url:
-            asyncio.ensure_future(self.get_updates())
+        """Make bot ask for updates and handle responses.
+
+        Nodes sharing an update queue may only ingest or only consume updates
+            (see `set_class_update_queue`).
+        """
+        if not self.__class__._ingest_updates:
+            pass
+        elif not self.webhook_url:
+            self.intake_tasks.append(
+                asyncio.ensure_future(self.get_updates())
+            )
         else:
             asyncio.ensure_future(self.set_webhook())
             self.__class__.app.router.add_route(
                 'POST', self.webhook_local_address, self.webhook_feeder
             )
+        if self.update_queue is not None and self.__class__._consume_updates:
+            self.intake_tasks.append(
+                asyncio.ensure_future(self.consume_updates())
+            )
         asyncio.ensure_future(self.update_users())
 
+    def reset_after_fork(self, processes=1):
+        """Drop sessions, queues and timers inherited from parent process.
+
+        Updates are received, journaled and acknowledged by the parent
+            process: the update journal, long polling offset and update queue
+            are dropped, so that child processes never save checkpoints or
+            flush a stale copy of the journal.
+        """
+        super().reset_after_fork(processes=processes)
+        self.update_journal = None
+        self._offset = 0
+        self.update_queue = None
+        self.update_receipts = dict()
+
     async def close_sessions(self):
-        """Close open sessions."""
+        """Stop update and outbound workers and close open sessions.
+
+        Tracked tasks still running (see `drain`) are cancelled.
+        The long polling offset is saved, so that updates not handled yet are
+            fetched again on next start.
+        """
+        tasks = set.union(*self.tracked_tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self.update_dispatcher.stop()
+        self.save_update_checkpoint()
+        if self.update_queue is not None:
+            await self.update_queue.close()
+        if self.outbound_dispatcher is not None:
+            await self.outbound_dispatcher.stop()
         for session_name, session in self.sessions.items():
             if not session.closed:
                 await session.close()
@@ -2516,7 +2819,7 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
         if self.name is None:
             return
         if allowed_updates is None:
-            allowed_updates = []
+            allowed_updates = self.allowed_updates
         webhook_was_set = await self.setWebhook(
             url=url, certificate=certificate, max_connections=max_connections,
             allowed_updates=allowed_updates
@@ -2551,6 +2854,14 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             List of update types to be retrieved.
             Empty list to allow all updates.
             None to fallback to class default.
+        Requests are pipelined: the next batch is requested while the current
+            one is handed over to the update dispatcher. Each batch is stored
+            in the update journal before the next request confirms it, so
+            that no update is lost if the bot stops (see `UpdateJournal`):
+            after a crash, updates handled since the last checkpoint are
+            handled again (at-least-once delivery).
+        The actual limit shrinks as the update queue fills up (see
+            `get_polling_limit`).
         """
         # Return if token is invalid
         await self.get_me()
@@ -2560,33 +2871,187 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
         if allowed_updates is None:
             allowed_updates = self.allowed_updates
         await self.deleteWebhook()  # Remove eventually active webhook
-        update = None  # Do not update offset if no update is received
-        while True:
-            updates = await self.getUpdates(
-                offset=self._offset,
-                timeout=timeout,
-                limit=limit,
-                allowed_updates=allowed_updates
-            )
-            if updates is None:
-                continue
-            elif isinstance(updates, TelegramError):
-                logging.error(
-                    f"Waiting {error_cooldown} seconds before trying again..."
+        self.update_journal = UpdateJournal(self.db, bot_id=self.telegram_id)
+        self.load_update_checkpoint()
+        asyncio.ensure_future(self.checkpoint_updates())
+        # Handle updates left unhandled by last run first
+        for update in self.update_journal.load():
+            self.polled_updates.add(update['update_id'])
+            await self.submit_update(update)
+        next_batch = asyncio.ensure_future(
+            self.fetch_updates(timeout=timeout, limit=limit,
+                               allowed_updates=allowed_updates)
+        )
+        try:
+            while True:
+                updates = await next_batch
+                if updates is None or isinstance(updates, Exception):
+                    if isinstance(updates, TelegramError):
+                        logging.error(
+                            f"Waiting {error_cooldown} seconds before trying "
+                            "again..."
+                        )
+                        await asyncio.sleep(error_cooldown)
+                    elif isinstance(updates, Exception):
+                        logging.error(
+                            "Unexpected exception. "
+                            f"Waiting {error_cooldown} seconds before trying "
+                            "again..."
+                        )
+                        await asyncio.sleep(error_cooldown)
+                    next_batch = asyncio.ensure_future(
+                        self.fetch_updates(timeout=timeout, limit=limit,
+                                           allowed_updates=allowed_updates)
+                    )
+                    continue
+                # Updates already stored (e.g. before a restart) are skipped
+                new_updates = [
+                    update
+                    for update in updates
+                    if self.polled_updates.add(update['update_id'])
+                ]
+                # Store updates before next request confirms them
+                self.update_journal.append(new_updates)
+                if updates:
+                    self._offset = updates[-1]['update_id'] + 1
+                next_batch = asyncio.ensure_future(
+                    self.fetch_updates(timeout=timeout, limit=limit,
+                                       allowed_updates=allowed_updates,
+                                       incoming=len(new_updates))
                 )
-                await asyncio.sleep(error_cooldown)
-                continue
-            elif isinstance(updates, Exception):
-                logging.error(
-                    "Unexpected exception. "
-                    f"Waiting {error_cooldown} seconds before trying again..."
+                # Wait while the update queue is full
+                for update in new_updates:
+                    await self.submit_update(update)
+        finally:
+            next_batch.cancel()
+
+    def get_polling_limit(self, limit=100, incoming=0):
+        """Return number of updates to be requested by next `getUpdates`.
+
+        Request no more updates than free slots in the update queue, taking
+            into account `incoming` updates about to be queued (at least one
+            update is requested anyway).
+        """
+        dispatcher = self.update_dispatcher
+        if not dispatcher.queue_size:
+            return limit
+        free_slots = (
+            dispatcher.queue_size - dispatcher.queue_depth - incoming
+        )
+        return max(1, min(limit, free_slots))
+
+    async def fetch_updates(self, timeout, limit, allowed_updates,
+                            incoming=0):
+        """Return a batch of updates from `offset`, recording statistics.
+
+        Return an Exception (or None) if the request failed.
+        """
+        started_at = time.monotonic()
+        updates = await self.getUpdates(
+            offset=self._offset,
+            timeout=timeout,
+            limit=self.get_polling_limit(limit=limit, incoming=incoming),
+            allowed_updates=allowed_updates
+        )
+        self.polling_stats['fetch_latency'].add(time.monotonic() - started_at)
+        if isinstance(updates, list):
+            self.polling_stats['batch_size'].add(len(updates))
+        return updates
+
+    def update_handled(self, update):
+        """Record that `update` has been handled."""
+        if self.update_journal is not None and 'update_id' in update:
+            self.update_journal.done(update['update_id'])
+        receipts = self.update_receipts.get(update.get('update_id'))
+        if receipts:
+            self.update_queue.ack(receipts.popleft())
+            if not receipts:
+                del self.update_receipts[update['update_id']]
+
+    async def submit_update(self, update):
+        """Hand `update` over to the update queue or dispatcher.
+
+        Once stored in a durable update queue, `update` is not replayed from
+            the polling journal any more: the queue takes care of it.
+        """
+        if self.update_queue is None:
+            return await self.update_dispatcher.submit(update)
+        await self.update_queue.put(update, key=self.get_update_key(update))
+        if (
+            self.update_queue.durable
+            and self.update_journal is not None
+            and 'update_id' in update
+        ):
+            self.update_journal.done(update['update_id'])
+
+    async def consume_updates(self, timeout=1.0, error_cooldown=10):
+        """Get updates from update queue and hand them to the dispatcher.
+
+        No more updates are got than free slots in the update dispatcher, so
+            that other consumers may get them.
+        """
+        while True:
+            try:
+                items = await self.update_queue.get(
+                    limit=self.get_polling_limit(),
+                    timeout=timeout
                 )
+            except Exception as e:
+                logging.error(f"Could not get updates from queue: {e}")
                 await asyncio.sleep(error_cooldown)
                 continue
-            for update in updates:
-                asyncio.ensure_future(self.route_update(update))
-            if update is not None:
-                self._offset = update['update_id'] + 1
+            for receipt, update in items:
+                # The same update may be delivered again while in progress
+                self.update_receipts.setdefault(
+                    update.get('update_id'), deque()
+                ).append(receipt)
+                await self.update_dispatcher.submit(update)
+
+    def load_update_checkpoint(self):
+        """Restore long polling offset from database."""
+        with self.db as db:
+            if 'update_checkpoints' not in db.tables:
+                return
+            checkpoint = db['update_checkpoints'].find_one(
+                bot_id=self.telegram_id
+            )
+        if checkpoint is not None:
+            self._offset = checkpoint['offset']
+
+    def save_update_checkpoint(self):
+        """Store long polling offset and forget handled updates.
+
+        The offset is saved first, so that updates deleted from the journal
+            are never sent again by Telegram.
+        """
+        if self.update_journal is None:
+            return
+        with self.db as db:
+            db['update_checkpoints'].upsert(
+                dict(
+                    bot_id=self.telegram_id,
+                    offset=self._offset,
+                    updated_at=datetime.datetime.now()
+                ),
+                ['bot_id']
+            )
+        self.update_journal.flush()
+
+    async def checkpoint_updates(self, interval=None):
+        """Every `interval` seconds, save offset and forget handled updates.
+
+        Saving in batches keeps database writes independent of traffic; if
+            the bot crashes, updates handled since last save are handled again
+            on restart (at-least-once delivery).
+        """
+        if interval is None:
+            interval = self.__class__._offset_checkpoint_interval
+        while 1:
+            await asyncio.sleep(interval)
+            try:
+                self.save_update_checkpoint()
+            except Exception as e:
+                logging.error(f"Could not save update checkpoint: {e}")
 
     async def update_users(self, interval=60):
         """Every `interval` seconds, store news about bot users.
@@ -2683,9 +3148,169 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
                 self.recent_users[telegram_id] = update['from']
         return user_record
 
-    def set_router(self, event, handler):
-        """Set `handler` as router for `event`."""
+    @classmethod
+    def set_class_update_dispatcher(cls, concurrency=None, queue_size=None,
+                                    ordering=False):
+        """Set limits of incoming updates handling.
+
+        At most `concurrency` updates are handled at once and at most
+            `queue_size` updates wait to be handled (0 for no limit).
+        When the queue is full, long polling stops fetching updates and
+            webhook requests are answered once a slot is free.
+        Updates waiting for the previous update of their chat (or user) keep
+            their slot, so a single busy chat may fill the queue.
+        `ordering` may be `chat` (updates from the same chat are handled one
+            at a time, in order), `user` (the same, per user) or None (any
+            update may be handled at any time).
+        Limits apply to bots instantiated after this call; see
+            `bot.update_dispatcher.stats` for queue depth and waiting times.
+        """
+        if concurrency is not None:
+            cls._update_concurrency = concurrency
+        if queue_size is not None:
+            cls._update_queue_size = queue_size
+        if ordering is not False:
+            assert ordering in ('chat', 'user', None), (
+                f"Invalid update ordering `{ordering}`"
+            )
+            cls._update_ordering = ordering
+
+    @classmethod
+    def set_class_update_queue(cls, factory=InProcessUpdateQueue,
+                               ingest=True, consume=True):
+        """Put received updates in a queue, possibly shared among nodes.
+
+        `factory(bot)` returns the `UpdateQueue` of `bot` (see
+            `davtelepot.update_queue`); pass None to hand updates over to the
+            update dispatcher directly (default).
+        Nodes may only `ingest` updates (receiving them via webhook or long
+            polling) or only `consume` them (routing them): e.g. a node polls
+            and several nodes route updates of a shared `SqliteUpdateQueue`.
+        Updates from the same chat are handled in order by any consumer.
+        It applies to bots instantiated after this call.
+        """
+        if factory is InProcessUpdateQueue:
+            def factory(bot):
+                return InProcessUpdateQueue(max_size=cls._update_queue_size)
+        cls._update_queue_factory = factory
+        cls._ingest_updates = ingest
+        cls._consume_updates = consume
+
+    @classmethod
+    def set_class_webhook_reply(cls, deadline=0.1):
+        """Send the first reply to webhook updates within webhook response.
+
+        If handling a webhook update makes an API call within `deadline`
+            seconds, the call is sent in the webhook response body instead of
+            as a separate request: latency and outbound connections are
+            saved, but its result is unknown and the API method returns True.
+        Therefore only calls whose result is not needed are eligible: calls of
+            methods returning True anyway (e.g. `answerCallbackQuery`) and
+            replies made with the return value of handlers (see
+            `webhook_reply.results_ignored`). A handler sending a message
+            itself (`sent = await bot.send_message(...)`) always gets it.
+        Later calls, other calls, file uploads and calls having to wait for
+            flood limits are sent as usual.
+        Pass `deadline=None` to disable (default).
+        """
+        cls._webhook_reply_deadline = deadline
+
+    async def handle_update(self, update):
+        """Route `update`, binding its webhook reply slot, if any."""
+        webhook_reply = self.webhook_replies.pop(update.get('update_id'), None)
+        if webhook_reply is None:
+            return await self.route_update(update)
+        token = set_webhook_reply(webhook_reply)
+        try:
+            return await self.route_update(update)
+        finally:
+            reset_webhook_reply(token)
+            webhook_reply.close()
+
+    @classmethod
+    def set_class_webhook_dedup_window(cls, size):
+        """Set number of recent webhook update ids remembered.
+
+        Updates received again within this window are dropped; memory used is
+            `size` bits per bot. It applies to bots instantiated after this
+            call.
+        """
+        cls._webhook_dedup_window = size
+
+    @classmethod
+    def set_class_offset_checkpoint_interval(cls, interval):
+        """Set seconds between two saves of the long polling offset."""
+        cls._offset_checkpoint_interval = interval
+
+    def get_update_key(self, update):
+        """Return the key of updates to be handled in order with `update`.
+
+        Depending on class `_update_ordering`, it is the identifier of the
+            chat (or user) `update` comes from, falling back to the user (or
+            chat) identifier; None if updates must not be ordered.
+        Private chats have the same identifier as their user, so inline
+            queries and messages from the same user are ordered as well.
+        """
+        ordering = self.__class__._update_ordering
+        if ordering is None:
+            return
+        for value in update.values():
+            if not isinstance(value, dict):
+                continue
+            chat = value.get('chat') or value.get('message', {}).get('chat')
+            user = value.get('from')
+            if ordering == 'user' and user is not None:
+                return user['id']
+            if chat is not None:
+                return chat['id']
+            if user is not None:
+                return user['id']
+
+    def set_router(self, event, handler, user_record=True):
+        """Set `handler` as router for `event`.
+
+        Set `user_record` to False if `handler` does not need the record of
+            the user sending the update: it will get None instead, sparing a
+            database query.
+        """
         self.routing_table[event] = handler
+        if user_record:
+            self.routers_without_user_record.discard(event)
+        else:
+            self.routers_without_user_record.add(event)
+
+    def set_message_handler(self, message_type, handler, user_record=True):
+        """Set `handler` for messages having `message_type` key.
+
+        See `set_router` for `user_record`.
+        """
+        self.message_handlers[message_type] = handler
+        if user_record:
+            self.message_handlers_without_user_record.discard(message_type)
+        else:
+            self.message_handlers_without_user_record.add(message_type)
+
+    def needs_user_record(self, update_type, update):
+        """Return True if handler of `update` needs the user record.
+
+        Placeholder handlers (see `placeholder_handler`) and handlers
+            declared not to need it (see `set_router`) get None instead.
+        """
+        handler = self.routing_table[update_type]
+        if (
+            getattr(handler, 'placeholder', False)
+            or update_type in self.routers_without_user_record
+        ):
+            return False
+        if update_type != 'message' or handler != self.message_router:
+            return True
+        for key in update:
+            if key in self.message_handlers:
+                return not (
+                    getattr(self.message_handlers[key], 'placeholder', False)
+                    or key in self.message_handlers_without_user_record
+                )
+        return False
 
     async def route_update(self, update):
         """Pass `update` to proper method.
@@ -2703,6 +3328,8 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             `shipping_query`
             `pre_checkout_query`
             `poll`
+        The record of the user sending the update is looked up only if its
+            handler needs it (see `needs_user_record`).
         """
         if (
             self.under_maintenance
@@ -2711,7 +3338,11 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             return await self.handle_update_during_maintenance(update)
         for key, value in update.items():
             if key in self.routing_table:
-                user_record = self.get_user_record(update=value)
+                user_record = (
+                    self.get_user_record(update=value)
+                    if self.needs_user_record(update_type=key, update=value)
+                    else None
+                )
                 return await self.routing_table[key](
                     update=value,
                     user_record=user_record
@@ -2753,13 +3384,126 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
 
     @classmethod
     async def stop_app(cls):
-        """Close bot sessions and cleanup."""
+        """Drain in-flight work, close bot sessions and cleanup.
+
+        All bots stop receiving updates, then they are granted the class
+            drain timeout (see `set_class_drain_timeout`) as a whole to
+            handle pending updates and send pending requests.
+        """
+        for bot in cls.bots:
+            bot.stop_intake()
+        deadline = cls.loop.time() + cls._drain_timeout
+        for bot in cls.bots:
+            await bot.drain(timeout=max(0, deadline - cls.loop.time()))
+        if cls.shard_router is not None:
+            await cls.shard_router.stop()
         for bot in cls.bots:
             await asyncio.gather(
                 *bot.final_tasks
             )
             await bot.close_sessions()
-        await cls.runner.cleanup()
+        if cls.runner is not None:
+            await cls.runner.cleanup()
+
+    @classmethod
+    def set_class_drain_timeout(cls, timeout):
+        """Set seconds granted to in-flight work when bots are stopped."""
+        cls._drain_timeout = timeout
+
+    def track_task(self, awaitable, kind='sending'):
+        """Schedule `awaitable` and return its task, awaited on stop.
+
+        Use it for background work which should not be lost on restart, e.g.
+            messages sent without awaiting them. `kind` is `routing` or
+            `sending`.
+        """
+        task = asyncio.ensure_future(awaitable)
+        tasks = self.tracked_tasks[kind]
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+        return task
+
+    def stop_intake(self):
+        """Stop receiving updates.
+
+        Long polling and queue consumption stop; webhook updates are refused
+            with status 503, so that Telegram delivers them again later.
+        """
+        self.accepting_updates = False
+        for task in self.intake_tasks:
+            task.cancel()
+        self.intake_tasks = []
+
+    async def drain(self, timeout=None):
+        """Wait up to `timeout` seconds for in-flight work to be done.
+
+        Pending updates are handled, tracked tasks are awaited and pending
+            requests are sent; whatever is left is dropped by
+            `close_sessions` (polled updates not handled yet are handled
+            again on next start).
+        Return True if nothing was left; see `drain_stats` for details.
+        """
+        loop = asyncio.get_event_loop()
+        started_at = loop.time()
+        deadline = None if timeout is None else started_at + timeout
+
+        def remaining():
+            if deadline is None:
+                return None
+            return max(0, deadline - loop.time())
+        pending_updates = self.update_dispatcher.pending
+        pending_tasks = sum(len(tasks)
+                            for tasks in self.tracked_tasks.values())
+        pending_requests = self.requests_in_flight
+        await self.update_dispatcher.drain(remaining())
+        tasks = set.union(*self.tracked_tasks.values())
+        if tasks:
+            await asyncio.wait(tasks, timeout=remaining())
+        await self.drain_requests(remaining())
+        self.drain_stats = dict(
+            duration=loop.time() - started_at,
+            pending_updates=pending_updates,
+            pending_tasks=pending_tasks,
+            pending_requests=pending_requests,
+            dropped_updates=self.update_dispatcher.pending,
+            dropped_tasks=sum(
+                not task.done()
+                for tasks in self.tracked_tasks.values()
+                for task in tasks
+            ),
+            dropped_requests=self.requests_in_flight,
+        )
+        drained = not any(
+            self.drain_stats[key]
+            for key in ('dropped_updates', 'dropped_tasks', 'dropped_requests')
+        )
+        if drained:
+            logging.info(f"Bot @{self.name} drained in "
+                         f"{self.drain_stats['duration']:.2f} seconds")
+        else:
+            logging.warning(f"Bot @{self.name} could not drain in time: "
+                            f"{self.drain_stats}")
+        return drained
+
+    @classmethod
+    def start_workers(cls, workers):
+        """Fork `workers` processes handling updates of all bots."""
+        if cls._webhook_reply_deadline is not None:
+            logging.warning("Webhook replies are disabled with workers")
+            cls._webhook_reply_deadline = None
+        cls.shard_router = ShardRouter(
+            bots=cls.bots,
+            workers=workers,
+            queue_size=cls._update_queue_size,
+            on_stop=cls.stop
+        )
+        cls.shard_router.start()
+        for bot_index, bot in enumerate(cls.bots):
+            bot.update_dispatcher = ShardedDispatcher(
+                router=cls.shard_router,
+                bot_index=bot_index,
+                get_key=bot.get_update_key
+            )
 
     @classmethod
     def stop(cls, message, final_state=0):
@@ -2768,20 +3512,32 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
         All bots and the web app will be terminated gracefully.
         The final state may be retrieved to get information about what stopped
             the bots.
+        In worker processes (see `run`), the request is forwarded to the front
+            process, which stops bots and workers.
         """
         logging.info(message)
         cls.final_state = final_state
+        if cls.shard_worker is not None:
+            cls.shard_worker.request_stop(message=message,
+                                          final_state=final_state)
+            return
         cls.loop.stop()
         return
 
     @classmethod
-    def run(cls, local_host=None, port=None):
+    def run(cls, local_host=None, port=None, workers=0):
         """Run aiohttp web app and all Bot instances.
 
         Each bot will receive updates via long polling or webhook according to
             its initialization parameters.
         A single aiohttp.web.Application instance will be run (cls.app) on
             local_host:port and it may serve custom-defined routes as well.
+        If `workers` > 0, updates are handled by as many worker processes,
+            forked after preliminary tasks and partitioned by chat (see
+            `davtelepot.sharding`): this process only receives updates.
+            Handlers must not rely on state shared among chats in memory;
+            database access is process-safe (SQLite databases use WAL).
+            See `Bot.shard_router.health` for workers health.
         """
         if local_host is not None:
             cls.local_host = local_host
@@ -2799,6 +3555,8 @@ class Bot(TelegramBot, ObjectWithDatabase, MultiLanguageObject):
             )
         except Exception as e:
             logging.error(f"{e}", exc_info=True)
+        if workers > 0:
+            cls.start_workers(workers)
         for bot in cls.bots:
             bot.setup()
         asyncio.ensure_future(cls.start_app())
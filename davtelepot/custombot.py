@@ -27,7 +27,6 @@ Check requirements.txt for third party dependencies.
 import asyncio
 from collections import OrderedDict
 import datetime
-import inspect
 import logging
 import os
 
@@ -36,7 +35,7 @@ import davtelepot.bot
 
 # Project modules
 from .utilities import (
-    get_secure_key, extract, sleep_until
+    get_secure_key, extract, make_argument_injector, sleep_until
 )
 
 
@@ -78,9 +77,11 @@ class Bot(davtelepot.bot.Bot):
             database_url=db_name,
             **kwargs
         )
-        self.message_handlers['pinned_message'] = self.handle_pinned_message
-        self.message_handlers['photo'] = self.handle_photo_message
-        self.message_handlers['location'] = self.handle_location
+        self.set_message_handler('pinned_message', self.handle_pinned_message,
+                                 user_record=False)
+        self.set_message_handler('photo', self.handle_photo_message,
+                                 user_record=False)
+        self.set_message_handler('location', self.handle_location)
         self.custom_photo_parsers = dict()
         self.custom_location_parsers = dict()
         self.to_be_obscured = []
@@ -131,18 +132,14 @@ class Bot(davtelepot.bot.Bot):
         It should take update and role and return a Boolean.
         Default authorization_function always evaluates True.
         """
+        inject_arguments = make_argument_injector(authorization_function)
+
         def _authorization_function(update, authorization_level,
                                     user_record=None):
             privileges = authorization_level  # noqa: W0612, this variable
             #                                   is used by locals()
             return authorization_function(
-                **{
-                    name: argument
-                    for name, argument in locals().items()
-                    if name in inspect.signature(
-                        authorization_function
-                    ).parameters
-                }
+                **inject_arguments(locals())
             )
         self.authorization_function = _authorization_function
 
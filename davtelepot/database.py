@@ -40,6 +40,22 @@ class ObjectWithDatabase(object):
             self._database = None
             logging.error(f"{e}")
 
+    def reconnect_database(self):
+        """Open a new connection, e.g. in a forked child process.
+
+        Connections inherited from the parent process are detached without
+            being closed, since closing them would affect the parent.
+        SQLite databases are opened in WAL mode, so that several processes
+            may read while one writes.
+        """
+        if self._database is not None:
+            self._database.engine.dispose(close=False)
+        try:
+            self._database = dataset.connect(self.db_url)
+        except Exception as e:
+            self._database = None
+            logging.error(f"{e}")
+
     @property
     def db_url(self):
         """Return complete path to database."""
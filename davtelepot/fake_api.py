@@ -0,0 +1,353 @@
+"""Local stand-in for Telegram bot API servers, for tests and benchmarks.
+
+Usage
+    ```
+    from davtelepot.bot import Bot
+    from davtelepot.fake_api import FakeTelegramServer
+
+    server = FakeTelegramServer(latency=0.01)
+    api_url = await server.start()  # e.g. http://127.0.0.1:45678
+    Bot.set_class_api_url(api_url)
+    server.push_update(token, dict(message=...))  # Served by getUpdates
+    ```
+Requests are answered like Telegram would: `send*` methods echo message
+    objects, `edit*` methods return edited messages, getters return plausible
+    objects and any other method returns True.
+Latency, flood control errors (429 with `retry_after`, 420 `FLOOD_WAIT_X`)
+    and timeouts may be injected, either at random (`*_rate` parameters) or
+    deterministically (`fail_next`).
+The server may also be run as a script:
+    `python -m davtelepot.fake_api --port 8081 --latency 0.02`
+"""
+
+# Standard library modules
+import argparse
+import asyncio
+import collections
+import random
+import time
+
+# Third party modules
+from aiohttp import web
+
+# Project modules
+from .json_codec import codec
+
+
+class FakeTelegramServer(object):
+    """aiohttp application mimicking Telegram bot API.
+
+    Any token is accepted; each token has its own queue of updates.
+    Counters of received requests by method are kept in `requests`.
+    """
+
+    file_content = b'davtelepot fake file content'
+
+    def __init__(self, latency=0.0, too_many_requests_rate=0.0,
+                 flood_wait_rate=0.0, timeout_rate=0.0, retry_after=1,
+                 flood_wait=5, timeout_delay=120, seed=None):
+        """Set latency (seconds) and error injection parameters.
+
+        `too_many_requests_rate`, `flood_wait_rate` and `timeout_rate` are
+            probabilities (0 to 1) that a request fails with error 429 (with
+            `retry_after` parameter), with error 420 (`FLOOD_WAIT_X`, with
+            X = `flood_wait`) or is kept hanging for `timeout_delay` seconds.
+        `seed` makes random failures reproducible.
+        """
+        self.latency = latency
+        self.too_many_requests_rate = too_many_requests_rate
+        self.flood_wait_rate = flood_wait_rate
+        self.timeout_rate = timeout_rate
+        self.retry_after = retry_after
+        self.flood_wait = flood_wait
+        self.timeout_delay = timeout_delay
+        self._random = random.Random(seed)
+        self._failures = collections.deque()  # (method, kind, value)
+        self._updates = collections.defaultdict(collections.deque)
+        self._new_updates = collections.defaultdict(asyncio.Event)
+        self._last_update_id = 0
+        self._last_message_id = collections.defaultdict(int)
+        self.requests = collections.Counter()
+        self.runner = None
+        self.url = None
+        self.app = web.Application()
+        self.app.router.add_route(
+            '*', '/bot{token}/{method}', self.method_handler
+        )
+        self.app.router.add_route(
+            'GET', '/file/bot{token}/{file_path:.*}', self.file_handler
+        )
+
+    async def start(self, host='127.0.0.1', port=0):
+        """Start serving on `host`:`port` and return the base URL.
+
+        Pass `port=0` to pick a free port.
+        """
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://{host}:{port}"
+        return self.url
+
+    async def stop(self):
+        """Stop serving."""
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    def push_update(self, token, update):
+        """Queue `update` for bot `token` and return its `update_id`.
+
+        If `update` already has an `update_id`, it is kept.
+        """
+        if 'update_id' not in update:
+            self._last_update_id += 1
+            update = dict(update, update_id=self._last_update_id)
+        else:
+            self._last_update_id = max(self._last_update_id,
+                                       update['update_id'])
+        self._updates[token].append(update)
+        self._new_updates[token].set()
+        return update['update_id']
+
+    def pending_updates(self, token):
+        """Return number of updates not confirmed yet by bot `token`."""
+        return len(self._updates[token])
+
+    def fail_next(self, method=None, error_code=429, retry_after=None,
+                  flood_wait=None, timeout=False):
+        """Make next request to `method` (any method if None) fail.
+
+        Fail with `error_code` 429 (`retry_after`), 420 (`flood_wait`) or
+            any other code, or keep the request hanging if `timeout`.
+        """
+        if timeout:
+            self._failures.append((method, 'timeout', None))
+        elif error_code == 420:
+            self._failures.append(
+                (method, 420, flood_wait or self.flood_wait)
+            )
+        else:
+            self._failures.append(
+                (method, error_code, retry_after or self.retry_after)
+            )
+
+    @staticmethod
+    async def get_parameters(request):
+        """Return request parameters, whatever the content type."""
+        if request.method != 'POST' or not request.can_read_body:
+            return dict(request.query)
+        if request.content_type == 'application/json':
+            return codec.loads(await request.read())
+        parameters = dict()
+        for key, value in (await request.post()).items():
+            if isinstance(value, str):
+                try:
+                    value = codec.loads(value)
+                except ValueError:
+                    pass
+            parameters[key] = value
+        return parameters
+
+    def get_failure(self, method):
+        """Return injected failure for `method`, if any, as (kind, value)."""
+        for failure in self._failures:
+            if failure[0] in (None, method):
+                self._failures.remove(failure)
+                return failure[1:]
+        draw = self._random.random()
+        if draw < self.too_many_requests_rate:
+            return 429, self.retry_after
+        draw -= self.too_many_requests_rate
+        if draw < self.flood_wait_rate:
+            return 420, self.flood_wait
+        draw -= self.flood_wait_rate
+        if draw < self.timeout_rate:
+            return 'timeout', None
+        return None, None
+
+    @staticmethod
+    def error_response(error_code, value=None):
+        """Return an error json response like Telegram's."""
+        response = dict(ok=False, error_code=error_code)
+        if error_code == 429:
+            response['description'] = (
+                f"Too Many Requests: retry after {value}"
+            )
+            response['parameters'] = dict(retry_after=value)
+        elif error_code == 420:
+            response['description'] = f"FLOOD_WAIT_{value}"
+        else:
+            response['description'] = (
+                f"Bad Request: {value or 'injected error'}"
+            )
+        return web.Response(body=codec.dumps_bytes(response),
+                            status=error_code,
+                            content_type='application/json')
+
+    async def method_handler(self, request):
+        """Answer API method calls."""
+        token = request.match_info['token']
+        method = request.match_info['method']
+        self.requests[method] += 1
+        parameters = await self.get_parameters(request)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        kind, value = self.get_failure(method)
+        if kind == 'timeout':
+            await asyncio.sleep(self.timeout_delay)
+        elif kind is not None:
+            return self.error_response(kind, value)
+        if not isinstance(parameters.get('reply_markup', dict()), dict):
+            return self.error_response(
+                400, "can't parse reply keyboard markup JSON object"
+            )
+        if method == 'getUpdates':
+            result = await self.get_updates(token, **parameters)
+        else:
+            result = self.get_result(token, method, parameters)
+        return web.Response(body=codec.dumps_bytes(dict(ok=True,
+                                                        result=result)),
+                            content_type='application/json')
+
+    async def file_handler(self, request):
+        """Serve fake file content."""
+        self.requests['file'] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return web.Response(body=self.file_content,
+                            content_type='application/octet-stream')
+
+    async def get_updates(self, token, offset=0, limit=100, timeout=0,
+                          **kwargs):
+        """Return updates from `offset`, waiting up to `timeout` seconds.
+
+        Updates having id lower than `offset` are confirmed and forgotten.
+        """
+        updates = self._updates[token]
+        offset, limit, timeout = int(offset or 0), int(limit or 100), \
+            float(timeout or 0)
+        while updates and updates[0]['update_id'] < offset:
+            updates.popleft()
+        if not updates and timeout > 0:
+            event = self._new_updates[token]
+            event.clear()
+            try:
+                await asyncio.wait_for(event.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        return [
+            update
+            for _, update in zip(range(limit), updates)
+        ]
+
+    def make_user(self, token):
+        """Return the User object of bot `token`."""
+        bot_id = int(token.split(':')[0]) if token[:1].isdigit() else 1
+        return dict(id=bot_id, is_bot=True, first_name="Fake bot",
+                    username=f"fake_bot_{bot_id}")
+
+    @staticmethod
+    def make_chat(chat_id):
+        """Return a Chat object for `chat_id`."""
+        try:
+            chat_id = int(chat_id)
+        except (TypeError, ValueError):
+            return dict(id=-1, type='channel', username=str(chat_id))
+        if chat_id > 0:
+            return dict(id=chat_id, type='private', first_name="User")
+        return dict(id=chat_id, type='supergroup', title="Group")
+
+    def make_message(self, token, chat_id, parameters):
+        """Return the Message object sent with `parameters` in `chat_id`."""
+        chat = self.make_chat(chat_id)
+        self._last_message_id[chat['id']] += 1
+        message = dict(
+            message_id=self._last_message_id[chat['id']],
+            date=int(time.time()),
+            chat=chat,
+        )
+        message['from'] = self.make_user(token)
+        for key, value in parameters.items():
+            if key in ('text', 'caption'):
+                message[key] = value
+            elif key in ('photo', 'audio', 'document', 'video', 'animation',
+                         'voice', 'video_note', 'sticker'):
+                file = dict(file_id=f"fake_{key}_{message['message_id']}",
+                            file_size=len(self.file_content))
+                message[key] = [file] if key == 'photo' else file
+            elif key in ('latitude', 'longitude'):
+                message.setdefault('location', dict())[key] = value
+            elif key == 'reply_markup' and isinstance(value, dict):
+                if 'inline_keyboard' in value:
+                    message[key] = value
+        return message
+
+    def get_result(self, token, method, parameters):
+        """Return the result of API `method` called with `parameters`."""
+        chat_id = parameters.get('chat_id')
+        if method == 'getMe':
+            return self.make_user(token)
+        if method == 'getWebhookInfo':
+            return dict(url='', has_custom_certificate=False,
+                        pending_update_count=self.pending_updates(token))
+        if method == 'getFile':
+            file_id = parameters.get('file_id', 'file')
+            return dict(file_id=file_id, file_size=len(self.file_content),
+                        file_path=f"documents/{file_id}")
+        if method == 'getChat':
+            return self.make_chat(chat_id)
+        if method == 'getChatMember':
+            user = dict(id=int(parameters.get('user_id', 0)), is_bot=False,
+                        first_name="User")
+            return dict(user=user, status='member')
+        if method == 'getChatAdministrators':
+            return [dict(user=self.make_user(token), status='administrator')]
+        if method == 'getChatMembersCount':
+            return 2
+        if method == 'sendMediaGroup':
+            return [
+                self.make_message(token, chat_id, dict(photo=medium))
+                for medium in parameters.get('media', [])
+            ]
+        if method.startswith(('send', 'forward')) and chat_id is not None:
+            return self.make_message(token, chat_id, parameters)
+        if method.startswith(('edit', 'stopMessageLiveLocation')):
+            if 'inline_message_id' in parameters:
+                return True
+            message = self.make_message(token, chat_id, parameters)
+            message['message_id'] = int(parameters.get('message_id', 0))
+            message['edit_date'] = message['date']
+            return message
+        if method == 'stopPoll':
+            return dict(id='1', question="", options=[], is_closed=True)
+        return True
+
+
+async def _main(host, port, **kwargs):
+    """Run server until interrupted."""
+    server = FakeTelegramServer(**kwargs)
+    url = await server.start(host=host, port=port)
+    print(f"Fake Telegram bot API running at {url}")
+    try:
+        while True:
+            await asyncio.sleep(3600)
+    finally:
+        await server.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8081)
+    parser.add_argument('--latency', type=float, default=0.0)
+    parser.add_argument('--too-many-requests-rate', type=float, default=0.0)
+    parser.add_argument('--flood-wait-rate', type=float, default=0.0)
+    parser.add_argument('--timeout-rate', type=float, default=0.0)
+    arguments = vars(parser.parse_args())
+    try:
+        asyncio.get_event_loop().run_until_complete(_main(**arguments))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,573 @@
+"""Schedule outbound API requests within Telegram flood limits.
+
+Exact limits are unknown, but less than 30 total messages per second, less
+    than 1 message per chat per second and less than 20 group chat messages
+    per chat per minute should be safe.
+Waiters compute the exact moment their slot opens and sleep until then:
+    nothing is polled.
+"""
+
+# Standard library modules
+import asyncio
+import collections
+import contextlib
+import contextvars
+import heapq
+import itertools
+import logging
+import time
+
+# Project modules
+from .utilities import ExpiringDict
+
+
+class TokenBucket(object):
+    """Token bucket releasing `rate` tokens per second.
+
+    Implemented as a generic cell rate algorithm: instead of refilling tokens,
+        the bucket stores the theoretical arrival time of the next request.
+    Up to `capacity` tokens may be consumed in a burst.
+    """
+
+    def __init__(self, rate, capacity=1, clock=time.monotonic):
+        """Set rate (tokens per second) and capacity of the bucket."""
+        assert rate > 0, "Rate must be positive"
+        assert capacity >= 1, "Capacity must be at least 1"
+        self._clock = clock
+        self._interval = 1 / rate
+        self._tolerance = (capacity - 1) * self._interval
+        self._theoretical_arrival_time = 0.0
+
+    @property
+    def interval(self):
+        """Seconds between two tokens."""
+        return self._interval
+
+    def reserve(self, now=None):
+        """Reserve the next token and return seconds to wait before using it.
+
+        Reservations are served in order: concurrent callers get consecutive
+            slots.
+        """
+        if now is None:
+            now = self._clock()
+        arrival_time = max(self._theoretical_arrival_time, now)
+        self._theoretical_arrival_time = arrival_time + self._interval
+        return max(0.0, arrival_time - self._tolerance - now)
+
+    def try_reserve(self, now=None):
+        """Consume a token and return True if one is available right now."""
+        if now is None:
+            now = self._clock()
+        if self._theoretical_arrival_time - self._tolerance > now:
+            return False
+        self.reserve(now)
+        return True
+
+    async def acquire(self):
+        """Await until a token is available and consume it."""
+        delay = self.reserve()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class ChatSendHistory(object):
+    """Monotonic timestamps of recent requests in a chat.
+
+    `sent` is a deque holding at most as many timestamps as needed to enforce
+        the chat limits. `lock` serializes requests in the same chat.
+    """
+
+    __slots__ = ('lock', 'sent')
+
+    def __init__(self, size):
+        """Keep track of the last `size` requests."""
+        self.lock = asyncio.Lock()
+        self.sent = collections.deque(maxlen=size)
+
+    @property
+    def last_sent(self):
+        """Return time of last request, or None if none was made."""
+        if self.sent:
+            return self.sent[-1]
+
+
+class RateLimiter(object):
+    """Global token bucket and per-chat buckets.
+
+    Private chats (positive integer `chat_id`) may receive a message every
+        `private_chat_cooldown` seconds.
+    Groups, supergroups and channels may receive a message every
+        `group_chat_cooldown` seconds and no more than
+        `group_messages_per_window` messages per `group_window` seconds.
+    Chat histories are forgotten once the longest cooldown has elapsed since
+        their last request, so memory is bounded by the number of chats
+        active in that period (and by `max_chats`, if set).
+    """
+
+    def __init__(self, messages_per_second=30, burst=1,
+                 private_chat_cooldown=1, group_chat_cooldown=1,
+                 group_messages_per_window=20, group_window=60,
+                 max_chats=None, clock=time.monotonic):
+        """Set limits (all durations are expressed in seconds)."""
+        self._clock = clock
+        self.bucket = TokenBucket(rate=messages_per_second, capacity=burst,
+                                  clock=clock)
+        self.private_chat_cooldown = private_chat_cooldown
+        self.group_chat_cooldown = group_chat_cooldown
+        self.group_messages_per_window = group_messages_per_window
+        self.group_window = group_window
+        self.chats = ExpiringDict(
+            ttl=max(private_chat_cooldown, group_chat_cooldown, group_window),
+            max_size=max_chats,
+            # Never forget chats having requests in progress
+            keep=lambda chat_id, history: history.lock.locked(),
+            clock=clock
+        )
+
+    @staticmethod
+    def is_private_chat(chat_id):
+        """Return True if `chat_id` identifies a private chat."""
+        return type(chat_id) is int and chat_id > 0
+
+    def get_history(self, chat_id):
+        """Return the ChatSendHistory of `chat_id`, creating it if missing."""
+        history = self.chats.get(chat_id)
+        if history is None:
+            history = ChatSendHistory(
+                size=(
+                    1 if self.is_private_chat(chat_id)
+                    else self.group_messages_per_window
+                )
+            )
+            self.chats[chat_id] = history
+        return history
+
+    def get_delay(self, chat_id):
+        """Return seconds to wait before a request in `chat_id` is allowed.
+
+        The global bucket is not taken into account.
+        """
+        history = self.chats.get(chat_id)
+        if history is None:
+            return 0.0
+        return self.get_chat_delay(chat_id, history)
+
+    def get_chat_delay(self, chat_id, history, now=None):
+        """Return seconds to wait before next request in `chat_id`."""
+        last_sent = history.last_sent
+        if last_sent is None:
+            return 0.0
+        if now is None:
+            now = self._clock()
+        if self.is_private_chat(chat_id):
+            ready_at = last_sent + self.private_chat_cooldown
+        else:
+            ready_at = last_sent + self.group_chat_cooldown
+            if len(history.sent) == history.sent.maxlen:
+                ready_at = max(ready_at, history.sent[0] + self.group_window)
+        return max(0.0, ready_at - now)
+
+    async def acquire(self, chat_id=None):
+        """Await until a request may be sent to `chat_id`.
+
+        If `chat_id` is None, only the global bucket is taken into account.
+        """
+        if chat_id is None:
+            return await self.bucket.acquire()
+        history = self.get_history(chat_id)
+        async with history.lock:
+            delay = self.get_chat_delay(chat_id, history)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self.bucket.acquire()
+            self.record(chat_id, history)
+
+    def try_acquire(self, chat_id=None):
+        """Take a slot and return True if a request may be sent right now.
+
+        Return False, taking nothing, if it should wait instead.
+        """
+        if chat_id is None:
+            return self.bucket.try_reserve()
+        history = self.get_history(chat_id)
+        if (
+            history.lock.locked()
+            or self.get_chat_delay(chat_id, history) > 0
+            or not self.bucket.try_reserve()
+        ):
+            return False
+        self.record(chat_id, history)
+        return True
+
+    def record(self, chat_id, history=None):
+        """Store that a request was just sent to `chat_id`."""
+        if history is None:
+            history = self.get_history(chat_id)
+        history.sent.append(self._clock())
+        self.chats[chat_id] = history  # Touch it
+
+
+class FloodGate(object):
+    """Pause requests while Telegram flood control is active.
+
+    Telegram may ask to wait a given number of seconds before next requests,
+        either globally (error 420, `FLOOD_WAIT_X`) or in a specific chat
+        (error 429, `retry_after` parameter).
+    Requests arriving during a pause are queued and released in order, all
+        at once, exactly when the pause ends.
+    Counters keep track of how long the gate was closed and how long requests
+        were delayed (see `stats`).
+    """
+
+    def __init__(self, clock=time.monotonic):
+        """Open the gate."""
+        self._clock = clock
+        self._paused_until = dict()  # None (global) or chat_id -> time
+        self._queues = dict()  # None (global) or chat_id -> deque of futures
+        self._timers = dict()  # None (global) or chat_id -> TimerHandle
+        self.global_throttled_time = 0.0
+        self.chat_throttled_time = 0.0
+        self.pauses = 0
+        self.delayed_requests = 0
+        self.delay_time = 0.0
+
+    @property
+    def stats(self):
+        """Return a dict of counters about flood control."""
+        return dict(
+            global_throttled_time=self.global_throttled_time,
+            chat_throttled_time=self.chat_throttled_time,
+            pauses=self.pauses,
+            delayed_requests=self.delayed_requests,
+            delay_time=self.delay_time,
+            queued_requests=sum(len(queue) for queue in self._queues.values()),
+        )
+
+    def get_delay(self, chat_id=None):
+        """Return seconds to wait before sending a request to `chat_id`.
+
+        Global pauses apply to all chats.
+        """
+        now = self._clock()
+        delay = self._paused_until.get(None, now) - now
+        if chat_id is not None:
+            delay = max(delay, self._paused_until.get(chat_id, now) - now)
+        return max(0.0, delay)
+
+    def pause(self, seconds, chat_id=None):
+        """Close the gate for `seconds` (for `chat_id` only, if given).
+
+        Pauses may be extended but never shortened.
+        """
+        now = self._clock()
+        until = now + seconds
+        previous_until = max(self._paused_until.get(chat_id, now), now)
+        if until <= previous_until:
+            return
+        self._paused_until[chat_id] = until
+        self.pauses += 1
+        if chat_id is None:
+            self.global_throttled_time += until - previous_until
+        else:
+            self.chat_throttled_time += until - previous_until
+        if chat_id in self._timers:
+            self._timers[chat_id].cancel()
+            self._schedule_release(chat_id)
+
+    def _schedule_release(self, key):
+        """Call `_release` when the pause on `key` ends."""
+        delay = max(0.0, self._paused_until.get(key, 0.0) - self._clock())
+        self._timers[key] = asyncio.get_event_loop().call_later(
+            delay, self._release, key
+        )
+
+    def _release(self, key):
+        """Wake up requests queued on `key`, in order, if pause ended."""
+        del self._timers[key]
+        if self._paused_until.get(key, 0.0) > self._clock():
+            # Pause was extended in the meantime
+            return self._schedule_release(key)
+        self._paused_until.pop(key, None)
+        for future in self._queues.pop(key, ()):
+            if not future.done():
+                future.set_result(None)
+
+    async def wait(self, chat_id=None):
+        """Await until the gate is open for `chat_id`.
+
+        While the gate is closed, queue requests and release them in order.
+        """
+        start = None
+        while True:
+            now = self._clock()
+            global_until = self._paused_until.get(None, now)
+            chat_until = (
+                self._paused_until.get(chat_id, now)
+                if chat_id is not None
+                else now
+            )
+            if max(global_until, chat_until) <= now:
+                if (
+                    chat_id in self._paused_until
+                    and chat_id not in self._timers
+                ):
+                    del self._paused_until[chat_id]  # Forget past pauses
+                break
+            if start is None:
+                start = now
+                self.delayed_requests += 1
+            key = None if global_until > now else chat_id
+            future = asyncio.get_event_loop().create_future()
+            self._queues.setdefault(key, collections.deque()).append(future)
+            if key not in self._timers:
+                self._schedule_release(key)
+            await future
+        if start is not None:
+            self.delay_time += self._clock() - start
+
+
+OUTBOUND_PRIORITIES = ('interactive', 'edits', 'bulk')
+_outbound_priority = contextvars.ContextVar('outbound_priority', default=None)
+
+
+def get_outbound_priority():
+    """Return priority set by `outbound_priority` in current context."""
+    return _outbound_priority.get()
+
+
+@contextlib.contextmanager
+def outbound_priority(priority):
+    """Set `priority` of outbound requests made within a `with` block.
+
+    Tasks created within the block inherit the priority as well.
+    """
+    assert priority in OUTBOUND_PRIORITIES, f"Invalid priority {priority}"
+    token = _outbound_priority.set(priority)
+    try:
+        yield
+    finally:
+        _outbound_priority.reset(token)
+
+
+class OutboundDispatcher(object):
+    """Run outbound requests through workers, by priority and chat.
+
+    Requests are queued by priority class (see `OUTBOUND_PRIORITIES`) and, in
+        each class, by chat: chats take turns (round-robin), so that a chat
+        with many pending requests does not delay other chats.
+    Workers only pick requests to chats which are ready, according to
+        `get_delay(chat_id)`, and only one request per chat at a time.
+    Chats waiting for their delay to elapse are kept in a heap, by time
+        they will be ready: picking a request does not scan all chats.
+    """
+
+    def __init__(self, workers=8, get_delay=None):
+        """Set number of workers and delay function (seconds, by chat_id)."""
+        assert workers > 0, "At least one worker is needed"
+        self._workers_number = workers
+        self._get_delay = get_delay or (lambda chat_id: 0.0)
+        # By priority: chat_id -> deque of jobs, chats to be tried in turn,
+        #   heap of (ready time, sequence number, chat_id) and chats either
+        #   to be tried or in the heap
+        self._jobs = [dict() for _ in OUTBOUND_PRIORITIES]
+        self._ready = [collections.deque() for _ in OUTBOUND_PRIORITIES]
+        self._delayed = [[] for _ in OUTBOUND_PRIORITIES]
+        self._scheduled = [set() for _ in OUTBOUND_PRIORITIES]
+        self._sequence = itertools.count()
+        self._busy_chats = set()
+        self._workers = []
+        self._new_job = None
+        self._idle = None  # Set when no request is pending (see `drain`)
+        self.submitted = collections.Counter()
+        self.completed = collections.Counter()
+        self.waiting_time = collections.Counter()
+
+    @property
+    def queue_depth(self):
+        """Return number of pending requests, by priority."""
+        return {
+            priority: sum(len(jobs) for jobs in chats_jobs.values())
+            for priority, chats_jobs in zip(OUTBOUND_PRIORITIES, self._jobs)
+        }
+
+    @property
+    def pending(self):
+        """Return number of requests queued or being sent."""
+        # Only one request per chat is sent at a time
+        return sum(self.queue_depth.values()) + len(self._busy_chats)
+
+    @property
+    def stats(self):
+        """Return counters about dispatched requests, by priority."""
+        return dict(
+            queue_depth=self.queue_depth,
+            submitted=dict(self.submitted),
+            completed=dict(self.completed),
+            waiting_time=dict(self.waiting_time),
+        )
+
+    def start(self):
+        """Start workers, if they are not running yet."""
+        self._workers = [
+            worker for worker in self._workers
+            if not worker.done()
+        ]
+        if self._new_job is None:
+            self._new_job = asyncio.Event()
+        while len(self._workers) < self._workers_number:
+            self._workers.append(asyncio.ensure_future(self._work()))
+
+    async def drain(self, timeout=None):
+        """Wait up to `timeout` seconds for pending requests to be sent.
+
+        Return True if no request is pending.
+        """
+        if self.pending == 0:
+            return True
+        if self._idle is None:
+            self._idle = asyncio.Event()
+        self._idle.clear()
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.pending == 0
+
+    async def stop(self):
+        """Cancel workers and pending requests (they are not sent).
+
+        Futures of pending requests are cancelled, so that nobody keeps
+            awaiting them.
+        """
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        for chats_jobs in self._jobs:
+            for jobs in chats_jobs.values():
+                for job in jobs:
+                    job[0].cancel()
+            chats_jobs.clear()
+        for structure in self._ready + self._delayed + self._scheduled:
+            structure.clear()
+        if self._idle is not None:
+            self._idle.set()
+
+    def submit(self, function, *args, chat_id=None, priority='interactive',
+               **kwargs):
+        """Queue `function(*args, **kwargs)` and return a future for result.
+
+        `priority` defaults to the one set by `outbound_priority` context
+            manager, if any.
+        """
+        priority = get_outbound_priority() or priority
+        self.start()
+        future = asyncio.get_event_loop().create_future()
+        index = OUTBOUND_PRIORITIES.index(priority)
+        chats_jobs = self._jobs[index]
+        if chat_id not in chats_jobs:
+            chats_jobs[chat_id] = collections.deque()
+        chats_jobs[chat_id].append(
+            (future, function, args, kwargs, priority, time.monotonic())
+        )
+        self._schedule(index, chat_id)
+        self.submitted[priority] += 1
+        self._new_job.set()
+        return future
+
+    def _schedule(self, index, chat_id):
+        """Let `chat_id` take its turn in priority class `index`.
+
+        Busy chats are scheduled again when their request is done.
+        """
+        if (
+            chat_id in self._busy_chats
+            or chat_id in self._scheduled[index]
+        ):
+            return
+        self._scheduled[index].add(chat_id)
+        self._ready[index].append(chat_id)
+
+    def _pick(self):
+        """Return (chat_id, job) to be run next, and min delay otherwise.
+
+        Return a tuple (chat_id, job, delay), where `job` is None if no chat
+            is ready and `delay` is the time before one will be (None if there
+            is no pending request).
+        Cancelled requests are discarded.
+        """
+        now = time.monotonic()
+        min_delay = None
+        for chats_jobs, ready, delayed, scheduled in zip(
+            self._jobs, self._ready, self._delayed, self._scheduled
+        ):
+            while delayed and delayed[0][0] <= now:
+                ready.append(heapq.heappop(delayed)[2])
+            while ready:
+                chat_id = ready.popleft()
+                jobs = chats_jobs.get(chat_id)
+                while jobs and jobs[0][0].cancelled():
+                    jobs.popleft()
+                if not jobs:
+                    chats_jobs.pop(chat_id, None)
+                    scheduled.discard(chat_id)
+                    continue
+                if chat_id in self._busy_chats:
+                    scheduled.discard(chat_id)
+                    continue
+                delay = self._get_delay(chat_id)
+                if delay > 0:
+                    heapq.heappush(
+                        delayed, (now + delay, next(self._sequence), chat_id)
+                    )
+                    continue
+                scheduled.discard(chat_id)
+                job = jobs.popleft()
+                if not jobs:
+                    del chats_jobs[chat_id]
+                return chat_id, job, None
+            if delayed:
+                delay = delayed[0][0] - now
+                if min_delay is None or delay < min_delay:
+                    min_delay = delay
+        return None, None, min_delay
+
+    async def _work(self):
+        """Run pending requests forever."""
+        while True:
+            chat_id, job, delay = self._pick()
+            if job is None:
+                if self._idle is not None and self.pending == 0:
+                    self._idle.set()
+                self._new_job.clear()
+                try:
+                    await asyncio.wait_for(self._new_job.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            future, function, args, kwargs, priority, submitted_at = job
+            self.waiting_time[priority] += time.monotonic() - submitted_at
+            self._busy_chats.add(chat_id)
+            try:
+                result = await function(*args, **kwargs)
+                if not future.done():
+                    future.set_result(result)
+            except asyncio.CancelledError:
+                if not future.done():
+                    future.cancel()
+                raise
+            except Exception as e:
+                logging.error(f"{e}", exc_info=True)
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self._busy_chats.discard(chat_id)
+                # Let the chat take its turn again, where it has requests
+                for index, chats_jobs in enumerate(self._jobs):
+                    if chat_id in chats_jobs:
+                        self._schedule(index, chat_id)
+                self.completed[priority] += 1
+                self._new_job.set()  # A chat became available again
+                if self._idle is not None and self.pending == 0:
+                    self._idle.set()
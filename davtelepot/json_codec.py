@@ -0,0 +1,91 @@
+"""Pluggable JSON codec for API requests, responses and webhook updates.
+
+If installed, an accelerated library is used (`orjson`, otherwise `ujson`);
+    the standard library `json` module is the fallback.
+Any library providing compatible `dumps` and `loads` functions may be plugged
+    in:
+    ```
+    import orjson
+    from davtelepot.json_codec import set_json_codec
+
+    set_json_codec(
+        name='orjson',
+        dumps=lambda obj: orjson.dumps(obj).decode(),
+        loads=orjson.loads
+    )
+    ```
+"""
+
+# Standard library modules
+import json
+
+
+class JsonCodec(object):
+    """Named pair of `dumps` and `loads` functions.
+
+    `dumps(obj)` must return a compact str; `loads(str_or_bytes)` must return
+        python objects and raise ValueError on invalid input.
+    """
+
+    def __init__(self, name, dumps, loads, dumps_bytes=None):
+        """Set codec name and functions.
+
+        `dumps_bytes(obj)`, if given, must return UTF-8 encoded bytes.
+        """
+        self.name = name
+        self.dumps = dumps
+        self.loads = loads
+        self._dumps_bytes = dumps_bytes
+
+    def dumps_bytes(self, obj):
+        """Return `obj` serialized as UTF-8 encoded bytes."""
+        if self._dumps_bytes is not None:
+            return self._dumps_bytes(obj)
+        return self.dumps(obj).encode('utf-8')
+
+
+def _stdlib_dumps(obj):
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False)
+
+
+def get_default_codec():
+    """Return a JsonCodec using the fastest installed library."""
+    try:
+        import orjson
+
+        def orjson_dumps_bytes(obj):
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+        def orjson_dumps(obj):
+            return orjson_dumps_bytes(obj).decode()
+        return JsonCodec(name='orjson', dumps=orjson_dumps,
+                         loads=orjson.loads, dumps_bytes=orjson_dumps_bytes)
+    except ImportError:
+        pass
+    try:
+        import ujson
+
+        def ujson_dumps(obj):
+            return ujson.dumps(obj, ensure_ascii=False,
+                               escape_forward_slashes=False)
+        return JsonCodec(name='ujson', dumps=ujson_dumps, loads=ujson.loads)
+    except ImportError:
+        pass
+    return JsonCodec(name='json', dumps=_stdlib_dumps, loads=json.loads)
+
+
+codec = get_default_codec()
+
+
+def set_json_codec(name, dumps=None, loads=None, dumps_bytes=None):
+    """Plug in a JSON library.
+
+    Missing functions fall back to the standard library.
+    Call `set_json_codec('json')` to use the standard library only.
+    The same `codec` object is updated, so modules holding a reference to it
+        use the new functions as well.
+    """
+    codec.name = name
+    codec.dumps = dumps or _stdlib_dumps
+    codec.loads = loads or json.loads
+    codec._dumps_bytes = dumps_bytes
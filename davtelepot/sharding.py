@@ -0,0 +1,640 @@
+"""Handle updates in several worker processes, partitioned by chat.
+
+All bots share one event loop, so a CPU-heavy handler delays every update.
+With `Bot.run(workers=N)`, the front process keeps receiving updates (via
+    webhook or long polling) and forwards them, encoded as bytes, to N worker
+    processes forked from it; each worker handles updates with its own event
+    loop, HTTP sessions and database connection.
+Updates are partitioned by `Bot.get_update_key` (chat or user identifier):
+    updates from the same chat are always handled by the same worker, in
+    order, so that state kept in memory by handlers stays consistent.
+Workers confirm handled updates and report their health to the front process;
+    a worker exiting unexpectedly is restarted and receives again the updates
+    it had not confirmed yet.
+`Bot.stop` called by a handler in a worker (e.g. by the admin restart command)
+    is forwarded to the front process, which stops all bots and workers.
+Workers are not forked by the front process, whose event loop may be running
+    when a worker is restarted, but by a supervisor process forked before
+    (see `WorkerSupervisor`).
+"""
+
+# Standard library modules
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import multiprocessing.reduction
+import os
+import signal
+import socket
+import struct
+import time
+import zlib
+
+# Project modules
+from .api import TelegramBot
+from .json_codec import codec
+from .update_dispatcher import UpdateDispatcher
+
+# Frame header: kind, bot index, sequence number, payload length
+FRAME_HEADER = struct.Struct('!BHII')
+UPDATE_FRAME, DONE_FRAME, HEALTH_FRAME, STOP_FRAME = 1, 2, 3, 4
+# Supervisor requests (command, argument) and replies (done, value)
+CONTROL_REQUEST = struct.Struct('!Bi')
+CONTROL_REPLY = struct.Struct('!?i')
+SPAWN_COMMAND, STATUS_COMMAND = 1, 2
+
+
+def write_frame(writer, kind, bot_index=0, sequence=0, payload=b''):
+    """Write a frame to `writer` (an asyncio.StreamWriter)."""
+    writer.write(
+        FRAME_HEADER.pack(kind, bot_index, sequence, len(payload)) + payload
+    )
+
+
+async def read_frame(reader):
+    """Return next (kind, bot index, sequence, payload) from `reader`.
+
+    Return None when the other end has been closed.
+    """
+    try:
+        header = await reader.readexactly(FRAME_HEADER.size)
+        kind, bot_index, sequence, length = FRAME_HEADER.unpack(header)
+        payload = await reader.readexactly(length) if length else b''
+    except (asyncio.IncompleteReadError, ConnectionError):
+        return
+    return kind, bot_index, sequence, payload
+
+
+def receive_exactly(sock, size):
+    """Return `size` bytes read from blocking `sock`, or None on EOF."""
+    data = b''
+    while len(data) < size:
+        chunk = sock.recv(size - len(data))
+        if not chunk:
+            return
+        data += chunk
+    return data
+
+
+class WorkerSupervisor(object):
+    """Process forking worker processes on behalf of the front process.
+
+    It is forked once, before the front process event loop runs, and never
+        runs a loop itself: workers forked from it start from bots as they
+        were set up, without running loops, tasks or open sessions, even when
+        they are restarted while the front process is serving updates.
+    """
+
+    def __init__(self, run_worker, context):
+        """Set worker entry point and multiprocessing context.
+
+        `run_worker(index, worker_socket)` is called in worker processes.
+        """
+        self.run_worker = run_worker
+        self._context = context
+        self.process = None
+        self.socket = None  # Front process end of the control socket
+
+    def start(self):
+        """Fork supervisor process."""
+        front_socket, supervisor_socket = socket.socketpair()
+        self.process = self._context.Process(
+            target=self._serve,
+            args=(supervisor_socket, front_socket),
+            name="davtelepot-supervisor",
+            daemon=True
+        )
+        self.process.start()
+        supervisor_socket.close()
+        self.socket = front_socket
+
+    def _request(self, command, argument, fds=()):
+        """Send a request to supervisor and return its reply."""
+        self.socket.sendall(CONTROL_REQUEST.pack(command, argument))
+        if fds:
+            multiprocessing.reduction.sendfds(self.socket, fds)
+        reply = receive_exactly(self.socket, CONTROL_REPLY.size)
+        if reply is None:
+            raise ConnectionError("Worker supervisor exited")
+        return CONTROL_REPLY.unpack(reply)
+
+    def spawn(self, index, worker_socket):
+        """Fork worker `index`, connected to front process via socket."""
+        _, pid = self._request(SPAWN_COMMAND, index,
+                               fds=[worker_socket.fileno()])
+        return WorkerProcess(self, pid)
+
+    def get_exit_code(self, pid):
+        """Return exit code of worker `pid`, or None if it is running."""
+        exited, exit_code = self._request(STATUS_COMMAND, pid)
+        return exit_code if exited else None
+
+    def stop(self, timeout=5):
+        """Close control socket and wait for supervisor to exit."""
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+        if self.process is not None:
+            self.process.join(timeout)
+
+    def _serve(self, control, front_socket):
+        """Fork workers on request until front process closes socket."""
+        # Front process decides when to stop, on KeyboardInterrupt as well
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        front_socket.close()
+        exit_codes = dict()
+        while True:
+            request = receive_exactly(control, CONTROL_REQUEST.size)
+            if request is None:
+                break
+            command, argument = CONTROL_REQUEST.unpack(request)
+            if command == SPAWN_COMMAND:
+                worker_socket = socket.socket(
+                    fileno=multiprocessing.reduction.recvfds(control, 1)[0]
+                )
+                pid = os.fork()
+                if pid == 0:
+                    control.close()
+                    exit_code = 0
+                    try:
+                        self.run_worker(argument, worker_socket)
+                    except BaseException as e:
+                        logging.error(f"{e}", exc_info=True)
+                        exit_code = 1
+                    finally:
+                        os._exit(exit_code)
+                worker_socket.close()
+                exit_codes[pid] = None
+                reply = (True, pid)
+            else:
+                if exit_codes.get(argument) is None:
+                    exit_codes[argument] = self._wait(argument)
+                exit_code = exit_codes[argument]
+                reply = (exit_code is not None, exit_code or 0)
+            control.sendall(CONTROL_REPLY.pack(*reply))
+        for pid, exit_code in exit_codes.items():
+            if exit_code is None:
+                self._wait(pid, block=True)
+
+    @staticmethod
+    def _wait(pid, block=False):
+        """Reap child `pid` and return its exit code, None if running.
+
+        As with `multiprocessing.Process.exitcode`, a negative exit code
+            is the signal which terminated the process.
+        """
+        try:
+            waited, status = os.waitpid(pid, 0 if block else os.WNOHANG)
+        except ChildProcessError:
+            return -1
+        if waited == 0:
+            return
+        if os.WIFSIGNALED(status):
+            return -os.WTERMSIG(status)
+        return os.WEXITSTATUS(status)
+
+
+class WorkerProcess(object):
+    """Front process handle of a worker forked by `WorkerSupervisor`.
+
+    It provides the part of `multiprocessing.Process` interface used by
+        `ShardRouter`.
+    """
+
+    def __init__(self, supervisor, pid):
+        """Set supervisor and process identifier."""
+        self.supervisor = supervisor
+        self.pid = pid
+        self._exit_code = None
+
+    @property
+    def exitcode(self):
+        """Return exit code, or None if process is running."""
+        if self._exit_code is None and self.supervisor.socket is not None:
+            self._exit_code = self.supervisor.get_exit_code(self.pid)
+        return self._exit_code
+
+    def is_alive(self):
+        """Return True if process is running."""
+        return self.exitcode is None
+
+    def join(self, timeout=None):
+        """Wait up to `timeout` seconds (forever if None) for process."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.is_alive() and (
+            deadline is None or time.monotonic() < deadline
+        ):
+            time.sleep(0.01)
+
+    def terminate(self):
+        """Send SIGTERM to process."""
+        try:
+            os.kill(self.pid, signal.SIGTERM)
+        except ProcessLookupError:
+            pass
+
+
+class Shard(object):
+    """Front process end of a worker process."""
+
+    def __init__(self, index, queue_size):
+        """Set shard index and maximum number of updates sent to worker."""
+        self.index = index
+        self.process = None
+        self.socket = None  # Front process end of the socket pair
+        self.writer = None
+        self.listener = None
+        # sequence -> (bot index, encoded update), in order
+        self.in_flight = dict()
+        self.slots = asyncio.Semaphore(queue_size) if queue_size else None
+        self.health = dict()
+        self.last_seen = None
+        self.restarts = 0
+
+    @property
+    def is_alive(self):
+        """Return True if worker process is running."""
+        return self.process is not None and self.process.is_alive()
+
+
+class ShardRouter(object):
+    """Fork worker processes and forward them updates of `bots`.
+
+    Workers are forked (through a `WorkerSupervisor`) after bots have been set
+        up in front process: they inherit bots, with their commands, handlers
+        and settings.
+    """
+
+    def __init__(self, bots, workers=2, queue_size=1000,
+                 heartbeat_interval=5, on_stop=None):
+        """Set bots, number of workers and limits.
+
+        At most `queue_size` updates per worker are sent and not confirmed
+            yet (0 for no limit); workers report their health every
+            `heartbeat_interval` seconds.
+        `on_stop(message, final_state)` is called in front process when a
+            worker asks to stop all bots (see `ShardWorker.request_stop`).
+        """
+        assert workers > 0, "At least one worker is needed"
+        self.bots = list(bots)
+        self.queue_size = queue_size
+        self.heartbeat_interval = heartbeat_interval
+        self.on_stop = on_stop
+        self.shards = [Shard(index, queue_size) for index in range(workers)]
+        self._sequence = itertools.count(1)
+        self._round_robin = itertools.cycle(self.shards)
+        self.supervisor = WorkerSupervisor(
+            run_worker=self._run_worker,
+            context=multiprocessing.get_context('fork')
+        )
+        self._inherited_loop = None  # Set in worker processes
+        self.running = False
+        self.submitted = 0
+        self.handled = 0
+
+    @property
+    def health(self):
+        """Return workers health and totals, as reported by workers."""
+        now = time.monotonic()
+        workers = [
+            dict(
+                index=shard.index,
+                pid=(shard.process.pid if shard.process else None),
+                alive=shard.is_alive,
+                restarts=shard.restarts,
+                in_flight=len(shard.in_flight),
+                last_seen=(
+                    now - shard.last_seen
+                    if shard.last_seen is not None else None
+                ),
+                **shard.health
+            )
+            for shard in self.shards
+        ]
+        return dict(
+            workers=workers,
+            alive=sum(worker['alive'] for worker in workers),
+            in_flight=sum(worker['in_flight'] for worker in workers),
+            submitted=self.submitted,
+            handled=self.handled,
+        )
+
+    def start(self):
+        """Fork supervisor and workers.
+
+        It must be called before the event loop runs, so that the supervisor
+            does not inherit a running loop.
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            raise RuntimeError("Workers must be started before the event "
+                               "loop runs")
+        self.supervisor.start()
+        self.running = True
+        for shard in self.shards:
+            self._spawn(shard)
+
+    def _spawn(self, shard):
+        """Have supervisor fork a worker process for `shard`."""
+        front_socket, worker_socket = socket.socketpair()
+        shard.socket = front_socket
+        shard.process = self.supervisor.spawn(shard.index, worker_socket)
+        worker_socket.close()
+        shard.writer = None
+        shard.listener = asyncio.ensure_future(self._listen(shard))
+
+    def _run_worker(self, index, worker_socket):
+        """Run worker process `index` until front process closes socket.
+
+        It is called in a process forked by the supervisor, which ignores
+            SIGINT and has no running loop.
+        The inherited loop is kept referenced: it shares its selector and
+            self-pipe with the front process one, so closing it (as its
+            garbage collection would) stops wakeups of the front process.
+        """
+        self._inherited_loop = TelegramBot.loop
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        TelegramBot.loop = loop
+        for bot in self.bots:
+            bot.reconnect_database()
+            bot.reset_after_fork(processes=len(self.shards))
+        worker = ShardWorker(self.bots, worker_socket,
+                             heartbeat_interval=self.heartbeat_interval)
+        # `Bot.stop` forwards stop requests to front process
+        for bot in self.bots:
+            bot.__class__.shard_worker = worker
+        try:
+            loop.run_until_complete(worker.run())
+        except Exception as e:
+            logging.error(f"{e}", exc_info=True)
+        finally:
+            logging.info(f"Worker {index} (pid {os.getpid()}) stopped")
+
+    async def _listen(self, shard):
+        """Read confirmations and health reports of `shard` worker."""
+        reader, shard.writer = await asyncio.open_connection(
+            sock=shard.socket
+        )
+        # Updates not confirmed by a previous worker are sent again
+        for sequence, (bot_index, payload) in shard.in_flight.items():
+            write_frame(shard.writer, UPDATE_FRAME, bot_index, sequence,
+                        payload)
+        while True:
+            frame = await read_frame(reader)
+            if frame is None:
+                break
+            kind, bot_index, sequence, payload = frame
+            shard.last_seen = time.monotonic()
+            if kind == DONE_FRAME:
+                self._confirm(shard, sequence)
+            elif kind == HEALTH_FRAME:
+                shard.health = codec.loads(payload)
+            elif kind == STOP_FRAME and self.on_stop is not None:
+                self.on_stop(**codec.loads(payload))
+        shard.writer.close()
+        shard.writer = None
+        if self.running:
+            shard.process.join(0)
+            logging.error(
+                f"Worker {shard.index} exited "
+                f"(exit code {shard.process.exitcode}): restarting it, "
+                f"{len(shard.in_flight)} updates will be handled again"
+            )
+            shard.restarts += 1
+            self._spawn(shard)
+
+    def _confirm(self, shard, sequence):
+        """Forget update `sequence` and tell its bot it has been handled."""
+        item = shard.in_flight.pop(sequence, None)
+        if item is None:
+            return
+        self.handled += 1
+        if shard.slots is not None:
+            shard.slots.release()
+        bot_index, payload = item
+        self.bots[bot_index].update_handled(codec.loads(payload))
+
+    def get_shard(self, key):
+        """Return the shard handling updates having `key`.
+
+        Keys are hashed with CRC-32 of their representation, which (unlike
+            `hash` of strings) does not change across processes.
+        """
+        if key is None:
+            return next(self._round_robin)
+        return self.shards[
+            zlib.crc32(repr(key).encode()) % len(self.shards)
+        ]
+
+    async def submit(self, bot_index, update, key=None):
+        """Send `update` of bot `bot_index` to the worker handling `key`.
+
+        Wait if that worker has too many updates not confirmed yet.
+        """
+        shard = self.get_shard(key)
+        if shard.slots is not None:
+            await shard.slots.acquire()
+        sequence = next(self._sequence) & 0xFFFFFFFF
+        payload = codec.dumps_bytes(update)
+        shard.in_flight[sequence] = (bot_index, payload)
+        self.submitted += 1
+        # If worker is restarting, the update is sent once it is back
+        if shard.writer is not None:
+            write_frame(shard.writer, UPDATE_FRAME, bot_index, sequence,
+                        payload)
+            try:
+                await shard.writer.drain()
+            except ConnectionError:
+                # Worker exited meanwhile: its restart will get the update
+                pass
+
+    async def stop(self, timeout=10):
+        """Close sockets and wait up to `timeout` seconds for workers."""
+        self.running = False
+        for shard in self.shards:
+            if shard.writer is not None:
+                shard.writer.close()
+        await asyncio.gather(
+            *[shard.listener for shard in self.shards
+              if shard.listener is not None],
+            return_exceptions=True
+        )
+        deadline = time.monotonic() + timeout
+        for shard in self.shards:
+            if shard.process is None:
+                continue
+            await self._join(shard.process, deadline - time.monotonic())
+            if shard.process.is_alive():
+                logging.error(f"Worker {shard.index} did not stop: "
+                              f"terminating it")
+                shard.process.terminate()
+                shard.process.join()
+        self.supervisor.stop(timeout=max(0, deadline - time.monotonic()))
+
+    @staticmethod
+    async def _join(process, timeout):
+        """Wait up to `timeout` seconds for `process` to exit."""
+        while process.is_alive() and timeout > 0:
+            await asyncio.sleep(0.05)
+            timeout -= 0.05
+
+
+class ShardedDispatcher(object):
+    """Stand-in for `Bot.update_dispatcher`, forwarding updates to workers.
+
+    It exposes the same interface used by update receivers (`submit`,
+        `drain`, `stop`, `queue_size`, `queue_depth`, `pending` and
+        `stats`).
+    """
+
+    def __init__(self, router, bot_index, get_key=None):
+        """Set router, index of the bot among router bots and key getter."""
+        self.router = router
+        self.bot_index = bot_index
+        self._get_key = get_key or (lambda update: None)
+        self.queue_size = router.queue_size * len(router.shards)
+
+    @property
+    def queue_depth(self):
+        """Return number of updates sent to workers and not confirmed yet."""
+        return sum(
+            1
+            for shard in self.router.shards
+            for bot_index, _ in shard.in_flight.values()
+            if bot_index == self.bot_index
+        )
+
+    @property
+    def pending(self):
+        """Return number of updates sent to workers and not confirmed yet."""
+        return self.queue_depth
+
+    @property
+    def stats(self):
+        """Return workers health."""
+        return self.router.health
+
+    async def drain(self, timeout=None):
+        """Wait up to `timeout` seconds for workers to confirm updates.
+
+        Return True if no update is pending.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while self.pending and (
+            deadline is None or time.monotonic() < deadline
+        ):
+            await asyncio.sleep(0.05)
+        return self.pending == 0
+
+    async def submit(self, update):
+        """Forward `update` to its worker."""
+        await self.router.submit(self.bot_index, update,
+                                 key=self._get_key(update))
+
+    async def stop(self):
+        """Do nothing: workers are stopped by the router."""
+        return
+
+
+class ShardWorker(object):
+    """Worker process side: handle updates received from front process."""
+
+    def __init__(self, bots, worker_socket, heartbeat_interval=5):
+        """Set bots, socket connected to front process and heartbeat."""
+        self.bots = bots
+        self.socket = worker_socket
+        self.heartbeat_interval = heartbeat_interval
+        self.writer = None
+        self.dispatchers = [
+            UpdateDispatcher(
+                handler=self.make_handler(bot),
+                concurrency=bot.__class__._update_concurrency,
+                queue_size=0,  # Bounded by front process
+                get_key=self.make_key_getter(bot),
+                on_done=self.make_confirmer(bot_index)
+            )
+            for bot_index, bot in enumerate(bots)
+        ]
+
+    @staticmethod
+    def make_handler(bot):
+        """Return a handler of (sequence, update) items for `bot`."""
+        async def handler(item):
+            return await bot.handle_update(item[1])
+        return handler
+
+    @staticmethod
+    def make_key_getter(bot):
+        """Return a key getter of (sequence, update) items for `bot`."""
+        def get_key(item):
+            return bot.get_update_key(item[1])
+        return get_key
+
+    def make_confirmer(self, bot_index):
+        """Return a function confirming handled items of `bot_index`."""
+        def confirm(item):
+            if self.writer is not None and not self.writer.is_closing():
+                write_frame(self.writer, DONE_FRAME, bot_index, item[0])
+        return confirm
+
+    def request_stop(self, message, final_state=0):
+        """Ask front process to stop all bots with `final_state`.
+
+        The worker goes on handling updates until front process closes the
+            socket.
+        """
+        if self.writer is not None and not self.writer.is_closing():
+            write_frame(
+                self.writer, STOP_FRAME,
+                payload=codec.dumps_bytes(
+                    dict(message=message, final_state=final_state)
+                )
+            )
+
+    async def send_health(self):
+        """Report dispatcher counters to front process forever."""
+        while True:
+            handled = sum(d.handled for d in self.dispatchers)
+            errors = sum(d.errors for d in self.dispatchers)
+            queue_depth = sum(d.queue_depth for d in self.dispatchers)
+            write_frame(
+                self.writer, HEALTH_FRAME,
+                payload=codec.dumps_bytes(
+                    dict(handled_by_worker=handled, errors=errors,
+                         queue_depth=queue_depth,
+                         cpu_time=time.process_time())
+                )
+            )
+            await asyncio.sleep(self.heartbeat_interval)
+
+    async def run(self):
+        """Handle updates until front process closes the socket."""
+        reader, self.writer = await asyncio.open_connection(sock=self.socket)
+        tasks = [asyncio.ensure_future(self.send_health())] + [
+            asyncio.ensure_future(bot.update_users())
+            for bot in self.bots
+        ]
+        try:
+            while True:
+                frame = await read_frame(reader)
+                if frame is None:
+                    break
+                kind, bot_index, sequence, payload = frame
+                if kind != UPDATE_FRAME:
+                    continue
+                await self.dispatchers[bot_index].submit(
+                    (sequence, codec.loads(payload))
+                )
+        finally:
+            for task in tasks:
+                task.cancel()
+            for dispatcher in self.dispatchers:
+                await dispatcher.stop()
+            for bot in self.bots:
+                await bot.close_sessions()
+            self.writer.close()
@@ -0,0 +1,210 @@
+"""Dispatch incoming updates to a bounded number of handler tasks.
+
+Updates are queued and handled by at most `concurrency` tasks at once.
+When the queue is full, `submit` waits: long polling stops fetching new
+    updates and webhook requests are answered later, so that Telegram slows
+    down instead of the bot spawning unbounded tasks.
+Updates sharing the same key (e.g. the same chat) are handled one at a time,
+    in the order they were submitted, while updates with different keys are
+    handled in parallel.
+Updates waiting for their key keep their queue slot: a key whose updates are
+    slow to handle may fill the queue, and `submit` then waits for every key.
+    Queue slots are not split by key because long polling submits updates
+    one at a time anyway; `queue_size` should rather be large compared with
+    the backlog a single chat may build up.
+"""
+
+# Standard library modules
+import asyncio
+import collections
+import logging
+import time
+
+
+class UpdateDispatcher(object):
+    """Bounded queue of updates consumed by a pool of workers.
+
+    A worker picking an update whose key is being handled by another worker
+        hands it over to that worker and picks another update; keys are
+        forgotten as soon as they have no pending update, so memory is bounded
+        by the number of updates in progress.
+    """
+
+    def __init__(self, handler, concurrency=100, queue_size=1000,
+                 get_key=None, on_done=None):
+        """Set update `handler` coroutine function and limits.
+
+        At most `concurrency` updates are handled at once and at most
+            `queue_size` updates wait to be handled (0 for no limit).
+        `get_key(update)` returns the key of updates to be handled in order
+            (None if `update` may be handled at any time).
+        `on_done(update)` is called once `update` has been handled, even if
+            its handler failed.
+        """
+        assert concurrency > 0, "At least one worker is needed"
+        self._handler = handler
+        self._get_key = get_key or (lambda update: None)
+        self._on_done = on_done
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self._queue = None
+        self._slots = None
+        self._idle = None  # Set when no update is pending (see `drain`)
+        self._workers = []
+        self._blocked_submitters = 0
+        # key -> deque of updates waiting for the update being handled
+        self._keys = dict()
+        self.submitted = 0
+        self.started = 0
+        self.handled = 0
+        self.errors = 0
+        self.dropped = 0  # Updates queued or in progress when stopped
+        self.max_queue_depth = 0
+        self.waiting_time = 0.0  # Seconds spent by updates in queue
+        self.blocked_time = 0.0  # Seconds spent by `submit` on a full queue
+
+    @property
+    def queue_depth(self):
+        """Return number of updates waiting to be handled."""
+        return self.submitted - self.started
+
+    @property
+    def pending(self):
+        """Return number of updates queued or being handled."""
+        return self.submitted - self.handled - self.dropped
+
+    @property
+    def active_keys(self):
+        """Return number of keys having updates in progress."""
+        return len(self._keys)
+
+    @property
+    def stats(self):
+        """Return counters about dispatched updates."""
+        return dict(
+            queue_depth=self.queue_depth,
+            max_queue_depth=self.max_queue_depth,
+            active_keys=self.active_keys,
+            submitted=self.submitted,
+            handled=self.handled,
+            errors=self.errors,
+            dropped=self.dropped,
+            average_waiting_time=(
+                self.waiting_time / self.started if self.started else 0.0
+            ),
+            blocked_time=self.blocked_time,
+        )
+
+    def start(self):
+        """Start workers, if they are not running yet."""
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+            if self.queue_size:
+                self._slots = asyncio.Semaphore(self.queue_size)
+        self._workers = [
+            worker for worker in self._workers
+            if not worker.done()
+        ]
+        while len(self._workers) < self.concurrency:
+            self._workers.append(asyncio.ensure_future(self._work()))
+
+    async def drain(self, timeout=None):
+        """Wait up to `timeout` seconds for pending updates to be handled.
+
+        Return True if no update is pending.
+        """
+        if self.pending == 0:
+            return True
+        if self._idle is None:
+            self._idle = asyncio.Event()
+        self._idle.clear()
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.pending == 0
+
+    async def stop(self):
+        """Cancel workers (queued updates are not handled).
+
+        Updates in progress are cancelled and counted as dropped, like queued
+            ones; `submit` calls waiting for a free slot raise
+            `asyncio.CancelledError`.
+        """
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        self._keys.clear()
+        self.dropped += self.queue_depth
+        self.started = self.submitted
+        slots = self._slots
+        self._queue, self._slots = None, None
+        if slots is not None:
+            for _ in range(self._blocked_submitters):
+                slots.release()
+        if self._idle is not None:
+            self._idle.set()
+
+    async def submit(self, update):
+        """Queue `update`, waiting for a free slot if queue is full."""
+        self.start()
+        slots = self._slots
+        if slots is not None:
+            if slots.locked():
+                blocked_since = time.monotonic()
+                self._blocked_submitters += 1
+                try:
+                    await slots.acquire()
+                finally:
+                    self._blocked_submitters -= 1
+                self.blocked_time += time.monotonic() - blocked_since
+            else:
+                await slots.acquire()
+            if slots is not self._slots:
+                # Workers were stopped meanwhile: `update` is not queued
+                raise asyncio.CancelledError
+        self._queue.put_nowait((update, time.monotonic()))
+        self.submitted += 1
+        self.max_queue_depth = max(self.max_queue_depth, self.queue_depth)
+
+    async def _handle(self, update, submitted_at):
+        """Handle `update`, freeing its queue slot."""
+        self.started += 1
+        self.waiting_time += time.monotonic() - submitted_at
+        if self._slots is not None:
+            self._slots.release()
+        try:
+            await self._handler(update)
+        except asyncio.CancelledError:
+            # Workers are being stopped: `update` is not handled
+            self.dropped += 1
+            raise
+        except Exception as e:
+            self.errors += 1
+            logging.error(f"{e}", exc_info=True)
+        self.handled += 1
+        if self._on_done is not None:
+            self._on_done(update)
+        if self._idle is not None and self.pending == 0:
+            self._idle.set()
+
+    async def _work(self):
+        """Handle queued updates forever."""
+        while True:
+            update, submitted_at = await self._queue.get()
+            key = self._get_key(update)
+            if key is None:
+                await self._handle(update, submitted_at)
+                continue
+            if key in self._keys:
+                # Another worker is handling this key: let it go on in order
+                self._keys[key].append((update, submitted_at))
+                continue
+            pending = self._keys[key] = collections.deque()
+            try:
+                await self._handle(update, submitted_at)
+                while pending:
+                    await self._handle(*pending.popleft())
+            finally:
+                self._keys.pop(key, None)
@@ -0,0 +1,290 @@
+"""Queues of updates between ingestion and routing, possibly shared by nodes.
+
+A bot receiving updates (via webhook or long polling) puts them in an
+    `UpdateQueue`; one or more consumers (in the same process, in other local
+    processes or on other hosts) get them, route them and acknowledge them.
+Each update has a partition key (`Bot.get_update_key`, i.e. its chat):
+    an update is not delivered while an older update with the same key is
+    being handled, so updates from the same chat are handled in order even
+    if several consumers share the queue.
+Delivery is at-least-once: updates not acknowledged in time (e.g. because
+    their consumer crashed) are delivered again.
+
+Implementations:
+    - `InProcessUpdateQueue`: in memory, for a single process;
+    - `SqliteUpdateQueue`: SQLite file shared by processes on the same host.
+A networked broker may be plugged in by implementing `UpdateQueue`.
+"""
+
+# Standard library modules
+import abc
+import asyncio
+import collections
+import concurrent.futures
+import logging
+import sqlite3
+import time
+
+# Project modules
+from .json_codec import codec
+
+
+class UpdateQueue(abc.ABC):
+    """Interface of update queues.
+
+    Receipts returned by `get` are opaque: they are only passed back to
+        `ack`.
+    Queues are `durable` if updates put survive the process putting them.
+    """
+
+    durable = False
+
+    @abc.abstractmethod
+    async def put(self, update, key=None):
+        """Append `update` having partition `key` (None: no ordering)."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    async def get(self, limit=100, timeout=1.0):
+        """Return up to `limit` (receipt, update) pairs.
+
+        Wait up to `timeout` seconds for at least one update; return an empty
+            list if none is available.
+        At most one update per partition key is returned and no update with
+            the same key is delivered until it is acknowledged.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def ack(self, receipt):
+        """Acknowledge that the update of `receipt` has been handled.
+
+        It must not block: implementations may buffer acknowledgements.
+        """
+        raise NotImplementedError
+
+    async def close(self):
+        """Flush pending acknowledgements and release resources."""
+        return
+
+
+class InProcessUpdateQueue(UpdateQueue):
+    """In-memory queue, consumed in the same process."""
+
+    def __init__(self, max_size=0):
+        """Set maximum number of queued updates (0 for no limit).
+
+        When the queue is full, `put` waits.
+        """
+        # Partition keys (or (None, update) pairs) ready to be delivered
+        self._ready = collections.deque()
+        # key -> updates waiting, the first one being in progress when the
+        #   key is not ready
+        self._partitions = dict()
+        self._new_updates = asyncio.Event()
+        self._slots = asyncio.Semaphore(max_size) if max_size else None
+        self.size = 0
+
+    async def put(self, update, key=None):
+        """Append `update` having partition `key`."""
+        if self._slots is not None:
+            await self._slots.acquire()
+        self.size += 1
+        if key is None:
+            self._ready.append((None, update))
+        elif key in self._partitions:
+            self._partitions[key].append(update)
+        else:
+            self._partitions[key] = collections.deque([update])
+            self._ready.append((key, None))
+        self._new_updates.set()
+
+    async def get(self, limit=100, timeout=1.0):
+        """Return up to `limit` (receipt, update) pairs."""
+        if not self._ready:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                return []
+        items = []
+        while self._ready and len(items) < limit:
+            key, update = self._ready.popleft()
+            if key is not None:
+                update = self._partitions[key][0]
+            items.append((key, update))
+        return items
+
+    def ack(self, receipt):
+        """Make next update with the same partition key available."""
+        self.size -= 1
+        if self._slots is not None:
+            self._slots.release()
+        key = receipt
+        if key is None:
+            return
+        updates = self._partitions[key]
+        updates.popleft()
+        if updates:
+            self._ready.append((key, None))
+            self._new_updates.set()
+        else:
+            del self._partitions[key]
+
+
+class SqliteUpdateQueue(UpdateQueue):
+    """Queue stored in a SQLite file, shared by local processes.
+
+    Processes claim updates within a write transaction, so that each update
+        is delivered to one consumer at a time; claims expire after `lease`
+        seconds, after which unacknowledged updates are delivered again.
+    The database is opened in WAL mode; the standard library `sqlite3`
+        module is used since claiming requires `BEGIN IMMEDIATE`
+        transactions.
+    Database calls may wait for locks held by other processes: they run in a
+        dedicated thread owning the connection, not in the event loop.
+    """
+
+    durable = True
+
+    def __init__(self, path, queue_name='updates', lease=60,
+                 poll_interval=0.1, ack_batch_size=100):
+        """Set database file `path` and name of the queue within it.
+
+        Consumers poll the database every `poll_interval` seconds while it is
+            empty; acknowledgements are written in batches of
+            `ack_batch_size` (and before claiming updates).
+        """
+        self.path = path
+        self.queue_name = queue_name
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self.ack_batch_size = ack_batch_size
+        self._acks = []
+        self.connection = None
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix='update_queue'
+        )
+        self._executor.submit(self._connect).result()
+
+    def _connect(self):
+        """Open database connection (in queue thread)."""
+        self.connection = sqlite3.connect(self.path, timeout=30,
+                                          isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        # In WAL mode, a power loss may lose last commits but not corrupt data
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS update_queue ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "queue TEXT NOT NULL, "
+            "partition_key TEXT, "
+            "body TEXT NOT NULL, "
+            "claimed_until REAL)"
+        )
+        self.connection.execute(
+            "CREATE INDEX IF NOT EXISTS update_queue_partition "
+            "ON update_queue (queue, partition_key, id)"
+        )
+
+    async def _run(self, function, *args):
+        """Run `function(*args)` in queue thread and return its result."""
+        return await asyncio.get_running_loop().run_in_executor(
+            self._executor, function, *args
+        )
+
+    async def put(self, update, key=None):
+        """Append `update` having partition `key`."""
+        await self._run(
+            self.connection.execute,
+            "INSERT INTO update_queue (queue, partition_key, body) "
+            "VALUES (?, ?, ?)",
+            (self.queue_name, None if key is None else str(key),
+             codec.dumps(update))
+        )
+
+    def _select_available(self, now, limit):
+        """Return (id, body) of up to `limit` updates available at `now`."""
+        # Oldest update of each partition, unless it is in progress
+        return self.connection.execute(
+            "SELECT id, body FROM update_queue AS q "
+            "WHERE queue = :queue "
+            "AND (claimed_until IS NULL OR claimed_until < :now) "
+            "AND (partition_key IS NULL OR id = ("
+            "    SELECT MIN(id) FROM update_queue "
+            "    WHERE queue = :queue "
+            "    AND partition_key = q.partition_key)) "
+            "ORDER BY id LIMIT :limit",
+            dict(queue=self.queue_name, now=now, limit=limit)
+        ).fetchall()
+
+    def _claim(self, limit):
+        """Claim up to `limit` available updates (in queue thread)."""
+        now = time.time()
+        connection = self.connection
+        # Idle consumers only read: no write lock unless there is work
+        if not self._select_available(now, 1):
+            return []
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            # Other consumers may have claimed updates meanwhile
+            rows = self._select_available(now, limit)
+            connection.executemany(
+                "UPDATE update_queue SET claimed_until = ? WHERE id = ?",
+                [(now + self.lease, row_id) for row_id, _ in rows]
+            )
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        return [(row_id, codec.loads(body)) for row_id, body in rows]
+
+    async def claim(self, limit):
+        """Claim up to `limit` available updates and return them."""
+        return await self._run(self._claim, limit)
+
+    async def get(self, limit=100, timeout=1.0):
+        """Return up to `limit` (receipt, update) pairs."""
+        deadline = time.monotonic() + timeout
+        while True:
+            # Updates handled meanwhile make their partitions available
+            await self.flush()
+            items = await self.claim(limit)
+            if items or time.monotonic() >= deadline:
+                return items
+            await asyncio.sleep(self.poll_interval)
+
+    def ack(self, receipt):
+        """Buffer acknowledgement of update `receipt`."""
+        self._acks.append(receipt)
+        if len(self._acks) >= self.ack_batch_size:
+            acks, self._acks = self._acks, []
+            self._executor.submit(self._delete, acks)
+
+    def _delete(self, acks):
+        """Delete acknowledged updates (in queue thread)."""
+        try:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.executemany(
+                "DELETE FROM update_queue WHERE id = ?",
+                [(row_id,) for row_id in acks]
+            )
+            self.connection.execute("COMMIT")
+        except Exception as e:
+            # Updates not deleted are delivered again when their lease expires
+            logging.error(f"{e}", exc_info=True)
+            if self.connection.in_transaction:
+                self.connection.execute("ROLLBACK")
+
+    async def flush(self):
+        """Delete acknowledged updates."""
+        acks, self._acks = self._acks, []
+        if acks:
+            await self._run(self._delete, acks)
+
+    async def close(self):
+        """Flush acknowledgements and close database connection."""
+        await self.flush()
+        await self._run(self.connection.close)
+        self._executor.shutdown()
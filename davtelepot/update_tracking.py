@@ -0,0 +1,151 @@
+"""Keep track of fetched and handled updates, to skip replays.
+
+Telegram considers an update confirmed as soon as `getUpdates` is called with
+    a greater offset, and never sends it again. `UpdateJournal` stores fetched
+    updates in the bot database before that happens, and forgets them once
+    handled: updates still in the journal on restart are handled again.
+Delivery is at-least-once, not exactly-once: handled updates are forgotten
+    in batches, so those handled since the last flush are handled again after
+    a crash (see `Bot.set_class_offset_checkpoint_interval` to shorten that
+    window). Handlers with side effects should tolerate replays.
+`UpdateIdWindow` remembers which recent update ids were already received.
+"""
+
+# Standard library modules
+import datetime
+import logging
+
+# Project modules
+from .json_codec import codec
+
+
+class UpdateJournal(object):
+    """Durable list of updates fetched but not handled yet.
+
+    Updates are stored in a single transaction per batch; handled ones are
+        deleted in batches as well (see `flush`), so that database writes do
+        not grow with the number of updates.
+    If the bot stops before a flush, updates handled since the last one are
+        handled again on restart (at-least-once delivery).
+    """
+
+    # SQLite limits the number of variables per statement
+    chunk_size = 500
+
+    def __init__(self, database, bot_id, table_name='update_journal'):
+        """Set dataset database, bot identifier and table name."""
+        self.database = database
+        self.bot_id = bot_id
+        self.table_name = table_name
+        self._pending = set()
+        self._handled = []
+
+    @property
+    def pending(self):
+        """Return number of updates stored and not handled yet."""
+        return len(self._pending)
+
+    def load(self):
+        """Return stored updates, in order, and mark them as pending."""
+        with self.database as db:
+            if self.table_name not in db.tables:
+                return []
+            records = list(
+                db[self.table_name].find(bot_id=self.bot_id,
+                                         order_by='update_id')
+            )
+        updates = [codec.loads(record['update']) for record in records]
+        self._pending.update(update['update_id'] for update in updates)
+        return updates
+
+    def append(self, updates):
+        """Store `updates` before they are confirmed to Telegram."""
+        if not updates:
+            return
+        now = datetime.datetime.now()
+        with self.database as db:
+            db[self.table_name].insert_many(
+                [
+                    dict(
+                        bot_id=self.bot_id,
+                        update_id=update['update_id'],
+                        update=codec.dumps(update),
+                        received_at=now
+                    )
+                    for update in updates
+                ]
+            )
+        self._pending.update(update['update_id'] for update in updates)
+
+    def done(self, update_id):
+        """Record that `update_id` has been handled (even if it failed)."""
+        if update_id in self._pending:
+            self._pending.discard(update_id)
+            self._handled.append(update_id)
+
+    def flush(self):
+        """Delete handled updates from database; return how many."""
+        handled, self._handled = self._handled, []
+        if not handled:
+            return 0
+        with self.database as db:
+            table = db[self.table_name]
+            for start in range(0, len(handled), self.chunk_size):
+                table.delete(
+                    bot_id=self.bot_id,
+                    update_id={'in': handled[start:start + self.chunk_size]}
+                )
+        return len(handled)
+
+
+class UpdateIdWindow(object):
+    """Bitmap of update ids seen among the latest `size` ones.
+
+    Memory is `size` bits, whatever the traffic: ids older than the window
+        are considered already seen.
+    Telegram starts update ids from a random number after a week without
+        updates: ids far older than the window (more than `size` ids before
+        it) are taken as such a reset and restart the window.
+    """
+
+    def __init__(self, size=4096):
+        """Set number of recent update ids remembered (rounded to bytes)."""
+        self.size = max(8, size - size % 8)
+        self._bits = bytearray(self.size // 8)
+        self._base = None  # Oldest id in window
+        self.duplicates = 0
+        self.resets = 0
+
+    def _clear(self, first, last):
+        """Clear bits of ids from `first` to `last` (excluded)."""
+        if last - first >= self.size:
+            self._bits[:] = bytes(len(self._bits))
+            return
+        for update_id in range(first, last):
+            position = update_id % self.size
+            self._bits[position >> 3] &= ~(1 << (position & 7)) & 0xFF
+
+    def add(self, update_id):
+        """Remember `update_id` and return False if it was already seen."""
+        if self._base is not None and update_id < self._base - self.size:
+            logging.warning(f"Update ids restarted from {update_id}")
+            self._bits[:] = bytes(len(self._bits))
+            self._base = None
+            self.resets += 1
+        if self._base is None:
+            # Updates delivered concurrently may arrive slightly out of order
+            self._base = update_id - self.size + 1
+        elif update_id < self._base:
+            self.duplicates += 1
+            return False
+        elif update_id >= self._base + self.size:
+            new_base = update_id - self.size + 1
+            self._clear(self._base, new_base)
+            self._base = new_base
+        position = update_id % self.size
+        byte, bit = position >> 3, 1 << (position & 7)
+        if self._bits[byte] & bit:
+            self.duplicates += 1
+            return False
+        self._bits[byte] |= bit
+        return True
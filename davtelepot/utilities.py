@@ -2,7 +2,9 @@
 
 # Standard library modules
 import asyncio
+import bisect
 import collections
+import collections.abc
 import csv
 import datetime
 from difflib import SequenceMatcher
@@ -12,14 +14,19 @@ import json
 import logging
 import os
 import random
+import re
 import string
 import time
+import weakref
 
 # Third party modules
 import aiohttp
 from aiohttp import web
 from bs4 import BeautifulSoup
 
+# Project modules
+from .json_codec import codec
+
 
 def sumif(iterable, condition):
     """Sum all `iterable` items matching `condition`."""
@@ -196,10 +203,10 @@ async def async_request(url, type='get', mode='json', encoding='utf-8',
         return e
     if mode == 'json':
         try:
-            result = json.loads(
+            result = codec.loads(
                 result
             )
-        except json.decoder.JSONDecodeError:
+        except ValueError:  # Including json.decoder.JSONDecodeError
             result = {}
     elif mode == 'html':
         result = BeautifulSoup(result, "html.parser")
@@ -429,6 +436,356 @@ class MyCounter():
         return self._n
 
 
+class ExpiringDict(collections.abc.MutableMapping):
+    """Dictionary forgetting items not set or touched for `ttl` seconds.
+
+    Items are kept in order of last touch, so that expired ones are always at
+        the beginning and are popped in amortized constant time whenever a
+        new item is set (or when `expire` is called).
+    If `max_size` is set, least recently touched items are evicted as well.
+    If `keep(key, value)` returns True, an expired item is touched instead of
+        being evicted (e.g. because it is still in use).
+    """
+
+    def __init__(self, ttl, max_size=None, keep=None, clock=time.monotonic):
+        """Set time to live (in seconds), maximum size and clock."""
+        self._ttl = ttl
+        self._max_size = max_size
+        self._keep = keep
+        self._clock = clock
+        self._data = collections.OrderedDict()  # key -> [touch_time, value]
+
+    @property
+    def ttl(self):
+        """Seconds after which untouched items are forgotten."""
+        return self._ttl
+
+    @property
+    def max_size(self):
+        """Maximum number of items (None for no limit)."""
+        return self._max_size
+
+    def __getitem__(self, key):
+        """Return value of `key` if it did not expire yet."""
+        item = self._data[key]
+        if self._clock() - item[0] > self._ttl:
+            if self._keep is None or not self._keep(key, item[1]):
+                raise KeyError(key)
+        return item[1]
+
+    def __setitem__(self, key, value):
+        """Set `key` and touch it."""
+        now = self._clock()
+        if key in self._data:
+            self._data.move_to_end(key)
+        self._data[key] = [now, value]
+        self.expire(now=now)
+
+    def __delitem__(self, key):
+        """Remove `key`."""
+        del self._data[key]
+
+    def __iter__(self):
+        """Iterate over keys, least recently touched first."""
+        return iter(self._data)
+
+    def __len__(self):
+        """Return number of stored items (expired ones may be included)."""
+        return len(self._data)
+
+    def touch(self, key):
+        """Refresh touch time of `key`."""
+        item = self._data[key]
+        item[0] = self._clock()
+        self._data.move_to_end(key)
+
+    def expire(self, now=None):
+        """Forget expired items, and oldest ones if `max_size` is exceeded."""
+        if now is None:
+            now = self._clock()
+        data = self._data
+        kept = 0  # Avoid looping forever if all items must be kept
+        while data and kept < len(data):
+            key, (touch_time, value) = next(iter(data.items()))
+            if not (
+                now - touch_time > self._ttl
+                or (self._max_size is not None and len(data) > self._max_size)
+            ):
+                break
+            if self._keep is not None and self._keep(key, value):
+                self.touch(key)
+                kept += 1
+                continue
+            del data[key]
+
+
+class Histogram(object):
+    """Count values falling into buckets delimited by `bounds`.
+
+    A value falls into the first bucket whose bound is not lower than it;
+        values greater than the last bound fall into an overflow bucket.
+    """
+
+    def __init__(self, bounds):
+        """Set upper bounds of buckets."""
+        self.bounds = tuple(sorted(bounds))
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.total = 0
+        self.max = None
+
+    def add(self, value):
+        """Count `value`."""
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    @property
+    def mean(self):
+        """Return mean of counted values (None if there is none)."""
+        if self.count:
+            return self.total / self.count
+
+    def as_dict(self):
+        """Return counts by bucket label, plus mean and max values."""
+        buckets = {
+            f"<={bound}": count
+            for bound, count in zip(self.bounds, self.counts)
+        }
+        buckets[f">{self.bounds[-1]}"] = self.counts[-1]
+        return dict(buckets=buckets, count=self.count, mean=self.mean,
+                    max=self.max)
+
+
+class PrefixTrie(object):
+    """Map string keys to values, finding keys which are prefixes of a text.
+
+    Lookups walk at most as many characters as the longest key, whatever
+        the number of keys.
+    Keys remember their insertion order, like dictionaries: setting again an
+        existing key replaces its value and keeps its position (use
+        `setdefault` to keep the first value instead).
+    """
+
+    def __init__(self, items=None):
+        """Add `items` ((key, value) pairs), if any."""
+        # Nodes are dicts of children by character; `None` holds the
+        #   (insertion index, value) pair of the key ending there, if any
+        self._root = dict()
+        self._length = 0
+        for key, value in (items or []):
+            self[key] = value
+
+    def __len__(self):
+        """Return number of keys."""
+        return self._length
+
+    def _get_node(self, key):
+        """Return the node where `key` ends, creating missing nodes."""
+        node = self._root
+        for character in key:
+            node = node.setdefault(character, dict())
+        return node
+
+    def __setitem__(self, key, value):
+        """Set `value` of `key`."""
+        node = self._get_node(key)
+        if None in node:
+            node[None] = (node[None][0], value)
+        else:
+            node[None] = (self._length, value)
+            self._length += 1
+
+    def setdefault(self, key, value):
+        """Set `value` of `key` unless `key` is set; return value of `key`."""
+        node = self._get_node(key)
+        if None not in node:
+            node[None] = (self._length, value)
+            self._length += 1
+        return node[None][1]
+
+    def iter_prefixes(self, text):
+        """Yield (key length, insertion index, value) of keys prefixing
+            `text`, shortest first.
+        """
+        node = self._root
+        if None in node:
+            yield (0,) + node[None]
+        for length, character in enumerate(text, start=1):
+            node = node.get(character)
+            if node is None:
+                return
+            if None in node:
+                yield (length,) + node[None]
+
+    def first(self, text, default=None):
+        """Return value of the first inserted key prefixing `text`."""
+        return min(
+            self.iter_prefixes(text),
+            key=lambda match: match[1],
+            default=(None, None, default)
+        )[2]
+
+    def longest(self, text, default=None):
+        """Return value of the longest key prefixing `text`."""
+        node = self._root
+        match = node.get(None)
+        for character in text:
+            node = node.get(character)
+            if node is None:
+                break
+            match = node.get(None, match)
+        return default if match is None else match[1]
+
+
+class PatternSet(object):
+    """Regular expressions combined into one, searched in a single pass.
+
+    Each pattern is stored with a key; `search` returns the key of the
+        pattern matching first in the text (if several patterns match at the
+        same position, the first added one wins).
+    Patterns sharing the same flags are combined without capturing groups
+        (which would make each search much slower): the combined expression
+        only finds where the first match starts, then patterns are tried in
+        order at that position. Global inline flags (e.g. `(?i)`) are part
+        of pattern flags, so they are dropped from combined patterns.
+    Case-insensitive single-word keywords are not combined: they are looked
+        up in a dictionary, word by word.
+    Patterns may not contain numbered backreferences, since groups are
+        renumbered when patterns are combined.
+    """
+
+    word_pattern = re.compile(r"\w+")
+    global_flags_pattern = re.compile(r"\A(?:\(\?[aiLmsux]+\))+")
+
+    def __init__(self):
+        """Start with no pattern."""
+        self._size = 0
+        self._patterns = dict()  # Flags -> list of (order, key, pattern)
+        self._compiled = dict()  # Flags -> combined regular expression
+        self._words = dict()  # Lower-cased keyword -> (order, key)
+
+    def __len__(self):
+        """Return number of patterns and keyword sets."""
+        return self._size
+
+    def add(self, key, pattern):
+        """Add `pattern` (a string or a compiled regular expression).
+
+        Raise `re.error` if it cannot be combined with other patterns.
+        """
+        pattern = re.compile(pattern)
+        patterns = self._patterns.setdefault(pattern.flags, [])
+        patterns.append((self._size, key, pattern))
+        try:
+            self._compile(pattern.flags)
+        except re.error:
+            patterns.pop()
+            self._compile(pattern.flags)
+            raise
+        self._size += 1
+
+    def add_keywords(self, key, keywords, flags=re.IGNORECASE):
+        """Add keywords, matching as whole words."""
+        keywords = sorted(keywords, key=len, reverse=True)
+        if flags == re.IGNORECASE and all(
+            self.word_pattern.fullmatch(keyword) for keyword in keywords
+        ):
+            for keyword in keywords:
+                # Keep the first key of a keyword, like combined patterns
+                self._words.setdefault(keyword.lower(), (self._size, key))
+            self._size += 1
+            return
+        self.add(
+            key,
+            re.compile(
+                r"\b(?:" + '|'.join(map(re.escape, keywords)) + r")\b",
+                flags
+            )
+        )
+
+    def _compile(self, flags):
+        """Combine patterns having `flags` into one regular expression."""
+        patterns = self._patterns[flags]
+        if not patterns:
+            del self._patterns[flags]
+            self._compiled.pop(flags, None)
+            return
+        # Comments of verbose patterns end at line end
+        end = '\n' if flags & re.VERBOSE else ''
+        self._compiled[flags] = re.compile(
+            '|'.join(
+                "(?:"
+                + self.global_flags_pattern.sub('', pattern.pattern, count=1)
+                + end + ")"
+                for _, _, pattern in patterns
+            ),
+            flags
+        )
+
+    def search(self, text):
+        """Return key of the pattern matching first in `text`, or None."""
+        found = None  # (position, order, key)
+        if self._words:
+            for word in self.word_pattern.finditer(text):
+                entry = self._words.get(word.group().lower())
+                if entry is not None:
+                    found = (word.start(), *entry)
+                    break
+        for flags, compiled in self._compiled.items():
+            match = compiled.search(text)
+            if match is None:
+                continue
+            position = match.start()
+            for order, key, pattern in self._patterns[flags]:
+                if found is not None and found[:2] < (position, order):
+                    break
+                if pattern.match(text, position) is not None:
+                    found = (position, order, key)
+                    break
+        if found is not None:
+            return found[2]
+
+
+def make_argument_injector(function):
+    """Return a function picking keyword arguments accepted by `function`.
+
+    The signature of `function` is inspected once: the returned function
+        takes a mapping of available arguments (e.g. `locals()`) and returns
+        a dict of those accepted by `function`.
+    """
+    names = tuple(inspect.signature(function).parameters)
+
+    def inject_arguments(arguments):
+        return {name: arguments[name] for name in names if name in arguments}
+    return inject_arguments
+
+
+# Function -> argument injector, forgotten with the function
+_argument_injectors = weakref.WeakKeyDictionary()
+
+
+def get_argument_injector(function):
+    """Return the argument injector of `function` (cached).
+
+    Use it for functions known only at call time; get injectors of functions
+        known in advance once, with `make_argument_injector`.
+    Injectors are cached as long as `function` exists (callables which cannot
+        be weakly referenced are inspected at each call).
+    """
+    try:
+        return _argument_injectors[function]
+    except KeyError:
+        injector = _argument_injectors[function] = make_argument_injector(
+            function
+        )
+        return injector
+    except TypeError:
+        return make_argument_injector(function)
+
+
 def wrapper(func, *args, **kwargs):
     """Wrap a function so that it can be later called with one argument."""
     def wrapped(update):
@@ -461,17 +818,13 @@ async def async_wrapper(coroutine, *args1, **kwargs1):
         asyncio.get_event_loop().run_until_complete(main())
     ```
     """
+    inject_arguments = make_argument_injector(coroutine)
+
     async def wrapped_coroutine(*args2, **kwargs2):
         # Update keyword arguments
         kwargs1.update(kwargs2)
         # Pass only supported arguments
-        kwargs = {
-            name: argument
-            for name, argument in kwargs1.items()
-            if name in inspect.signature(
-                coroutine
-            ).parameters
-        }
+        kwargs = inject_arguments(kwargs1)
         return await coroutine(*args1, *args2, **kwargs)
     return wrapped_coroutine
 
@@ -0,0 +1,113 @@
+"""Send the first API call of a webhook update within the webhook response.
+
+Telegram accepts one method call in the body of the response to a webhook
+    request, saving a full outbound round trip. Its result is not returned.
+While a webhook update is being handled, a `WebhookReply` is bound to the
+    context: the first eligible API call made before the deadline is stored
+    there instead of being sent, and the webhook response carries it.
+Eligible calls are those whose result nobody misses (see
+    `is_webhook_reply_allowed`): calls of methods returning nothing but True,
+    and text replies made within `results_ignored`.
+"""
+
+# Standard library modules
+import asyncio
+import contextlib
+import contextvars
+
+# Methods whose result is always True
+TRUE_RESULT_METHODS = frozenset([
+    'answerCallbackQuery', 'answerInlineQuery', 'answerPreCheckoutQuery',
+    'answerShippingQuery', 'deleteMessage', 'sendChatAction',
+])
+# Methods whose result is only returned to callers, not read by wrappers
+#   (e.g. `Bot.send_photo` reads the file id of sent photos)
+RETURNED_RESULT_METHODS = frozenset(['editMessageText', 'sendMessage'])
+
+_webhook_reply = contextvars.ContextVar('webhook_reply', default=None)
+_results_ignored = contextvars.ContextVar('results_ignored', default=False)
+
+
+def get_webhook_reply():
+    """Return the WebhookReply bound to current context, if any."""
+    return _webhook_reply.get()
+
+
+def set_webhook_reply(webhook_reply):
+    """Bind `webhook_reply` to current context and return a reset token."""
+    return _webhook_reply.set(webhook_reply)
+
+
+def reset_webhook_reply(token):
+    """Restore the WebhookReply bound before `set_webhook_reply`."""
+    _webhook_reply.reset(token)
+
+
+@contextlib.contextmanager
+def results_ignored():
+    """Declare that results of API calls made in this block are not used.
+
+    Use it around replies whose result is discarded, e.g. replies made with
+        the return value of a handler: text messages sent or edited there may
+        travel in the webhook response.
+    """
+    token = _results_ignored.set(True)
+    try:
+        yield
+    finally:
+        _results_ignored.reset(token)
+
+
+def is_webhook_reply_allowed(method):
+    """Return True if a call of `method` may travel in a webhook response.
+
+    Such calls return True instead of their result.
+    """
+    return method in TRUE_RESULT_METHODS or (
+        method in RETURNED_RESULT_METHODS and _results_ignored.get()
+    )
+
+
+class WebhookReply(object):
+    """Slot for the first API call made while handling a webhook update."""
+
+    def __init__(self):
+        """Open an empty slot."""
+        self.method = None
+        self.body = None
+        self._closed = False
+        self._done = asyncio.Event()
+
+    @property
+    def is_open(self):
+        """Return True if the slot may still receive an API call."""
+        return not self._closed and self.method is None
+
+    def claim(self, method, body):
+        """Store `method` and its JSON `body`; return False if too late."""
+        if not self.is_open:
+            return False
+        self.method, self.body = method, body
+        self._done.set()
+        return True
+
+    def close(self):
+        """Refuse further API calls."""
+        self._closed = True
+        self._done.set()
+
+    async def wait(self, deadline):
+        """Wait up to `deadline` seconds for an API call, then close slot.
+
+        Return True if an API call was stored.
+        """
+        try:
+            await asyncio.wait_for(self._done.wait(), deadline)
+        except asyncio.TimeoutError:
+            pass
+        self.close()
+        return self.method is not None
+
+    def make_response_body(self):
+        """Return the webhook response body as a dict."""
+        return dict(self.body, method=self.method)
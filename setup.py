@@ -52,13 +52,18 @@ setuptools.setup(
     long_description=long_description,
     long_description_content_type="text/markdown",
     url="https://gogs.davte.it/davte/davtelepot",
-    packages=setuptools.find_packages(),
+    packages=setuptools.find_packages(
+        exclude=['benchmarks', 'benchmarks.*', 'tests', 'tests.*']
+    ),
     platforms=['any'],
     install_requires=[
         'aiohttp',
         'bs4',
         'dataset',
     ],
+    extras_require={
+        'fast_json': ['orjson'],
+    },
     classifiers=[
         "Development Status :: 5 - Production/Stable",
         "Environment :: Console",
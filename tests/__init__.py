@@ -0,0 +1,51 @@
+"""Behaviour tests of davtelepot.
+
+Run from the repository root:
+    ```bash
+    python -m pytest tests
+    ```
+Tests talking to Telegram use `davtelepot.fake_api.FakeTelegramServer`.
+"""
+
+# Standard library modules
+import unittest
+
+# Project modules
+from davtelepot.api import TelegramBot
+from davtelepot.fake_api import FakeTelegramServer
+
+
+def run(coroutine):
+    """Run `coroutine` on the event loop shared by bots and return result."""
+    return TelegramBot.loop.run_until_complete(coroutine)
+
+
+class FakeServerTestCase(unittest.TestCase):
+    """Test case providing a fake Telegram server and a bot using it."""
+
+    bot_class = TelegramBot
+    server_parameters = dict()
+
+    def setUp(self):
+        """Start fake server and make a bot pointing to it."""
+        self.server = FakeTelegramServer(**self.server_parameters)
+        url = run(self.server.start())
+        self.bot = self.make_bot()
+        self.bot.set_api_url(url)
+
+    def make_bot(self):
+        """Return the bot under test."""
+        return self.bot_class(token='123456:test')
+
+    def tearDown(self):
+        """Stop bot workers, close sessions and stop fake server."""
+        if self.bot.outbound_dispatcher is not None:
+            run(self.bot.outbound_dispatcher.stop())
+        sessions = list(self.bot.sessions.values())
+        if TelegramBot._shared_session is not None:
+            sessions.append(TelegramBot._shared_session)
+            TelegramBot._shared_session = None
+        for session in sessions:
+            if not session.closed:
+                run(session.close())
+        run(self.server.stop())
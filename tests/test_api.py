@@ -0,0 +1,25 @@
+"""Test how API requests are encoded and their errors reported."""
+
+# Project modules
+from davtelepot.api import TelegramError
+from . import FakeServerTestCase, run
+
+
+class TestRequestEncoding(FakeServerTestCase):
+
+    def test_serialized_parameters_are_nested(self):
+        sent = run(self.bot.sendMessage(
+            chat_id=1, text="Hello",
+            reply_markup='{"inline_keyboard": [[{"text": "A", '
+                         '"callback_data": "a"}]]}'
+        ))
+        self.assertEqual(sent['reply_markup']['inline_keyboard'][0][0],
+                         dict(text="A", callback_data="a"))
+
+    def test_invalid_serialized_parameters_are_reported(self):
+        # Result is an Exception, as for any refused request
+        result = run(self.bot.sendMessage(chat_id=1, text="Hello",
+                                          reply_markup='{bad'))
+        self.assertIsInstance(result, TelegramError)
+        self.assertEqual(result.code, 400)
+        self.assertEqual(self.server.requests['sendMessage'], 1)
@@ -0,0 +1,135 @@
+"""Test caching and single-flight coalescing of Telegram API getters."""
+
+# Standard library modules
+import asyncio
+import unittest
+
+# Project modules
+from davtelepot.api_cache import ApiCache
+from . import FakeServerTestCase, run
+
+
+class FakeClock(object):
+    """Clock advanced by hand."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestApiCache(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.cache = ApiCache(ttls=dict(getChat=10), max_size=2,
+                              clock=self.clock)
+        self.requests = 0
+
+    async def request(self, result='chat', delay=0.0):
+        self.requests += 1
+        await asyncio.sleep(delay)
+        return result
+
+    def get(self, key, chat_id=None, **kwargs):
+        return self.cache.get(key, lambda: self.request(**kwargs),
+                              chat_id=chat_id)
+
+    def test_hits_until_expiry(self):
+        key = ('getChat', 1)
+        self.assertEqual(run(self.get(key)), 'chat')
+        self.assertEqual(run(self.get(key)), 'chat')
+        self.assertEqual(self.requests, 1)
+        self.clock.now = 11
+        run(self.get(key))
+        self.assertEqual(self.requests, 2)
+        self.assertEqual(self.cache.stats['hits'], 1)
+
+    def test_single_flight(self):
+        async def scenario():
+            return await asyncio.gather(*(
+                self.get(('getChat', 1), delay=0.01) for _ in range(5)
+            ))
+        self.assertEqual(run(scenario()), ['chat'] * 5)
+        self.assertEqual(self.requests, 1)
+        self.assertEqual(self.cache.stats['coalesced'], 4)
+        self.assertEqual(self.cache.stats['in_flight'], 0)
+
+    def test_errors_are_shared_not_stored(self):
+        async def failing_request():
+            self.requests += 1
+            await asyncio.sleep(0.01)
+            raise ValueError("Failed")
+
+        async def scenario():
+            return await asyncio.gather(
+                *(self.cache.get(('getChat', 1), failing_request)
+                  for _ in range(3)),
+                return_exceptions=True
+            )
+        results = run(scenario())
+        self.assertTrue(all(isinstance(r, ValueError) for r in results))
+        self.assertEqual(self.requests, 1)
+        self.assertEqual(self.cache.stats['size'], 0)
+
+    def test_cancelled_caller_does_not_cancel_waiters(self):
+        async def scenario():
+            leader = asyncio.ensure_future(self.get(('getChat', 1),
+                                                    delay=0.05))
+            await asyncio.sleep(0)
+            waiter = asyncio.ensure_future(self.get(('getChat', 1),
+                                                    delay=0.01))
+            await asyncio.sleep(0.01)
+            leader.cancel()
+            return await waiter, leader
+        result, leader = run(scenario())
+        self.assertEqual(result, 'chat')
+        self.assertTrue(leader.cancelled())
+        self.assertEqual(self.requests, 2)  # Waiter made the request again
+
+    def test_lru_eviction(self):
+        for chat_id in (1, 2):
+            run(self.get(('getChat', chat_id), chat_id=chat_id))
+        run(self.get(('getChat', 1), chat_id=1))  # 2 is now least recent
+        run(self.get(('getChat', 3), chat_id=3))
+        self.assertEqual(self.requests, 3)
+        run(self.get(('getChat', 1), chat_id=1))
+        self.assertEqual(self.requests, 3)
+        run(self.get(('getChat', 2), chat_id=2))
+        self.assertEqual(self.requests, 4)
+
+    def test_invalidation_by_chat(self):
+        run(self.get(('getChat', 1), chat_id=1))
+        run(self.get(('getChat', 2), chat_id=2))
+        self.cache.invalidate(chat_id=1)
+        self.assertEqual(self.cache.stats['size'], 1)
+        run(self.get(('getChat', 1), chat_id=1))
+        run(self.get(('getChat', 2), chat_id=2))
+        self.assertEqual(self.requests, 3)
+
+
+class TestBotApiCache(FakeServerTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.bot.set_api_cache()
+
+    def test_concurrent_getters_share_request(self):
+        async def scenario():
+            return await asyncio.gather(*(
+                self.bot.getChat(chat_id=-100) for _ in range(10)
+            ))
+        results = run(scenario())
+        self.assertEqual(len({result['id'] for result in results}), 1)
+        self.assertEqual(self.server.requests['getChat'], 1)
+        run(self.bot.getChat(chat_id=-100))
+        self.assertEqual(self.server.requests['getChat'], 1)
+
+    def test_chat_changes_invalidate(self):
+        run(self.bot.getChat(chat_id=-100))
+        run(self.bot.getChat(chat_id=-200))
+        run(self.bot.setChatTitle(chat_id=-100, title="New title"))
+        run(self.bot.getChat(chat_id=-100))
+        run(self.bot.getChat(chat_id=-200))
+        self.assertEqual(self.server.requests['getChat'], 3)
@@ -0,0 +1,235 @@
+"""Test rate limits, flood control pauses and outbound dispatching."""
+
+# Standard library modules
+import asyncio
+import unittest
+
+# Project modules
+from davtelepot.flood_control import (
+    FloodGate, OutboundDispatcher, RateLimiter, TokenBucket, outbound_priority
+)
+from . import FakeServerTestCase, run
+
+
+class FakeClock(object):
+    """Clock advanced by hand."""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestTokenBucket(unittest.TestCase):
+
+    def test_reservations_are_spaced(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=10, capacity=1, clock=clock)
+        self.assertEqual(bucket.reserve(), 0.0)
+        self.assertAlmostEqual(bucket.reserve(), 0.1)
+        self.assertAlmostEqual(bucket.reserve(), 0.2)
+        self.assertFalse(bucket.try_reserve())
+        clock.now = 0.31
+        self.assertTrue(bucket.try_reserve())
+
+    def test_burst(self):
+        bucket = TokenBucket(rate=10, capacity=3, clock=FakeClock())
+        self.assertEqual([bucket.try_reserve() for _ in range(4)],
+                         [True, True, True, False])
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_private_chat_cooldown(self):
+        clock = FakeClock()
+        limiter = RateLimiter(private_chat_cooldown=1, clock=clock)
+        self.assertTrue(limiter.try_acquire(1))
+        self.assertFalse(limiter.try_acquire(1))
+        self.assertAlmostEqual(limiter.get_delay(1), 1.0)
+        clock.now = 0.1  # Let the global bucket refill
+        self.assertTrue(limiter.try_acquire(2))  # Other chats may go
+        clock.now = 1.0
+        self.assertTrue(limiter.try_acquire(1))
+
+    def test_group_window(self):
+        clock = FakeClock()
+        limiter = RateLimiter(group_chat_cooldown=0.5,
+                              group_messages_per_window=3, group_window=10,
+                              clock=clock)
+        for n in range(3):
+            clock.now = n
+            self.assertTrue(limiter.try_acquire(-100))
+        clock.now = 3
+        self.assertAlmostEqual(limiter.get_delay(-100), 7.0)
+
+    def test_histories_are_forgotten(self):
+        clock = FakeClock()
+        limiter = RateLimiter(private_chat_cooldown=1, group_window=2,
+                              clock=clock)
+        limiter.try_acquire(1)
+        clock.now = 5
+        limiter.try_acquire(2)
+        self.assertNotIn(1, limiter.chats)
+
+
+class TestFloodGate(unittest.TestCase):
+
+    def test_chat_pause(self):
+        async def scenario():
+            gate = FloodGate()
+            gate.pause(0.05, chat_id=1)
+            self.assertGreater(gate.get_delay(1), 0)
+            self.assertEqual(gate.get_delay(2), 0)
+            loop = asyncio.get_event_loop()
+            start = loop.time()
+            await gate.wait(2)
+            self.assertLess(loop.time() - start, 0.04)
+            await gate.wait(1)
+            self.assertGreaterEqual(loop.time() - start, 0.04)
+            return gate.stats
+        stats = run(scenario())
+        self.assertEqual(stats['pauses'], 1)
+        self.assertEqual(stats['delayed_requests'], 1)
+
+    def test_global_pause_releases_in_order(self):
+        async def scenario():
+            gate = FloodGate()
+            gate.pause(0.05)
+            released = []
+
+            async def request(n):
+                await gate.wait(n)
+                released.append(n)
+            await asyncio.gather(*(request(n) for n in range(5)))
+            return released
+        self.assertEqual(run(scenario()), list(range(5)))
+
+
+class TestOutboundDispatcher(unittest.TestCase):
+
+    def test_priorities_and_round_robin(self):
+        async def scenario():
+            dispatcher = OutboundDispatcher(workers=1)
+            sent = []
+
+            async def send(label):
+                sent.append(label)
+            futures = [
+                dispatcher.submit(send, label, chat_id=chat_id,
+                                  priority=priority)
+                for label, chat_id, priority in (
+                    ('a1', 1, 'bulk'), ('b1', 2, 'bulk'), ('a2', 1, 'bulk'),
+                    ('a3', 1, 'bulk'), ('c1', 3, 'interactive'),
+                    ('d1', 4, 'edits'),
+                )
+            ]
+            with outbound_priority('interactive'):
+                futures.append(dispatcher.submit(send, 'e1', chat_id=5,
+                                                 priority='bulk'))
+            await asyncio.gather(*futures)
+            await dispatcher.stop()
+            return sent
+        self.assertEqual(run(scenario()),
+                         ['c1', 'e1', 'd1', 'a1', 'b1', 'a2', 'a3'])
+
+    def test_delayed_chats_wait(self):
+        async def scenario():
+            loop = asyncio.get_event_loop()
+            ready_at = {1: loop.time() + 0.05}
+            dispatcher = OutboundDispatcher(
+                workers=1,
+                get_delay=lambda chat_id: max(
+                    0.0, ready_at.get(chat_id, 0.0) - loop.time()
+                )
+            )
+            sent = []
+
+            async def send(label):
+                sent.append((label, loop.time()))
+            futures = [dispatcher.submit(send, 'a', chat_id=1),
+                       dispatcher.submit(send, 'b', chat_id=2)]
+            await asyncio.gather(*futures)
+            await dispatcher.stop()
+            return sent, ready_at[1]
+        sent, ready_at = run(scenario())
+        self.assertEqual([label for label, _ in sent], ['b', 'a'])
+        self.assertGreaterEqual(sent[1][1], ready_at - 0.01)
+
+    def test_one_request_per_chat_at_a_time(self):
+        async def scenario():
+            dispatcher = OutboundDispatcher(workers=4)
+            running, overlaps = set(), []
+
+            async def send(chat_id):
+                if chat_id in running:
+                    overlaps.append(chat_id)
+                running.add(chat_id)
+                await asyncio.sleep(0.01)
+                running.discard(chat_id)
+            await asyncio.gather(*(
+                dispatcher.submit(send, chat_id, chat_id=chat_id)
+                for chat_id in (1, 1, 2, 1, 2, 3)
+            ))
+            await dispatcher.stop()
+            return overlaps
+        self.assertEqual(run(scenario()), [])
+
+    def test_cancelled_requests_are_skipped(self):
+        async def scenario():
+            dispatcher = OutboundDispatcher(workers=1)
+            sent = []
+
+            async def send(label):
+                sent.append(label)
+            first = dispatcher.submit(send, 'a', chat_id=1)
+            dispatcher.submit(send, 'b', chat_id=1).cancel()
+            await first
+            self.assertTrue(await dispatcher.drain(timeout=1))
+            await dispatcher.stop()
+            return sent
+        self.assertEqual(run(scenario()), ['a'])
+
+    def test_stop_cancels_pending_requests(self):
+        async def scenario():
+            dispatcher = OutboundDispatcher(workers=1)
+            release = asyncio.Event()
+            await_forever = dispatcher.submit(release.wait, chat_id=1)
+            pending = dispatcher.submit(release.wait, chat_id=2)
+            await asyncio.sleep(0.01)
+            await asyncio.wait_for(dispatcher.stop(), 1)
+            return await_forever, pending, dispatcher.pending
+        await_forever, pending, pending_number = run(scenario())
+        self.assertTrue(await_forever.cancelled())
+        self.assertTrue(pending.cancelled())
+        self.assertEqual(pending_number, 0)
+
+
+class TestFloodRetry(FakeServerTestCase):
+
+    def test_retry_after_pause(self):
+        self.server.fail_next('sendMessage', error_code=429, retry_after=1)
+        message = run(self.bot.sendMessage(chat_id=1, text="Hello"))
+        self.assertEqual(message['text'], "Hello")
+        self.assertEqual(self.server.requests['sendMessage'], 2)
+        stats = self.bot.flood_gate.stats
+        self.assertEqual(stats['pauses'], 1)
+        self.assertGreater(stats['chat_throttled_time'], 0)
+
+    def test_pause_delays_chat_only(self):
+        self.server.fail_next('sendMessage', error_code=429, retry_after=1)
+
+        async def scenario():
+            loop = asyncio.get_event_loop()
+            start = loop.time()
+            first = asyncio.ensure_future(
+                self.bot.sendMessage(chat_id=1, text="First")
+            )
+            await asyncio.sleep(0.2)  # Chat 1 is paused now
+            await self.bot.sendMessage(chat_id=2, text="Other chat")
+            other_chat_time = loop.time() - start
+            await first
+            return other_chat_time, loop.time() - start
+        other_chat_time, first_time = run(scenario())
+        self.assertLess(other_chat_time, 0.9)
+        self.assertGreaterEqual(first_time, 0.9)
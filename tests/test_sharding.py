@@ -0,0 +1,219 @@
+"""Test the frame protocol and worker processes handling updates."""
+
+# Standard library modules
+import asyncio
+import gc
+import os
+import socket
+import tempfile
+import time
+import unittest
+import zlib
+
+# Project modules
+from davtelepot.bot import Bot
+from davtelepot.sharding import (
+    DONE_FRAME, FRAME_HEADER, UPDATE_FRAME, ShardRouter, read_frame,
+    write_frame
+)
+from davtelepot.update_tracking import UpdateJournal
+from . import run
+
+
+class TestFrames(unittest.TestCase):
+
+    def test_frames_round_trip(self):
+        async def scenario():
+            left, right = socket.socketpair()
+            _, writer = await asyncio.open_connection(sock=left)
+            reader, other_writer = await asyncio.open_connection(sock=right)
+            write_frame(writer, UPDATE_FRAME, 3, 2 ** 32 - 1, b'{"a": 1}')
+            write_frame(writer, DONE_FRAME, sequence=7)
+            await writer.drain()
+            frames = [await read_frame(reader), await read_frame(reader)]
+            writer.close()
+            frames.append(await read_frame(reader))
+            other_writer.close()
+            return frames
+        self.assertEqual(
+            run(scenario()),
+            [(UPDATE_FRAME, 3, 2 ** 32 - 1, b'{"a": 1}'),
+             (DONE_FRAME, 0, 7, b''),
+             None]
+        )
+
+    def test_truncated_frame(self):
+        async def scenario():
+            reader = asyncio.StreamReader()
+            reader.feed_data(FRAME_HEADER.pack(UPDATE_FRAME, 0, 1, 10)
+                             + b'short')
+            reader.feed_eof()
+            return await read_frame(reader)
+        self.assertIsNone(run(scenario()))
+
+
+class TestShardSelection(unittest.TestCase):
+
+    def test_keys_are_hashed_deterministically(self):
+        router = ShardRouter(bots=[], workers=3)
+        for key in (42, -100123, 'channel_name'):
+            expected = zlib.crc32(repr(key).encode()) % 3
+            self.assertIs(router.get_shard(key), router.shards[expected])
+        # Updates without key are spread across shards
+        self.assertEqual(
+            {router.get_shard(None).index for _ in range(3)}, {0, 1, 2}
+        )
+
+
+class TestShardRouter(unittest.TestCase):
+    """Fork workers handling updates, one of them crashing once."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.log_path = os.path.join(self.directory.name, 'handled.log')
+        self.crash_marker = os.path.join(self.directory.name, 'crashed')
+        self.bot = Bot(token='123456:test',
+                       database_url=os.path.join(self.directory.name,
+                                                 'bot.db'))
+        self.bot.set_router('message', self.handle_message,
+                            user_record=False)
+        self.confirmed = []
+        self.bot.update_handled = self.confirmed.append
+
+    def tearDown(self):
+        Bot.bots.remove(self.bot)
+        self.directory.cleanup()
+
+    async def handle_message(self, update, user_record):
+        """Log `update` (in worker process), crashing once on `crash`."""
+        if update['text'] == 'crash' and not os.path.exists(
+            self.crash_marker
+        ):
+            open(self.crash_marker, 'w').close()
+            os._exit(1)
+        if update['text'] == 'restart':
+            Bot.stop(message='=== RESTART ===', final_state=65)
+        # Objects inherited from front process may be collected in workers
+        gc.collect()
+        await asyncio.sleep(0.001)
+        with open(self.log_path, 'a') as log_file:
+            log_file.write(f"{os.getpid()} {update['chat']['id']} "
+                           f"{update['message_id']}\n")
+
+    @staticmethod
+    def make_update(update_id, chat_id, text='hello'):
+        return dict(
+            update_id=update_id,
+            message=dict(message_id=update_id, chat=dict(id=chat_id),
+                         date=0, text=text)
+        )
+
+    def test_updates_are_partitioned_and_replayed(self):
+        # Workers, restarted ones included, must leave checkpoints to the
+        #   front process
+        self.bot.update_journal = UpdateJournal(self.bot.db, bot_id=1)
+        self.bot.update_journal.append([self.make_update(1000, chat_id=1)])
+        self.bot.update_journal.done(1000)
+        self.bot._offset = 1001
+        router = ShardRouter([self.bot], workers=2, queue_size=5,
+                             heartbeat_interval=0.1)
+        router.start()
+        updates = [self.make_update(n, chat_id=n % 4) for n in range(1, 40)]
+        updates.insert(20, self.make_update(100, chat_id=1, text='crash'))
+
+        async def scenario():
+            for update in updates:
+                await router.submit(0, update,
+                                    key=self.bot.get_update_key(update))
+            deadline = time.monotonic() + 20
+            while (
+                router.handled < len(updates)
+                and time.monotonic() < deadline
+            ):
+                await asyncio.sleep(0.05)
+            health = router.health
+            await router.stop(timeout=5)
+            # Workers must not have broken wakeups of this loop from threads
+            started = time.monotonic()
+            await asyncio.wait_for(
+                asyncio.get_running_loop().run_in_executor(
+                    None, time.sleep, 0.1
+                ),
+                2
+            )
+            self.assertLess(time.monotonic() - started, 1)
+            return health
+        health = run(scenario())
+        self.assertEqual(health['handled'], len(updates))
+        self.assertEqual(health['in_flight'], 0)
+        self.assertEqual(sum(worker['restarts']
+                             for worker in health['workers']), 1)
+        self.assertEqual(len(self.confirmed), len(updates))
+        self.assertFalse(router.supervisor.process.is_alive())
+        with self.bot.db as db:
+            self.assertNotIn('update_checkpoints', db.tables)
+        self.assertEqual(
+            [update['update_id'] for update in UpdateJournal(
+                self.bot.db, bot_id=1
+            ).load()],
+            [1000]
+        )
+        with open(self.log_path) as log_file:
+            lines = [line.split() for line in log_file]
+        for chat_id in range(4):
+            expected = [update['message']['message_id']
+                        for update in updates
+                        if update['message']['chat']['id'] == chat_id]
+            message_ids = [int(message_id)
+                           for _, chat, message_id in lines
+                           if int(chat) == chat_id]
+            # Each update at least once and in order (replayed updates may
+            #   be handled twice)
+            self.assertEqual(list(dict.fromkeys(message_ids)), expected)
+            if router.get_shard(chat_id) is not router.get_shard(1):
+                self.assertEqual(
+                    len({pid for pid, chat, _ in lines
+                         if int(chat) == chat_id}),
+                    1
+                )
+
+    def test_stop_requests_are_forwarded_to_front_process(self):
+        stops = []
+        router = ShardRouter(
+            [self.bot], workers=1, heartbeat_interval=0.1,
+            on_stop=lambda message, final_state: stops.append(
+                (message, final_state)
+            )
+        )
+        router.start()
+        updates = [self.make_update(1, chat_id=1, text='restart'),
+                   self.make_update(2, chat_id=1)]
+
+        async def scenario():
+            for update in updates:
+                await router.submit(0, update,
+                                    key=self.bot.get_update_key(update))
+            deadline = time.monotonic() + 10
+            while (
+                (router.handled < len(updates) or not stops)
+                and time.monotonic() < deadline
+            ):
+                await asyncio.sleep(0.05)
+            health = router.health
+            await router.stop(timeout=5)
+            return health
+        health = run(scenario())
+        self.assertEqual(stops, [('=== RESTART ===', 65)])
+        # The worker went on handling updates instead of exiting
+        self.assertEqual(health['handled'], len(updates))
+        self.assertEqual(health['workers'][0]['restarts'], 0)
+        self.assertIsNone(Bot.shard_worker)
+
+    def test_workers_are_not_started_by_running_loop(self):
+        router = ShardRouter([self.bot], workers=1)
+
+        async def scenario():
+            router.start()
+        with self.assertRaises(RuntimeError):
+            run(scenario())
+        self.assertIsNone(router.supervisor.process)
@@ -0,0 +1,84 @@
+"""Test draining of in-flight work when bots are stopped."""
+
+# Standard library modules
+import asyncio
+import os
+import tempfile
+
+# Third party modules
+from aiohttp.test_utils import make_mocked_request
+
+# Project modules
+from davtelepot.bot import Bot
+from davtelepot.update_dispatcher import UpdateDispatcher
+from . import FakeServerTestCase, run
+
+
+class TestDrain(FakeServerTestCase):
+
+    def make_bot(self):
+        self.directory = tempfile.TemporaryDirectory()
+        return Bot(token='123456:test',
+                   database_url=os.path.join(self.directory.name, 'bot.db'))
+
+    def tearDown(self):
+        super().tearDown()
+        Bot.bots.remove(self.bot)
+        self.directory.cleanup()
+
+    def stop_app(self, drain_timeout):
+        """Stop bots granting them `drain_timeout` seconds."""
+        self.addCleanup(Bot.set_class_drain_timeout, Bot._drain_timeout)
+        Bot.set_class_drain_timeout(drain_timeout)
+        run(Bot.stop_app())
+
+    def test_placeholders_are_sent_before_stopping(self):
+        self.bot.set_placeholder(chat_id=1, timeout=0.05)
+        self.assertTrue(run(self.bot.drain(timeout=5)))
+        self.assertEqual(self.bot.drain_stats['pending_tasks'], 1)
+        self.assertEqual(self.server.requests['sendChatAction'], 1)
+
+    def test_routing_tasks_are_drained(self):
+        async def route():
+            await asyncio.sleep(0.05)
+            return 'routed'
+        task = self.bot.track_task(route(), kind='routing')
+        self.stop_app(drain_timeout=5)
+        self.assertEqual(task.result(), 'routed')
+        self.assertEqual(self.bot.drain_stats['pending_tasks'], 1)
+        self.assertEqual(self.bot.drain_stats['dropped_tasks'], 0)
+
+    def test_tasks_are_cancelled_after_timeout(self):
+        task = self.bot.track_task(asyncio.sleep(10), kind='routing')
+        self.stop_app(drain_timeout=0.05)
+        self.assertTrue(task.cancelled())
+        self.assertEqual(self.bot.drain_stats['dropped_tasks'], 1)
+        self.assertLess(self.bot.drain_stats['duration'], 5)
+
+    def test_webhook_refuses_updates_after_intake_stops(self):
+        async def feed():
+            return await self.bot.webhook_feeder(
+                make_mocked_request('POST', '/webhook')
+            )
+        self.bot.stop_intake()
+        self.assertEqual(run(feed()).status, 503)
+
+    def test_blocked_submitters_are_released(self):
+        async def handler(update):
+            await asyncio.Event().wait()  # Never done
+        self.bot.update_dispatcher = UpdateDispatcher(handler, concurrency=1,
+                                                      queue_size=1)
+
+        async def submit_updates():
+            await self.bot.submit_update(dict(update_id=1))
+            await asyncio.sleep(0)  # First update in progress
+            await self.bot.submit_update(dict(update_id=2))  # Queued
+            return asyncio.ensure_future(
+                self.bot.submit_update(dict(update_id=3))
+            )
+        blocked = run(submit_updates())
+        self.stop_app(drain_timeout=0.05)
+        self.assertTrue(blocked.done())
+        with self.assertRaises(asyncio.CancelledError):
+            blocked.result()
+        self.assertEqual(self.bot.drain_stats['dropped_updates'], 2)
@@ -0,0 +1,159 @@
+"""Test dispatch of text messages to commands, aliases and parsers."""
+
+# Standard library modules
+import os
+import re
+import tempfile
+import unittest
+
+# Project modules
+from davtelepot.bot import Bot
+from . import run
+
+
+class TextMessageTestCase(unittest.TestCase):
+    """Test case providing a bot and recording called handlers."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.bot = Bot(token='123456:test',
+                       database_url=os.path.join(self.directory.name,
+                                                 'bot.db'))
+        self.calls = []
+
+    def tearDown(self):
+        Bot.bots.remove(self.bot)
+        self.directory.cleanup()
+
+    def make_handler(self, name):
+        """Return a handler recording its `name` when called."""
+        async def handler(bot, update, user_record):
+            self.calls.append(name)
+        return handler
+
+    def send(self, text, chat_id=1):
+        """Pass a text message to `Bot.text_message_handler`."""
+        update = {'message_id': 1, 'text': text, 'chat': dict(id=chat_id),
+                  'from': dict(id=chat_id)}
+        run(self.bot.text_message_handler(update=update, user_record=None))
+
+
+class TestCommandDispatch(TextMessageTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.bot.command('/start', aliases=['Hello', 'Hi there'],
+                         authorization_level='everybody')(
+            self.make_handler('start')
+        )
+        self.bot.command('help_2', aliases=['/h', 'Help'],
+                         authorization_level='everybody')(
+            self.make_handler('help')
+        )
+
+    def test_commands(self):
+        self.send('/start')
+        self.send('/START now')
+        self.send('/start@davtelepot_bot')
+        self.send('/help_2 me')
+        self.send('/h')
+        self.assertEqual(self.calls,
+                         ['start', 'start', 'start', 'help', 'help'])
+
+    def test_unknown_commands(self):
+        # Group chats get no reply to unknown commands
+        self.send('/stop', chat_id=-1)
+        self.send('/help', chat_id=-1)
+        self.send('/', chat_id=-1)
+        self.assertEqual(self.calls, [])
+
+    def test_aliases(self):
+        self.send('hello world')
+        self.send('HI THERE')
+        self.send('help me')
+        self.send('hi')
+        self.send('say hello')
+        self.assertEqual(self.calls, ['start', 'start', 'help'])
+
+    def test_first_registered_alias_wins(self):
+        self.bot.add_command_alias('HELLO', self.make_handler('other'))
+        self.bot.add_command_alias('hel', self.make_handler('shorter'))
+        self.send('Hello')
+        self.send('help')
+        self.assertEqual(self.calls, ['start', 'help'])
+        self.assertIn('HELLO', self.bot.command_aliases)
+
+    def test_registering_an_alias_again_replaces_handler(self):
+        self.bot.add_command_alias('Hello', self.make_handler('other'))
+        self.send('hello')
+        self.assertEqual(self.calls, ['other'])
+
+
+class TestTextParsers(TextMessageTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.bot.parser(r"\bweather in (\w+)",
+                        authorization_level='everybody')(
+            self.make_handler('weather')
+        )
+        self.bot.parser({'hello', 'hi'}, authorization_level='everybody')(
+            self.make_handler('greeting')
+        )
+
+        def is_chill(update):
+            return update['text'].startswith('Chill')
+        self.bot.parser(is_chill, authorization_level='everybody',
+                        argument='update')(self.make_handler('fallback'))
+
+    def test_parsers(self):
+        self.send('Weather in Rome?')
+        self.send('Hi, weather in Rome?')
+        self.send('Well, hello')
+        self.send('Chill out')
+        self.assertEqual(self.calls,
+                         ['weather', 'greeting', 'greeting', 'fallback'])
+        self.assertEqual(
+            [(parser['kind'], parser['hits'])
+             for parser in self.bot.get_parser_stats()],
+            [('keywords', 2), ('pattern', 1), ('callable', 1)]
+        )
+
+    def test_patterns_are_searched_in_original_text(self):
+        self.bot.parser(re.compile(r"\bStop\b"),
+                        authorization_level='everybody')(
+            self.make_handler('case sensitive')
+        )
+        self.bot.parser(r"(?s)go.on", authorization_level='everybody')(
+            self.make_handler('inline flags')
+        )
+        self.send('Please Stop')
+        self.send('please stop')
+        self.send('GO\nON')
+        self.assertEqual(self.calls, ['case sensitive', 'inline flags'])
+
+    def test_searched_conditions_only_get_text(self):
+        for condition in (r"\bfoo", {'foo'}):
+            with self.assertRaises(ValueError):
+                self.bot.parser(condition, argument='update')
+        with self.assertRaises(ValueError):
+            self.bot.parser(len, argument='message')
+
+    def test_searched_conditions_are_registered_once(self):
+        for condition in (r"\bweather in (\w+)", ['HI', 'hello']):
+            with self.assertRaises(ValueError):
+                self.bot.parser(condition)
+        self.send('hi')
+        self.assertEqual(self.calls, ['greeting'])
+        self.assertEqual(len(self.bot.text_message_parsers), 3)
+
+    def test_callable_conditions_are_replaced(self):
+        def is_long(text):
+            return len(text) > 20
+        for name in ('first', 'second'):
+            self.bot.parser(is_long, authorization_level='everybody')(
+                self.make_handler(name)
+            )
+        self.assertEqual(len(self.bot.text_message_parsers), 4)
+        self.send('A rather long message, indeed')
+        self.assertEqual(self.calls, ['second'])
@@ -0,0 +1,163 @@
+"""Test bounded and ordered dispatching of incoming updates."""
+
+# Standard library modules
+import asyncio
+import unittest
+
+# Project modules
+from davtelepot.update_dispatcher import UpdateDispatcher
+from . import run
+
+
+def get_chat(update):
+    """Return the chat of test `update`."""
+    return update['chat']
+
+
+class TestUpdateDispatcher(unittest.TestCase):
+
+    def test_same_key_in_order_other_keys_in_parallel(self):
+        async def scenario():
+            handled, running = [], set()
+            max_running = 0
+
+            async def handler(update):
+                nonlocal max_running
+                running.add(update['id'])
+                max_running = max(max_running, len(running))
+                # Earlier updates of a chat are slower: order must hold
+                await asyncio.sleep(0.02 if update['id'] % 2 else 0.005)
+                running.discard(update['id'])
+                handled.append(update)
+            dispatcher = UpdateDispatcher(handler, concurrency=10,
+                                          get_key=get_chat)
+            for n in range(12):
+                await dispatcher.submit(dict(id=n, chat=n % 3))
+            self.assertTrue(await dispatcher.drain(timeout=2))
+            await dispatcher.stop()
+            return handled, max_running, dispatcher.stats
+        handled, max_running, stats = run(scenario())
+        for chat in range(3):
+            self.assertEqual(
+                [update['id'] for update in handled
+                 if update['chat'] == chat],
+                list(range(chat, 12, 3))
+            )
+        self.assertEqual(max_running, 3)  # One update per chat at a time
+        self.assertEqual(stats['handled'], 12)
+        self.assertEqual(stats['active_keys'], 0)
+
+    def test_updates_without_key_are_not_ordered(self):
+        async def scenario():
+            release = asyncio.Event()
+            started = []
+
+            async def handler(update):
+                started.append(update['id'])
+                await release.wait()
+            dispatcher = UpdateDispatcher(handler, concurrency=4)
+            for n in range(4):
+                await dispatcher.submit(dict(id=n))
+            await asyncio.sleep(0.01)
+            release.set()
+            await dispatcher.drain(timeout=1)
+            await dispatcher.stop()
+            return started
+        self.assertEqual(sorted(run(scenario())), [0, 1, 2, 3])
+
+    def test_full_queue_blocks_submit(self):
+        async def scenario():
+            release = asyncio.Event()
+
+            async def handler(update):
+                await release.wait()
+            dispatcher = UpdateDispatcher(handler, concurrency=1,
+                                          queue_size=2)
+            await dispatcher.submit(dict(id=0))
+            await asyncio.sleep(0)  # Worker takes it, freeing its slot
+            await dispatcher.submit(dict(id=1))
+            await dispatcher.submit(dict(id=2))
+            blocked = asyncio.ensure_future(dispatcher.submit(dict(id=3)))
+            await asyncio.sleep(0.01)
+            was_blocked = not blocked.done()
+            release.set()
+            await blocked
+            await dispatcher.drain(timeout=1)
+            await dispatcher.stop()
+            return was_blocked, dispatcher.stats
+        was_blocked, stats = run(scenario())
+        self.assertTrue(was_blocked)
+        self.assertEqual(stats['handled'], 4)
+        self.assertGreater(stats['blocked_time'], 0)
+
+    def test_busy_key_fills_queue(self):
+        # Updates waiting for their key keep their slot (head-of-line
+        #   blocking): other keys wait although a worker is idle
+        async def scenario():
+            release = asyncio.Event()
+            handled = []
+
+            async def handler(update):
+                if update['chat'] == 0:
+                    await release.wait()
+                handled.append(update['id'])
+            dispatcher = UpdateDispatcher(handler, concurrency=2,
+                                          queue_size=2, get_key=get_chat)
+            for n in range(3):
+                await dispatcher.submit(dict(id=n, chat=0))
+            await asyncio.sleep(0.01)
+            blocked = asyncio.ensure_future(
+                dispatcher.submit(dict(id=3, chat=1))
+            )
+            await asyncio.sleep(0.01)
+            was_blocked = not blocked.done()
+            release.set()
+            await blocked
+            await dispatcher.drain(timeout=1)
+            await dispatcher.stop()
+            return was_blocked, handled
+        was_blocked, handled = run(scenario())
+        self.assertTrue(was_blocked)
+        self.assertEqual(sorted(handled), [0, 1, 2, 3])
+
+    def test_errors_are_counted_and_on_done_called(self):
+        async def scenario():
+            done = []
+
+            async def handler(update):
+                if update['id'] == 1:
+                    raise ValueError("Handler failed")
+            dispatcher = UpdateDispatcher(handler, get_key=get_chat,
+                                          on_done=done.append)
+            for n in range(3):
+                await dispatcher.submit(dict(id=n, chat=0))
+            await dispatcher.drain(timeout=1)
+            await dispatcher.stop()
+            return done, dispatcher.stats
+        done, stats = run(scenario())
+        self.assertEqual([update['id'] for update in done], [0, 1, 2])
+        self.assertEqual(stats['errors'], 1)
+        self.assertEqual(stats['handled'], 3)
+
+    def test_stop_drops_updates_in_progress_and_releases_submitters(self):
+        async def scenario():
+            async def handler(update):
+                await asyncio.Event().wait()  # Never done
+            dispatcher = UpdateDispatcher(handler, concurrency=2,
+                                          queue_size=1)
+            await dispatcher.submit(dict(id=0))
+            await dispatcher.submit(dict(id=1))
+            await asyncio.sleep(0)  # Both updates in progress
+            await dispatcher.submit(dict(id=2))  # Queued
+            blocked = asyncio.ensure_future(dispatcher.submit(dict(id=3)))
+            drained = asyncio.ensure_future(dispatcher.drain())
+            await asyncio.sleep(0.01)
+            await dispatcher.stop()
+            with self.assertRaises(asyncio.CancelledError):
+                await asyncio.wait_for(blocked, timeout=1)
+            self.assertTrue(await asyncio.wait_for(drained, timeout=1))
+            return dispatcher.stats
+        stats = run(scenario())
+        self.assertEqual(stats['submitted'], 3)
+        self.assertEqual(stats['handled'], 0)
+        self.assertEqual(stats['dropped'], 3)
@@ -0,0 +1,192 @@
+"""Test update queues, alone and consumed by bots."""
+
+# Standard library modules
+import asyncio
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+
+# Project modules
+from davtelepot.bot import Bot
+from davtelepot.update_queue import (
+    InProcessUpdateQueue, SqliteUpdateQueue, UpdateQueue
+)
+from . import run
+
+
+def make_update(update_id, chat_id):
+    """Return a text message update."""
+    return dict(
+        update_id=update_id,
+        message=dict(message_id=update_id, chat=dict(id=chat_id), date=0,
+                      text='hello')
+    )
+
+
+class TestInProcessUpdateQueue(unittest.TestCase):
+
+    def test_interface_is_abstract(self):
+        self.assertRaises(TypeError, UpdateQueue)
+
+    def test_partitions_are_delivered_in_order(self):
+        queue = InProcessUpdateQueue()
+
+        async def scenario():
+            for update_id, key in ((1, 'a'), (2, 'a'), (3, 'b'), (4, None),
+                                   (5, 'a')):
+                await queue.put(dict(update_id=update_id), key=key)
+            first = await queue.get(timeout=0.1)
+            # Partitions in progress are not delivered again
+            second = await queue.get(timeout=0.1)
+            for receipt, _ in first:
+                queue.ack(receipt)
+            third = await queue.get(timeout=0.1)
+            queue.ack(third[0][0])
+            fourth = await queue.get(timeout=0.1)
+            return [[update['update_id'] for _, update in items]
+                    for items in (first, second, third, fourth)]
+        self.assertEqual(run(scenario()), [[1, 3, 4], [], [2], [5]])
+        self.assertEqual(queue.size, 1)
+
+    def test_full_queue_waits_for_acks(self):
+        queue = InProcessUpdateQueue(max_size=2)
+
+        async def scenario():
+            await queue.put(dict(update_id=1), key='a')
+            await queue.put(dict(update_id=2), key='b')
+            put = asyncio.ensure_future(queue.put(dict(update_id=3), key='c'))
+            await asyncio.sleep(0.01)
+            blocked = not put.done()
+            receipt, _ = (await queue.get(limit=1))[0]
+            queue.ack(receipt)
+            await asyncio.wait_for(put, timeout=1)
+            return blocked
+        self.assertTrue(run(scenario()))
+        self.assertEqual(queue.size, 2)
+
+
+class TestSqliteUpdateQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'queue.db')
+        self.queues = []
+
+    def tearDown(self):
+        for queue in self.queues:
+            run(queue.close())
+        self.directory.cleanup()
+
+    def make_queue(self, **kwargs):
+        queue = SqliteUpdateQueue(self.path, poll_interval=0.01, **kwargs)
+        self.queues.append(queue)
+        return queue
+
+    @staticmethod
+    def get_ids(items):
+        return [update['update_id'] for _, update in items]
+
+    def test_updates_survive_and_are_delivered_in_order(self):
+        async def put():
+            queue = self.make_queue()
+            for update_id, key in ((1, 'a'), (2, 'a'), (3, 'b'), (4, None)):
+                await queue.put(dict(update_id=update_id), key=key)
+            await queue.close()
+        run(put())
+        self.queues.clear()
+        queue = self.make_queue()
+
+        async def consume():
+            first = await queue.get(timeout=0.1)
+            second = await queue.get(timeout=0.1)
+            for receipt, _ in first:
+                queue.ack(receipt)
+            third = await queue.get(timeout=0.1)
+            return first, second, third
+        first, second, third = run(consume())
+        self.assertEqual(self.get_ids(first), [1, 3, 4])
+        self.assertEqual(second, [])
+        self.assertEqual(self.get_ids(third), [2])
+
+    def test_unacknowledged_updates_are_delivered_again(self):
+        crashed, other = self.make_queue(lease=0.2), self.make_queue()
+
+        async def scenario():
+            await crashed.put(dict(update_id=1), key='a')
+            claimed = await crashed.get(timeout=0.1)
+            # Claimed update is not delivered to other consumers...
+            during_lease = await other.get(timeout=0.05)
+            # ... until its lease expires
+            await asyncio.sleep(0.2)
+            after_lease = await other.get(timeout=0.1)
+            other.ack(after_lease[0][0])
+            await other.flush()
+            left = await other.get(timeout=0.05)
+            return claimed, during_lease, after_lease, left
+        claimed, during_lease, after_lease, left = run(scenario())
+        self.assertEqual(self.get_ids(claimed), [1])
+        self.assertEqual(during_lease, [])
+        self.assertEqual(self.get_ids(after_lease), [1])
+        self.assertEqual(left, [])
+
+    def test_idle_consumers_do_not_lock_database(self):
+        queue = self.make_queue()
+        writer = sqlite3.connect(self.path, isolation_level=None)
+        writer.execute("BEGIN IMMEDIATE")
+        try:
+            started = time.monotonic()
+            self.assertEqual(run(queue.get(timeout=0.1)), [])
+            self.assertLess(time.monotonic() - started, 5)
+        finally:
+            writer.execute("ROLLBACK")
+            writer.close()
+
+
+class TestQueueWithWorkers(unittest.TestCase):
+    """Consume a queue in front process, handle updates in workers."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.bot = Bot(token='123456:test',
+                       database_url=os.path.join(self.directory.name,
+                                                 'bot.db'))
+        self.bot.set_router('message', self.handle_message,
+                            user_record=False)
+        self.bot.update_queue = InProcessUpdateQueue(max_size=5)
+
+    def tearDown(self):
+        Bot.shard_router = None
+        Bot.bots.remove(self.bot)
+        self.directory.cleanup()
+
+    @staticmethod
+    async def handle_message(update, user_record):
+        await asyncio.sleep(0.001)
+
+    def test_updates_handled_by_workers_are_acknowledged(self):
+        Bot.start_workers(2)
+        queue = self.bot.update_queue
+
+        async def scenario():
+            consumer = asyncio.ensure_future(
+                self.bot.consume_updates(timeout=0.1)
+            )
+            # The queue holds 5 updates: it fills up if acks get lost
+            for update_id in range(1, 31):
+                await asyncio.wait_for(
+                    self.bot.submit_update(make_update(update_id,
+                                                       update_id % 3)),
+                    timeout=5
+                )
+            deadline = time.monotonic() + 10
+            while queue.size and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+            consumer.cancel()
+            await Bot.shard_router.stop(timeout=5)
+            return Bot.shard_router.health
+        health = run(scenario())
+        self.assertEqual(queue.size, 0)
+        self.assertEqual(self.bot.update_receipts, {})
+        self.assertEqual(health['handled'], 30)
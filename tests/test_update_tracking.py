@@ -0,0 +1,106 @@
+"""Test the update journal, checkpoints and duplicate update detection."""
+
+# Standard library modules
+import os
+import tempfile
+import unittest
+
+# Project modules
+from davtelepot.bot import Bot
+from davtelepot.update_tracking import UpdateIdWindow, UpdateJournal
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """Test case providing a bot with a temporary database."""
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.bot = Bot(token='123456:test',
+                       database_url=os.path.join(self.directory.name,
+                                                 'bot.db'))
+        self.bot._telegram_id = 123456
+
+    def tearDown(self):
+        Bot.bots.remove(self.bot)
+        self.bot.db.close()
+        self.directory.cleanup()
+
+
+class TestUpdateJournal(DatabaseTestCase):
+
+    def test_unhandled_updates_are_loaded_again(self):
+        journal = UpdateJournal(self.bot.db, bot_id=1)
+        journal.append([dict(update_id=n, message=dict(text=str(n)))
+                        for n in (10, 11, 12)])
+        journal.done(11)
+        self.assertEqual(journal.flush(), 1)
+        journal.done(10)  # Not flushed: handled again after a crash
+        restarted = UpdateJournal(self.bot.db, bot_id=1)
+        self.assertEqual(
+            [update['update_id'] for update in restarted.load()],
+            [10, 12]
+        )
+        self.assertEqual(restarted.pending, 2)
+        self.assertEqual(UpdateJournal(self.bot.db, bot_id=2).load(), [])
+
+
+class TestUpdateCheckpoint(DatabaseTestCase):
+
+    def test_offset_is_restored(self):
+        self.bot.update_journal = UpdateJournal(self.bot.db,
+                                                bot_id=self.bot.telegram_id)
+        self.bot._offset = 42
+        self.bot.save_update_checkpoint()
+        self.bot._offset = 0
+        self.bot.load_update_checkpoint()
+        self.assertEqual(self.bot._offset, 42)
+
+    def test_crash_between_done_and_flush_replays_updates(self):
+        bot = self.bot
+        bot.update_journal = UpdateJournal(bot.db, bot_id=bot.telegram_id)
+        updates = [dict(update_id=n, message=dict(text=str(n)))
+                   for n in (10, 11)]
+        bot.update_journal.append(updates)
+        bot._offset = 12
+        bot.save_update_checkpoint()
+        for update in updates:
+            bot.update_handled(update)
+        # Crash: done marks are lost, updates are handled again once
+        restarted = UpdateJournal(bot.db, bot_id=bot.telegram_id)
+        self.assertEqual(
+            [update['update_id'] for update in restarted.load()], [10, 11]
+        )
+        bot._offset = 0
+        bot.load_update_checkpoint()
+        self.assertEqual(bot._offset, 12)  # Not sent again by Telegram
+        # Once flushed, handled updates are not replayed
+        bot.save_update_checkpoint()
+        self.assertEqual(
+            UpdateJournal(bot.db, bot_id=bot.telegram_id).load(), []
+        )
+
+
+class TestUpdateIdWindow(unittest.TestCase):
+
+    def test_duplicates(self):
+        window = UpdateIdWindow(size=64)
+        self.assertEqual([window.add(n) for n in (100, 102, 101, 102, 100)],
+                         [True, True, True, False, False])
+        self.assertEqual(window.duplicates, 2)
+
+    def test_ids_before_window_are_duplicates(self):
+        window = UpdateIdWindow(size=64)
+        window.add(1000)
+        window.add(1100)  # Window now starts at 1037
+        self.assertFalse(window.add(1036))
+        self.assertTrue(window.add(1090))
+        self.assertFalse(window.add(1090))
+
+    def test_reset_of_update_ids(self):
+        window = UpdateIdWindow(size=64)
+        for update_id in range(5000, 5100):
+            window.add(update_id)
+        # Telegram restarted ids from a random, lower value
+        self.assertEqual([window.add(n) for n in (17, 18, 17)],
+                         [True, True, False])
+        self.assertEqual(window.resets, 1)
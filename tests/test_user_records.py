@@ -0,0 +1,73 @@
+"""Test which updates get the record of their sender looked up."""
+
+# Standard library modules
+import os
+import tempfile
+import unittest
+
+# Project modules
+from davtelepot.bot import Bot, placeholder_handler
+
+
+def make_message(**kwargs):
+    """Return a private message sent by user 1 with `kwargs` content."""
+    return dict(message_id=1, date=0, chat=dict(id=1, type='private'),
+                **kwargs)
+
+
+class TestUserRecords(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.bot = Bot(token='123456:test',
+                       database_url=os.path.join(self.directory.name,
+                                                 'bot.db'))
+
+    def tearDown(self):
+        Bot.bots.remove(self.bot)
+        self.directory.cleanup()
+
+    def test_placeholder_handlers_do_not_need_user_record(self):
+        self.assertTrue(self.bot.needs_user_record('callback_query', {}))
+        self.assertTrue(
+            self.bot.needs_user_record('message', make_message(text='hi'))
+        )
+        self.assertFalse(self.bot.needs_user_record('poll', {}))
+        self.assertFalse(
+            self.bot.needs_user_record('message', make_message(photo=[]))
+        )
+
+    def test_handlers_declared_without_user_record(self):
+        self.assertFalse(
+            self.bot.needs_user_record('chosen_inline_result', {})
+        )
+
+        async def handler(bot, update, user_record):
+            return
+
+        self.bot.set_router('poll', handler, user_record=False)
+        self.assertFalse(self.bot.needs_user_record('poll', {}))
+        self.bot.set_router('poll', handler)
+        self.assertTrue(self.bot.needs_user_record('poll', {}))
+        self.bot.set_message_handler('photo', handler, user_record=False)
+        self.assertFalse(
+            self.bot.needs_user_record('message', make_message(photo=[]))
+        )
+        self.bot.set_message_handler('photo', handler)
+        self.assertTrue(
+            self.bot.needs_user_record('message', make_message(photo=[]))
+        )
+
+    def test_allowed_updates_skip_placeholders(self):
+        allowed_updates = self.bot.allowed_updates
+        self.assertIn('message', allowed_updates)
+        self.assertNotIn('poll', allowed_updates)
+
+        async def handler(bot, update, user_record):
+            return
+
+        self.bot.set_router('poll', handler)
+        self.assertIn('poll', self.bot.allowed_updates)
+        self.bot.set_router('poll', placeholder_handler(handler))
+        self.assertNotIn('poll', self.bot.allowed_updates)
+
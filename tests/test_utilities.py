@@ -0,0 +1,131 @@
+"""Test data structures of davtelepot.utilities."""
+
+# Standard library modules
+import gc
+import re
+import unittest
+
+# Project modules
+from davtelepot.utilities import (
+    PatternSet, PrefixTrie, _argument_injectors, get_argument_injector
+)
+
+
+class TestPrefixTrie(unittest.TestCase):
+
+    def setUp(self):
+        self.trie = PrefixTrie([('/start', 'start'), ('/', 'slash'),
+                                ('/st', 'st'), ('help', 'help')])
+
+    def test_first_inserted_prefix_wins(self):
+        self.assertEqual(self.trie.first('/start now'), 'start')
+        self.assertEqual(self.trie.first('/stop'), 'slash')
+        self.assertEqual(self.trie.first('helpful'), 'help')
+        self.assertIsNone(self.trie.first('hello'))
+        self.assertEqual(self.trie.first('', default=0), 0)
+
+    def test_longest_prefix_wins(self):
+        self.assertEqual(self.trie.longest('/start now'), 'start')
+        self.assertEqual(self.trie.longest('/stop'), 'st')
+        self.assertEqual(self.trie.longest('/help'), 'slash')
+        self.assertEqual(self.trie.longest('hello', default=0), 0)
+
+    def test_prefixes_are_yielded_shortest_first(self):
+        self.assertEqual(list(self.trie.iter_prefixes('/starting')),
+                         [(1, 1, 'slash'), (3, 2, 'st'), (6, 0, 'start')])
+
+    def test_replaced_keys_keep_their_position(self):
+        self.trie['/'] = 'root'
+        self.assertEqual(len(self.trie), 4)
+        self.assertEqual(self.trie.first('/stop'), 'root')
+        self.trie[''] = 'empty'  # Prefix of any text, inserted last
+        self.assertEqual(self.trie.first('hello'), 'empty')
+        self.assertEqual(self.trie.first('/start'), 'start')
+        self.assertEqual(self.trie.longest('hello'), 'empty')
+
+    def test_setdefault_keeps_first_value(self):
+        self.assertEqual(self.trie.setdefault('/st', 'other'), 'st')
+        self.assertEqual(self.trie.longest('/stop'), 'st')
+        self.assertEqual(self.trie.setdefault('he', 'he'), 'he')
+        self.assertEqual(len(self.trie), 5)
+        self.assertEqual(self.trie.first('help'), 'help')
+
+
+class TestPatternSet(unittest.TestCase):
+
+    def setUp(self):
+        self.patterns = PatternSet()
+        self.patterns.add('weather', re.compile(r"\bweather in (\w+)", re.I))
+        self.patterns.add_keywords('greeting', {'hello', 'hi'})
+        self.patterns.add('number', r"\d+")
+        self.patterns.add_keywords('bye', {'see you'})  # Not a single word
+
+    def test_match_starting_first_wins(self):
+        self.assertEqual(self.patterns.search("42, hello"), 'number')
+        self.assertEqual(self.patterns.search("Hello, 42"), 'greeting')
+        self.assertEqual(self.patterns.search("Weather in Rome? Hi"),
+                         'weather')
+        self.assertEqual(self.patterns.search("well, see you"), 'bye')
+        self.assertIsNone(self.patterns.search("nothing to see here"))
+        self.assertEqual(len(self.patterns), 4)
+
+    def test_keywords_match_whole_words(self):
+        self.assertIsNone(self.patterns.search("this is high"))
+        self.assertIsNone(self.patterns.search("goodbye, see youngsters"))
+
+    def test_first_added_pattern_wins_at_same_position(self):
+        self.patterns.add('digit', r"\d")
+        self.patterns.add_keywords('again', {'hello'})
+        self.assertEqual(self.patterns.search("7"), 'number')
+        self.assertEqual(self.patterns.search("hello"), 'greeting')
+
+    def test_invalid_patterns_are_not_kept(self):
+        # Group names must be unique in the combined expression
+        self.patterns.add('city', r"in (?P<city>[A-Z]\w+)")
+        with self.assertRaises(re.error):
+            self.patterns.add('town', r"to (?P<city>[A-Z]\w+)")
+        self.assertEqual(self.patterns.search("weather in Rome"), 'weather')
+        self.assertEqual(self.patterns.search("go to Rome"), None)
+        self.assertEqual(len(self.patterns), 5)
+
+    def test_inline_flags(self):
+        self.patterns.add('rain', r"(?i)rain")
+        self.patterns.add('snow', re.compile(r"(?s)snow.fall"))
+        self.patterns.add('wind', re.compile(r"""(?x) wind  # Comment
+                                                 \s storm"""))
+        self.assertEqual(self.patterns.search("RAIN!"), 'rain')
+        self.assertEqual(self.patterns.search("snow\nfall"), 'snow')
+        self.assertEqual(self.patterns.search("wind storm"), 'wind')
+
+
+class TestArgumentInjector(unittest.TestCase):
+
+    def test_injectors_are_cached_while_functions_exist(self):
+        def make_replier():
+            def replier(bot, update):
+                return
+            return replier
+        replier = make_replier()
+        injector = get_argument_injector(replier)
+        self.assertIs(get_argument_injector(replier), injector)
+        self.assertEqual(injector(dict(bot=1, update=2, user_record=3)),
+                         dict(bot=1, update=2))
+        gc.collect()  # Forget handlers left by previous tests
+        size = len(_argument_injectors)
+        # Handlers made on the fly do not pile up in the cache
+        for _ in range(10):
+            get_argument_injector(make_replier())
+        gc.collect()
+        self.assertEqual(len(_argument_injectors), size)
+        del replier
+        gc.collect()
+        self.assertEqual(len(_argument_injectors), size - 1)
+
+    def test_callables_without_weak_references(self):
+        class Replier(object):
+            __slots__ = ()
+
+            def __call__(self, bot, update):
+                return
+        injector = get_argument_injector(Replier())
+        self.assertEqual(injector(dict(bot=1, user_record=3)), dict(bot=1))
@@ -0,0 +1,81 @@
+"""Test which API calls travel in webhook responses."""
+
+# Standard library modules
+import os
+import tempfile
+
+# Project modules
+from davtelepot.bot import Bot
+from davtelepot.webhook_reply import (
+    WebhookReply, reset_webhook_reply, results_ignored, set_webhook_reply
+)
+from . import FakeServerTestCase, run
+
+
+class TestWebhookReply(FakeServerTestCase):
+
+    def make_bot(self):
+        self.directory = tempfile.TemporaryDirectory()
+        return Bot(token='123456:test',
+                   database_url=os.path.join(self.directory.name, 'bot.db'))
+
+    def tearDown(self):
+        super().tearDown()
+        Bot.bots.remove(self.bot)
+        self.directory.cleanup()
+
+    def handle(self, coroutine_function):
+        """Await `coroutine_function()` as if handling a webhook update.
+
+        Return its result and the method carried by the webhook response.
+        """
+        async def scenario():
+            webhook_reply = WebhookReply()
+            token = set_webhook_reply(webhook_reply)
+            try:
+                result = await coroutine_function()
+            finally:
+                reset_webhook_reply(token)
+            return result, webhook_reply.method
+        return run(scenario())
+
+    def test_sent_messages_are_returned(self):
+        sent, method = self.handle(
+            lambda: self.bot.send_message(chat_id=1, text="Hello",
+                                          send_default_keyboard=False)
+        )
+        self.assertIsNone(method)
+        self.assertEqual(sent['chat']['id'], 1)
+        self.assertIn('message_id', sent)
+        self.assertEqual(self.server.requests['sendMessage'], 1)
+
+    def test_replies_with_ignored_result_are_carried(self):
+        async def reply():
+            with results_ignored():
+                return await self.bot.send_message(
+                    chat_id=1, text="Hello", send_default_keyboard=False
+                )
+        self.assertEqual(self.handle(reply), (True, 'sendMessage'))
+        self.assertEqual(self.server.requests['sendMessage'], 0)
+
+    def test_true_result_methods_are_carried(self):
+        self.assertEqual(
+            self.handle(lambda: self.bot.sendChatAction(chat_id=1,
+                                                        action='typing')),
+            (True, 'sendChatAction')
+        )
+        self.assertEqual(self.server.requests['sendChatAction'], 0)
+
+    def test_handler_replies_are_carried(self):
+        @self.bot.command('/start', authorization_level='everybody')
+        async def start_command():
+            return "Hello"
+        update = dict(message_id=1, text='/start', chat=dict(id=1),
+                      date=0)
+        update['from'] = dict(id=1)
+        _, method = self.handle(
+            lambda: self.bot.text_message_handler(update=update,
+                                                  user_record=None)
+        )
+        self.assertEqual(method, 'sendMessage')
+        self.assertEqual(self.server.requests['sendMessage'], 0)